@@ -1,15 +1,61 @@
-from django.contrib import admin
+import datetime
+
+from urllib.parse import urlencode
+
+from django.contrib import admin, messages
+from django.contrib.admin.widgets import ForeignKeyRawIdWidget
+from django.core.exceptions import ValidationError
+from django.shortcuts import render
+from django.urls import NoReverseMatch, reverse
+from django.utils.html import format_html
+from django.utils.text import Truncator
 
 # Register your models here.
-from .models import Author, Genre, Book, BookInstance, Language
+from .models import Author, Genre, Book, BookInstance, CopyChanged, Hold, Job, Language
+from .forms import BookInstanceAdminForm, RenewBookForm
+from .tasks import RENEW_INLINE_LIMIT
+from . import holds, jobs
 #admin.site.register(Book)
 #admin.site.register(Author)
 admin.site.register(Genre)
 #admin.site.register(BookInstance)
 admin.site.register(Language)
 
-class BooksInline(admin.TabularInline):
+class LimitedInlineMixin:
+    """Only put the first ``inline_limit`` related rows in an inline.
+
+    A popular book can have thousands of copies; the rest are reached through
+    the link to the filtered changelist shown on the parent's form."""
+    inline_limit = 20
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        object_id = request.resolver_match.kwargs.get('object_id')
+        if object_id is None:
+            # Add form: there are no related rows yet
+            return queryset.none()
+        if not queryset.ordered:
+            queryset = queryset.order_by('pk')
+        first_pks = queryset.filter(**{self.parent_fk_name(): object_id}).values_list('pk', flat=True)
+        return queryset.filter(pk__in=list(first_pks[:self.inline_limit]))
+
+    def parent_fk_name(self):
+        """The foreign key to the parent: ``fk_name``, else the only one to the parent model."""
+        if self.fk_name:
+            return self.fk_name
+        return next(field.name for field in self.model._meta.get_fields()
+                    if field.many_to_one and field.related_model is self.parent_model)
+
+class BooksInline(LimitedInlineMixin, admin.TabularInline):
     model = Book
+    # A raw id input instead of a <select> of every language in each row
+    raw_id_fields = ('language',)
+    show_change_link = True
+
+def changelist_link(model, label, **filters):
+    """Link to the admin changelist of ``model`` filtered by ``filters``."""
+    url = reverse(f'admin:{model._meta.app_label}_{model._meta.model_name}_changelist')
+    return format_html('<a href="{}?{}">{}</a>', url, urlencode(filters), label)
 
 # Define the admin class
 class AuthorAdmin (admin.ModelAdmin):
@@ -18,31 +64,132 @@ class AuthorAdmin (admin.ModelAdmin):
 
     # used to change how the fields on the form are displayed
     # tuple will display it horizontally
-    fields = ['first_name', 'last_name', ('date_of_birth', 'date_of_death')]
+    fields = ['first_name', 'last_name', ('date_of_birth', 'date_of_death'), 'all_books']
+    readonly_fields = ['all_books']
+    # Needed for the author autocomplete on the book form
+    search_fields = ['last_name', 'first_name']
     inlines = [BooksInline]
+
+    def all_books(self, obj):
+        if obj.pk is None:
+            return '-'
+        count = obj.book_set.count()
+        return changelist_link(Book, f'All {count} book(s) by this author', author__id__exact=obj.pk)
     
 admin.site.register(Author, AuthorAdmin)
 
 # Used to add associated records at the same time
 # this will book instance informaiton inline to our book detail
-class BooksInstanceInline(admin.TabularInline):
+class LoadedRawIdWidget(ForeignKeyRawIdWidget):
+    """Raw id input labelled from ``loaded``, the related object its form's
+    instance already holds, instead of fetching it (one query per inline row)."""
+    loaded = None
+
+    def label_and_url_for_value(self, value):
+        obj = self.loaded
+        if obj is None or str(obj.pk) != str(value):
+            return super().label_and_url_for_value(value)
+        try:
+            url = reverse(f'{self.admin_site.name}:{obj._meta.app_label}_{obj._meta.model_name}_change',
+                          args=(obj.pk,))
+        except NoReverseMatch:
+            url = ''
+        return Truncator(obj).words(14), url
+
+class CopyChangedMixin:
+    """Show a copy changed by someone else between the form's version check and
+    the save (BookInstance.save raises CopyChanged) as an error on the form.
+
+    The whole change was rolled back, so the form is shown again with the error
+    instead of a server error."""
+
+    def changeform_view(self, request, *args, **kwargs):
+        try:
+            return super().changeform_view(request, *args, **kwargs)
+        except CopyChanged as e:
+            request.copy_changed = str(e)
+            return super().changeform_view(request, *args, **kwargs)
+
+    def get_form(self, request, obj=None, **kwargs):
+        form = super().get_form(request, obj, **kwargs)
+        error = getattr(request, 'copy_changed', None)
+        if error is None:
+            return form
+
+        class CopyChangedForm(form):
+            def clean(self):
+                super().clean()
+                raise ValidationError(error)
+
+        return CopyChangedForm
+
+class CopyInlineForm(BookInstanceAdminForm):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The inline's queryset joins the borrower
+        if self.instance.borrower_id:
+            self.fields['borrower'].widget.loaded = self.instance.borrower
+
+class BooksInstanceInline(LimitedInlineMixin, admin.TabularInline):
     model = BookInstance
+    form = CopyInlineForm
+    # A raw id input instead of a <select> of every user in each row
+    raw_id_fields = ('borrower',)
+    show_change_link = True
+
+    def get_queryset(self, request):
+        # Each row is labelled with str(copy), which shows the book title, and
+        # its borrower input with the borrower
+        return super().get_queryset(request).select_related('book', 'borrower')
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'borrower':
+            kwargs['widget'] = LoadedRawIdWidget(db_field.remote_field, self.admin_site, using=kwargs.get('using'))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 # Register the admin classes for Book using the decorator
 # Does the same thing as admin.site.register()
 @admin.register(Book)
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(CopyChangedMixin, admin.ModelAdmin):
     # can't specify the genre field since ManyToManyField would be too large
     # 'display_genre' is a call to the function in book class
     list_display = ('title', 'author', 'display_genre')
+    # Join the author into the changelist query instead of fetching it per row
+    list_select_related = ('author',)
+    search_fields = ['title', 'isbn']
+    autocomplete_fields = ['author']
+    readonly_fields = ['all_copies']
     # add the inline class
     inlines = [BooksInstanceInline]
+    actions = ['recount_copies']
+
+    def get_queryset(self, request):
+        # display_genre reads the prefetched genres, one query for the whole page
+        return super().get_queryset(request).prefetch_related('genre')
+
+    def all_copies(self, obj):
+        if obj.pk is None:
+            return '-'
+        return changelist_link(BookInstance, f'All {obj.copies_total} copies of this book', book__id__exact=obj.pk)
+
+    def recount_copies(self, request, queryset):
+        # A job, so selecting every book doesn't hold up the request (see catalog/jobs.py)
+        job = jobs.enqueue('rebuild_availability', user=request.user,
+                           book_ids=list(queryset.values_list('pk', flat=True)))
+        self.message_user(request, format_html('Recounting the copies in <a href="{}">job #{}</a>.',
+                                               job.get_absolute_url(), job.pk), messages.SUCCESS)
+
+    recount_copies.short_description = 'Recount the copies of selected books in the background'
     
 
 # Register the Admin classes for BookInstance using the decorator
 @admin.register(BookInstance)
-class BookInstanceAdmin(admin.ModelAdmin):
+class BookInstanceAdmin(CopyChangedMixin, admin.ModelAdmin):
+    # Refuses to overwrite a copy changed since the form was shown
+    form = BookInstanceAdminForm
     list_display = ('book', 'status', 'borrower', 'due_back', 'id')
+    list_select_related = ('book', 'borrower')
+    autocomplete_fields = ['book', 'borrower']
 
     # Used to filter which items are displayed
     list_filter = ('status', 'due_back')
@@ -50,9 +197,79 @@ class BookInstanceAdmin(admin.ModelAdmin):
     # Used to add sections within the detail form (Group related model information)
     fieldsets = (
         (None, {
-            'fields': ('book', 'imprint', 'id')
+            'fields': ('book', 'imprint', 'id', 'seen_version')
         }),
         ('Availability', {
             'fields': ('status', 'due_back', 'borrower')
         }),
-    )
\ No newline at end of file
+    )
+    # Bulk renewal: asks for the new due date on an intermediate page, then
+    # moves every selected copy on loan to it with a single UPDATE
+    actions = ['renew_loans']
+
+    def renew_loans(self, request, queryset):
+        if 'apply' in request.POST:
+            form = RenewBookForm(request.POST)
+            if form.is_valid():
+                renewal_date = form.cleaned_data['renewal_date']
+                copy_ids = list(queryset.values_list('pk', flat=True)[:RENEW_INLINE_LIMIT + 1])
+                if len(copy_ids) > RENEW_INLINE_LIMIT:
+                    # E.g. "select all": leave it to a job (see catalog/jobs.py)
+                    job = jobs.enqueue('renew_loans', user=request.user, renewal_date=renewal_date,
+                                       copy_ids=list(queryset.values_list('pk', flat=True)))
+                    self.message_user(request, format_html('Renewing the books in <a href="{}">job #{}</a>.',
+                                                           job.get_absolute_url(), job.pk), messages.SUCCESS)
+                    return None
+                renewed = queryset.renew(renewal_date)
+                self.message_user(request, f'Renewed {renewed} book(s) on loan.', messages.SUCCESS)
+                return None
+        else:
+            form = RenewBookForm(initial={'renewal_date': datetime.date.today() + datetime.timedelta(weeks=3)})
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Renew loans',
+            'opts': self.model._meta,
+            'form': form,
+            'selected': request.POST.getlist(admin.helpers.ACTION_CHECKBOX_NAME),
+            'select_across': request.POST.get('select_across', '0'),
+            'action_checkbox_name': admin.helpers.ACTION_CHECKBOX_NAME,
+        }
+        return render(request, 'admin/catalog/bookinstance/renew_loans.html', context)
+
+    renew_loans.short_description = 'Renew selected books on loan'
+
+
+@admin.register(Hold)
+class HoldAdmin(admin.ModelAdmin):
+    list_display = ('book', 'patron', 'status', 'placed_at', 'copy')
+    list_select_related = ('book', 'patron', 'copy')
+    autocomplete_fields = ['book', 'patron']
+    list_filter = ('status',)
+    # Holds move between statuses through catalog/holds.py so copies follow them
+    readonly_fields = ('status', 'copy', 'ready_at')
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if not change:
+            holds.offer_available_copy(obj.book_id)
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'task', 'status', 'attempts', 'created_by', 'created_at', 'finished_at', 'worker')
+    list_select_related = ('created_by',)
+    list_filter = ('status', 'task')
+    # Jobs are queued by the app and changed by the workers only
+    readonly_fields = ('task', 'arguments', 'status', 'attempts', 'max_attempts', 'run_after', 'created_by',
+                       'created_at', 'started_at', 'finished_at', 'worker', 'result', 'error')
+    actions = ['retry_jobs']
+
+    def has_add_permission(self, request):
+        return False
+
+    def retry_jobs(self, request, queryset):
+        retried = jobs.retry(queryset)
+        self.message_user(request, f'Queued {retried} failed job(s) again.', messages.SUCCESS)
+
+    retry_jobs.short_description = 'Retry selected failed jobs'
@@ -0,0 +1,199 @@
+"""Read-only JSON API over the catalog, for the kiosk and mobile clients.
+
+    GET /catalog/api/<resource>/                   first page, ordered by id
+    GET /catalog/api/<resource>/?cursor=...        following pages (see "next")
+    GET /catalog/api/<resource>/?ids=1,2,3         up to API_MAX_LIMIT rows by id
+    GET /catalog/api/<resource>/?fields=title,author   only these fields (id is always included)
+
+Resources are books, authors, genres and copies (the availability of each
+copy; filter with ?book=1,2). Rows are read with values() and serialized as
+they come, no model instances are built, and the number of queries doesn't
+depend on the number of rows.
+"""
+from django.core.exceptions import ValidationError
+from django.http import Http404, JsonResponse
+from django.views.decorators.http import require_safe
+
+from catalog.models import Author, Book, BookInstance, Genre
+from catalog.pagination import decode_cursor, encode_cursor, field_value
+
+API_DEFAULT_LIMIT = 50
+API_MAX_LIMIT = 500
+
+# Public field name -> values() lookup. A dict of lookups is returned as a
+# nested object, or null if its first lookup (the related id) is null.
+BOOK_FIELDS = {
+    'id': 'id',
+    'title': 'title',
+    'isbn': 'isbn',
+    'summary': 'summary',
+    'language': 'language__name',
+    'author': {'id': 'author_id', 'first_name': 'author__first_name', 'last_name': 'author__last_name'},
+    'availability': {
+        'total': 'copies_total',
+        'available': 'copies_available',
+        'on_loan': 'copies_on_loan',
+        'reserved': 'copies_reserved',
+        'maintenance': 'copies_maintenance',
+    },
+    'updated_at': 'updated_at',
+}
+AUTHOR_FIELDS = {
+    'id': 'id',
+    'first_name': 'first_name',
+    'last_name': 'last_name',
+    'date_of_birth': 'date_of_birth',
+    'date_of_death': 'date_of_death',
+    'updated_at': 'updated_at',
+}
+GENRE_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+}
+# No borrower: the API is public, like the catalog pages
+COPY_FIELDS = {
+    'id': 'id',
+    'book': 'book_id',
+    'imprint': 'imprint',
+    'status': 'status',
+    'due_back': 'due_back',
+    'updated_at': 'updated_at',
+}
+
+
+def book_genres(book_ids):
+    """Genres of each book as {book_id: [{'id': ..., 'name': ...}]}, in one query."""
+    genres = {}
+    rows = (Book.genre.through.objects.filter(book_id__in=book_ids)
+            .order_by('book_id', 'genre__name').values_list('book_id', 'genre_id', 'genre__name'))
+    for book_id, genre_id, name in rows:
+        genres.setdefault(book_id, []).append({'id': genre_id, 'name': name})
+    return genres
+
+
+# Resource name -> (model, fields, default fields, {field: loader for many-to-many
+# fields, fetched for the whole page in one extra query}, {query parameter: (filter lookup, model of the ids)})
+RESOURCES = {
+    'books': (Book, BOOK_FIELDS, ('id', 'title', 'author', 'availability'),
+              {'genres': book_genres}, {}),
+    'authors': (Author, AUTHOR_FIELDS, tuple(AUTHOR_FIELDS), {}, {}),
+    'genres': (Genre, GENRE_FIELDS, tuple(GENRE_FIELDS), {}, {}),
+    'copies': (BookInstance, COPY_FIELDS, tuple(COPY_FIELDS), {}, {'book': ('book_id__in', Book)}),
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _split(value):
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+
+def _lookups(fields, selected):
+    lookups = []
+    for name in selected:
+        lookup = fields[name]
+        lookups.extend(lookup.values() if isinstance(lookup, dict) else [lookup])
+    return lookups
+
+
+def _shape(row, fields, selected):
+    """Turn a flat values() row into the API object with the selected fields."""
+    item = {}
+    for name in selected:
+        lookup = fields[name]
+        if isinstance(lookup, dict):
+            nested = {key: row[value] for key, value in lookup.items()}
+            item[name] = nested if next(iter(nested.values())) is not None else None
+        else:
+            item[name] = row[lookup]
+    return item
+
+
+def _parse_ids(model, values):
+    pk = model._meta.pk
+    try:
+        return [field_value(pk, value) for value in values]
+    except ValidationError:
+        raise BadRequest(f'Invalid {model._meta.verbose_name} id.')
+
+
+def _parse_limit(value):
+    try:
+        limit = int(value)
+    except ValueError:
+        raise BadRequest('limit must be a number.')
+    if not 1 <= limit <= API_MAX_LIMIT:
+        raise BadRequest(f'limit must be between 1 and {API_MAX_LIMIT}.')
+    return limit
+
+
+def fetch(request, resource):
+    """Return the response body for a request to ``resource``; raises BadRequest for invalid parameters."""
+    model, fields, default_fields, related, filters = RESOURCES[resource]
+    params = request.GET
+
+    selected = _split(params['fields']) if 'fields' in params else list(default_fields)
+    unknown = [name for name in selected if name not in fields and name not in related]
+    if unknown:
+        raise BadRequest(f'Unknown fields: {", ".join(unknown)}. Choose from {", ".join([*fields, *related])}.')
+    selected = ['id'] + [name for name in dict.fromkeys(selected) if name != 'id']
+    columns = [name for name in selected if name in fields]
+
+    queryset = model.objects.order_by('pk')
+    for param, (lookup, ids_model) in filters.items():
+        if param in params:
+            queryset = queryset.filter(**{lookup: _parse_ids(ids_model, _split(params[param]))})
+
+    body = {}
+    if 'ids' in params:
+        ids = _parse_ids(model, _split(params['ids']))
+        if len(ids) > API_MAX_LIMIT:
+            raise BadRequest(f'At most {API_MAX_LIMIT} ids per request.')
+        rows = list(queryset.filter(pk__in=ids).values(*_lookups(fields, columns)))
+        found = {row['id'] for row in rows}
+        body['missing'] = [value for value in ids if value not in found]
+    else:
+        # Keyset pagination on the primary key (see catalog/pagination.py for the cursor format)
+        limit = _parse_limit(params.get('limit', API_DEFAULT_LIMIT))
+        if params.get('cursor'):
+            try:
+                values, _, number = decode_cursor(params['cursor'])
+            except Http404:
+                raise BadRequest('Invalid cursor.')
+            if len(values) != 1:
+                raise BadRequest('Invalid cursor.')
+            try:
+                queryset = queryset.filter(pk__gt=_parse_ids(model, values)[0])
+            except BadRequest:
+                raise BadRequest('Invalid cursor.')
+        else:
+            number = 1
+        rows = list(queryset.values(*_lookups(fields, columns))[:limit + 1])
+        body['next'] = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            query = params.copy()
+            query['cursor'] = encode_cursor([rows[-1]['id']], 'next', number + 1)
+            body['next'] = f'{request.path}?{query.urlencode()}'
+
+    items = [_shape(row, fields, columns) for row in rows]
+    for name in selected:
+        if name in related:
+            loaded = related[name]([item['id'] for item in items])
+            for item in items:
+                item[name] = loaded.get(item['id'], [])
+    body['results'] = items
+    return body
+
+
+@require_safe
+def resource_list(request, resource):
+    if resource not in RESOURCES:
+        raise Http404(f'No API resource {resource!r}')
+    try:
+        body = fetch(request, resource)
+    except BadRequest as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(body)
@@ -3,3 +3,13 @@ from django.apps import AppConfig
 
 class CatalogConfig(AppConfig):
     name = 'catalog'
+
+    def ready(self):
+        # Connect the model signal handlers (cache invalidation etc.)
+        from catalog import signals  # noqa: F401
+        # Register the background tasks (see catalog/jobs.py)
+        from catalog import tasks  # noqa: F401
+        # Apply settings.SQLITE_PRAGMAS to every new database connection
+        from django.db.backends.signals import connection_created
+        from catalog.sqlite import configure_connection
+        connection_created.connect(configure_connection, dispatch_uid='catalog.sqlite.configure_connection')
@@ -0,0 +1,71 @@
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from catalog.cache import bump_version
+from catalog.models import Book, BookInstance
+
+# Book counter for each BookInstance.status. Copies with a blank status only
+# count towards copies_total.
+STATUS_COUNTERS = {
+    'm': 'copies_maintenance',
+    'o': 'copies_on_loan',
+    'a': 'copies_available',
+    'r': 'copies_reserved',
+}
+
+
+def _counter_deltas(status, delta):
+    deltas = {'copies_total': delta}
+    if status in STATUS_COUNTERS:
+        deltas[STATUS_COUNTERS[status]] = delta
+    return deltas
+
+
+def copy_changed(old, new):
+    """Move a copy between books/statuses in the counters.
+
+    ``old`` and ``new`` are (book_id, status) pairs, or None when the copy is
+    being created or deleted. The counters are adjusted with F() expressions,
+    so concurrent changes to the same book can't overwrite each other."""
+    if old == new:
+        return
+    # Net change per book, so moving a copy between statuses of the same book
+    # is a single UPDATE
+    changes = {}
+    for state, delta in ((old, -1), (new, 1)):
+        book_id, status = state or (None, None)
+        if book_id is None:
+            continue
+        book_changes = changes.setdefault(book_id, {})
+        for name, d in _counter_deltas(status, delta).items():
+            book_changes[name] = book_changes.get(name, 0) + d
+    with transaction.atomic():
+        for book_id, deltas in changes.items():
+            deltas = {name: d for name, d in deltas.items() if d}
+            if not deltas:
+                continue
+            # Never below zero, even if the counters drifted (e.g. after a bulk load).
+            # update() skips auto_now, and the counters are shown on the book's pages,
+            # so bump updated_at as well.
+            Book.objects.filter(pk=book_id).update(
+                updated_at=timezone.now(),
+                **{name: Greatest(F(name) + d, Value(0)) for name, d in deltas.items()})
+
+
+def rebuild_availability(books=None):
+    """Recount the copies of ``books`` (a Book queryset, default all) in one UPDATE."""
+    copies = BookInstance.objects.filter(book=OuterRef('pk')).order_by().values('book')
+
+    def count(**filters):
+        counted = copies.filter(**filters).annotate(count=Count('pk')).values('count')
+        return Coalesce(Subquery(counted), Value(0))
+
+    counters = {'copies_total': count()}
+    counters.update({name: count(status=status) for status, name in STATUS_COUNTERS.items()})
+    # As in copy_changed(): update() skips auto_now and the signal handlers,
+    # so bump updated_at and mark the cached pages showing the counters stale
+    updated = (Book.objects.all() if books is None else books).update(updated_at=timezone.now(), **counters)
+    bump_version(Book)
+    return updated
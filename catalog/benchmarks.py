@@ -0,0 +1,176 @@
+"""Benchmark of every page in catalog.urls on a synthetic catalog.
+
+Each case is requested through the test client as the kind of user who
+uses the page, with every cache cleared first, so the numbers are those of
+actually building the page:
+
+- queries: SQL statements run for the request, and how many exactly
+  repeated an earlier one (both exact, the same every run)
+- latency: median and fastest of ``runs`` requests, in ms
+- memory: peak Python allocations during one request (tracemalloc), in KiB
+
+"manage.py benchmark_urls" seeds the catalog, runs the cases, saves the
+results as JSON and compares them with a previous run's (see compare()).
+"""
+import statistics
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from catalog.models import Author, Book, BookInstance, Job
+from catalog.profiling import RequestProfile
+
+HOST = 'localhost'
+
+# URL name in catalog.urls -> (who requests it, URL arguments, query string),
+# or the reason it isn't benchmarked. Names of fixtures() stand for the object.
+URL_CASES = {
+    'index': ('anonymous', (), {}),
+    'books': ('anonymous', (), {}),
+    'book-search': ('anonymous', (), {'q': 'river'}),
+    'book-detail': ('anonymous', ('book',), {}),
+    'authors': ('anonymous', (), {}),
+    'author-detail': ('anonymous', ('author',), {}),
+    'my-borrowed': ('patron', (), {}),
+    'all-borrowed': ('librarian', (), {}),
+    'renew-book-librarian': ('librarian', ('loan',), {}),
+    'checkout-copy': ('librarian', ('available',), {}),
+    'return-copy': ('librarian', ('loan',), {}),
+    'renew-books-bulk': ('librarian', (), {'copies': 'loans'}),
+    'loan-report': ('librarian', (), {}),
+    'place-hold': 'POST only, changes the hold queue',
+    'cancel-hold': 'POST only, changes the hold queue',
+    'export-catalog': ('librarian', ('books',), {}),
+    'api': ('anonymous', ('books',), {}),
+    'profiling': ('librarian', (), {}),
+    'jobs': ('librarian', (), {}),
+    'job-detail': ('librarian', ('job',), {}),
+    'enqueue-job': 'POST only, queues a job',
+    'author_create': ('librarian', (), {}),
+    'author_update': ('librarian', ('author',), {}),
+    'author_delete': ('librarian', ('author',), {}),
+}
+
+# Differences below these are noise, whatever the tolerance
+LATENCY_SLACK_MS = 2
+MEMORY_SLACK_KB = 64
+
+
+def fixtures():
+    """Objects of the seeded catalog that the cases need, picked deterministically."""
+    librarian, _ = User.objects.get_or_create(username='benchmark-librarian',
+                                              defaults={'is_staff': True, 'is_superuser': True})
+    on_loan = BookInstance.objects.filter(status__exact='o').order_by('id')
+    loan = on_loan.select_related('borrower').first()
+    return {
+        'users': {'anonymous': None, 'patron': loan.borrower, 'librarian': librarian},
+        # The book with the most copies, the worst case for its detail page
+        'book': Book.objects.order_by('-copies_total', 'id').values_list('id', flat=True).first(),
+        'author': Author.objects.order_by('id').values_list('id', flat=True).first(),
+        'loan': loan.pk,
+        'loans': [str(pk) for pk in on_loan.values_list('id', flat=True)[:10]],
+        'available': BookInstance.objects.filter(status__exact='a').order_by('id').values_list(
+            'id', flat=True).first(),
+        'job': Job.objects.get_or_create(task='rebuild_search_index', created_by=librarian)[0].pk,
+    }
+
+
+def cases(objects):
+    """(name, user, url, query) for every benchmarked URL."""
+    for name, case in URL_CASES.items():
+        if isinstance(case, str):
+            continue
+        user, args, query = case
+        url = reverse(name, args=[objects.get(arg, arg) for arg in args])
+        query = {key: objects.get(value, value) for key, value in query.items()}
+        yield name, objects['users'][user], url, query
+
+
+def _request(client, url, query):
+    response = client.get(url, query)
+    if response.streaming:
+        # An export is only done once all of it has been sent
+        for _ in response.streaming_content:
+            pass
+    return response
+
+
+def measure(client, url, query, runs):
+    def cold():
+        for cache in caches.all():
+            cache.clear()
+
+    cold()
+    # The profiling middleware's execute wrapper: the log behind
+    # CaptureQueriesContext is reset when a request starts
+    profile = RequestProfile()
+    with connection.execute_wrapper(profile.record_query):
+        response = _request(client, url, query)
+
+    cold()
+    tracemalloc.start()
+    try:
+        _request(client, url, query)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    timings = []
+    for _ in range(runs):
+        cold()
+        start = time.perf_counter()
+        _request(client, url, query)
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        'url': url,
+        'status': response.status_code,
+        'queries': profile.queries,
+        'duplicate_queries': profile.duplicates,
+        'median_ms': round(statistics.median(timings), 3),
+        'min_ms': round(min(timings), 3),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def run(runs=10, progress=None):
+    """Benchmark every case; returns {url name: measurements}."""
+    objects = fixtures()
+    clients = {}
+    results = {}
+    # As in production: DEBUG adds its own work to every query
+    with override_settings(DEBUG=False, ALLOWED_HOSTS=[HOST]):
+        for name, user, url, query in cases(objects):
+            if user not in clients:
+                clients[user] = client = Client(HTTP_HOST=HOST)
+                if user is not None:
+                    client.force_login(user)
+            results[name] = measure(clients[user], url, query, runs)
+            if progress:
+                progress(name, results[name])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Messages for every case that got worse than in ``baseline``: any extra
+    query, a different status, or latency (median) or memory more than
+    ``tolerance`` (0.25 = 25%) above it."""
+    regressions = []
+    for name, old in baseline.items():
+        new = results.get(name)
+        if new is None:
+            continue
+        if new['status'] != old['status']:
+            regressions.append(f'{name}: status {old["status"]} -> {new["status"]}')
+        if new['queries'] > old['queries']:
+            regressions.append(f'{name}: {old["queries"]} -> {new["queries"]} queries')
+        if new['median_ms'] > old['median_ms'] * (1 + tolerance) + LATENCY_SLACK_MS:
+            regressions.append(f'{name}: median {old["median_ms"]:.1f} -> {new["median_ms"]:.1f} ms')
+        if new['peak_kb'] > old['peak_kb'] * (1 + tolerance) + MEMORY_SLACK_KB:
+            regressions.append(f'{name}: peak memory {old["peak_kb"]:.0f} -> {new["peak_kb"]:.0f} KiB')
+    return regressions
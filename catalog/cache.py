@@ -0,0 +1,138 @@
+import collections
+import functools
+import hashlib
+import threading
+import time
+import uuid
+
+from django.core.cache import caches
+
+# Rendered catalog pages are stored in the 'pages' cache (see CACHES in
+# settings.py: a size-limited local-memory LRU by default, or files on disk).
+# The version of each model they were built from is kept apart, in the
+# 'page-versions' cache, which every process shares so that a version bumped
+# by a management command or a job reaches the web workers.
+PAGE_CACHE_ALIAS = 'pages'
+VERSION_CACHE_ALIAS = 'page-versions'
+PAGE_CACHE_TIMEOUT = 60 * 60
+
+# Hits and misses of this process; counting them in a shared cache would
+# turn every hit into a write
+_page_cache_counts = collections.Counter()
+_page_cache_counts_lock = threading.Lock()
+
+
+def page_cache():
+    return caches[PAGE_CACHE_ALIAS]
+
+
+def version_cache():
+    return caches[VERSION_CACHE_ALIAS]
+
+
+def isolated_caches(directory):
+    """A CACHES setting for the tests and benchmarks, with the shared versions
+    kept in ``directory``, so pages built from a throwaway database never reach
+    (or clear) the caches of a server running from the same checkout."""
+    return {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'isolated-default',
+        },
+        PAGE_CACHE_ALIAS: {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'isolated-pages',
+            'OPTIONS': {'MAX_ENTRIES': 2000},
+        },
+        VERSION_CACHE_ALIAS: {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': directory,
+        },
+    }
+
+
+def _version_key(model):
+    return f'catalog:version:{model._meta.label_lower}'
+
+
+def _new_version():
+    return uuid.uuid4().hex, time.time()
+
+
+def bump_version(model):
+    """Mark every cached page built from ``model`` as stale.
+
+    Versions are random rather than a counter, so a version key that was
+    evicted or lost can never come back with a value an old page was built with.
+    The time of the bump is kept with it (see get_versions_changed())."""
+    version_cache().set(_version_key(model), _new_version(), None)
+
+
+def get_versions_changed(models):
+    """Current version of each model and the time it was set, as a list of
+    ``(version, timestamp)``, creating the missing ones, in one cache round trip.
+    A missing version is taken to have changed now."""
+    cache = version_cache()
+    keys = [_version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    missing = {key: _new_version() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def get_versions(models):
+    """Current version of each model, creating the missing ones, in one cache round trip."""
+    return [version for version, _ in get_versions_changed(models)]
+
+
+def _count(outcome):
+    with _page_cache_counts_lock:
+        _page_cache_counts[outcome] += 1
+
+
+def page_cache_stats():
+    """Return {'hits': ..., 'misses': ...} for the cached catalog pages served by this process."""
+    with _page_cache_counts_lock:
+        return {'hits': _page_cache_counts['hits'], 'misses': _page_cache_counts['misses']}
+
+
+def reset_page_cache_stats():
+    with _page_cache_counts_lock:
+        _page_cache_counts.clear()
+
+
+def cache_catalog_page(*models, timeout=PAGE_CACHE_TIMEOUT):
+    """View decorator caching the rendered page for anonymous GET requests.
+
+    The cache key is the full path (so the object id and page or cursor are
+    part of it) plus the current version of each model in ``models``; the
+    signal handlers in catalog/signals.py bump a model's version whenever one
+    of its rows is saved or deleted, so stale pages are simply never looked up
+    again and age out of the LRU."""
+    def decorator(view_func):
+        @functools.wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+                return view_func(request, *args, **kwargs)
+
+            path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+            versions = hashlib.md5(':'.join(get_versions(models)).encode()).hexdigest()
+            key = f'catalog:page:{path}:{versions}'
+            cache = page_cache()
+            response = cache.get(key)
+            if response is not None:
+                _count('hits')
+                return response
+
+            _count('misses')
+            response = view_func(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming:
+                if hasattr(response, 'render') and callable(response.render):
+                    response.add_post_render_callback(lambda r: cache.set(key, r, timeout))
+                else:
+                    cache.set(key, response, timeout)
+            return response
+        return wrapped
+    return decorator
@@ -0,0 +1,110 @@
+import functools
+import hashlib
+
+from django.conf import settings
+from django.db import connection, models
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from catalog.cache import PAGE_CACHE_TIMEOUT, get_versions_changed, page_cache
+from catalog.models import Author, Book, BookInstance
+
+
+def latest_update(querysets):
+    """Return the newest ``updated_at`` of all the rows in ``querysets`` (None if
+    they are all empty), in a single query.
+
+    Each queryset becomes a scalar "newest row first, LIMIT 1" subquery, which
+    the updated_at indexes answer without scanning the tables."""
+    columns, params = [], []
+    for queryset in querysets:
+        sql, sql_params = queryset.order_by('-updated_at').values('updated_at')[:1].query.sql_with_params()
+        columns.append(f'({sql})')
+        params.extend(sql_params)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT ' + ', '.join(columns), params)
+        row = cursor.fetchone()
+
+    # Scalar subqueries skip the field converters, so SQLite returns plain strings
+    field = models.DateTimeField()
+    found = []
+    for value in row:
+        if value is None:
+            continue
+        value = field.to_python(value)
+        if settings.USE_TZ and timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.utc)
+        found.append(value)
+    return max(found, default=None)
+
+
+def book_list_updates(request, **kwargs):
+    return [Book.objects.all(), Author.objects.all()]
+
+
+def book_detail_updates(request, pk, **kwargs):
+    # The availability counters live on the book row, the due dates on its copies
+    return [Book.objects.filter(pk=pk), Author.objects.filter(book=pk), BookInstance.objects.filter(book=pk)]
+
+
+def author_list_updates(request, **kwargs):
+    return [Author.objects.all()]
+
+
+def author_detail_updates(request, pk, **kwargs):
+    return [Author.objects.filter(pk=pk), Book.objects.filter(author=pk)]
+
+
+def conditional_catalog_page(updates, *models):
+    """View decorator answering conditional GETs from anonymous visitors.
+
+    ``updates(request, **kwargs)`` returns the querysets whose newest
+    ``updated_at`` is the page's Last-Modified time, unless one of the page
+    cache versions of ``models`` (see catalog/cache.py) was bumped later. The
+    ETag covers the full path and those versions too, so deletions and changes
+    to models without an updated_at column (genres, languages) change both. When the client's copy is still current the
+    response is a bodiless 304 and the view isn't run at all.
+
+    The validators are kept in the page cache under the same versions as the
+    page, so like a page cache hit, revalidating costs no queries until one
+    of ``models`` changes. Apply it outside cache_catalog_page so a 304 skips
+    the page lookup as well."""
+    def decorator(view_func):
+        @functools.wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            # Logged in users see their own links in the sidebar, so only
+            # anonymous pages are shared enough to be worth validating
+            if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+                return view_func(request, *args, **kwargs)
+
+            path = request.get_full_path()
+            versions_changed = get_versions_changed(models)
+            versions = [version for version, _ in versions_changed]
+            key = 'catalog:validators:%s' % hashlib.md5(':'.join([path] + versions).encode()).hexdigest()
+            cache = page_cache()
+            validators = cache.get(key)
+            if validators is None:
+                latest = latest_update(updates(request, **kwargs))
+                stamp = latest.isoformat() if latest else ''
+                etag = '"%s"' % hashlib.md5(':'.join([path, stamp] + versions).encode()).hexdigest()
+                # A deletion or a change to a genre or language moves no
+                # updated_at, only a version: the page is as new as either
+                changed = [changed for _, changed in versions_changed]
+                if latest:
+                    changed.append(latest.timestamp())
+                validators = (etag, int(max(changed)) if changed else None)
+                cache.set(key, validators, PAGE_CACHE_TIMEOUT)
+            etag, last_modified = validators
+
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = view_func(request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                # Overwrite, a page from the page cache still has the headers it was stored with
+                response['ETag'] = etag
+                if last_modified:
+                    response['Last-Modified'] = http_date(last_modified)
+            return response
+        return wrapped
+    return decorator
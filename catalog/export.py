@@ -0,0 +1,79 @@
+import csv
+import datetime
+import json
+import uuid
+import zlib
+
+from catalog.models import Author, Book, BookInstance
+
+# Columns of each export, as values_list() lookups. Related columns are joined
+# in SQL, so rows come straight from the cursor without building model instances.
+DATASETS = {
+    'books': (Book, ('id', 'title', 'isbn', 'summary', 'author_id', 'language__name',
+                     'copies_total', 'copies_available', 'copies_on_loan', 'copies_reserved',
+                     'copies_maintenance')),
+    'book_genres': (Book.genre.through, ('book_id', 'genre_id', 'genre__name')),
+    'authors': (Author, ('id', 'first_name', 'last_name', 'date_of_birth', 'date_of_death')),
+    # The loan ledger: every copy with its current borrower and due date
+    'copies': (BookInstance, ('id', 'book_id', 'book__title', 'imprint', 'status', 'due_back',
+                              'borrower_id', 'borrower__username')),
+}
+FORMATS = ('csv', 'jsonl')
+
+
+def _plain(value):
+    """Convert a database value to something csv/json can write."""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+class _Echo:
+    """File-like object whose write() returns the line instead of storing it,
+    so csv.writer can be used to produce a stream."""
+
+    def write(self, value):
+        return value
+
+
+def export_rows(dataset, chunk_size=2000):
+    """Yield the header and then each row of ``dataset`` as a tuple, walking the
+    table with a chunked iterator so memory stays flat."""
+    model, columns = DATASETS[dataset]
+    yield columns
+    queryset = model.objects.order_by('pk').values_list(*columns)
+    for row in queryset.iterator(chunk_size=chunk_size):
+        yield tuple(_plain(value) for value in row)
+
+
+def export_lines(dataset, file_format='csv', chunk_size=2000):
+    """Yield ``dataset`` as lines of text in CSV (with a header) or JSONL."""
+    rows = export_rows(dataset, chunk_size)
+    columns = next(rows)
+    if file_format == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(columns)
+        for row in rows:
+            yield writer.writerow(row)
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n'
+
+
+def gzip_stream(lines, flush_size=64 * 1024):
+    """Gzip-compress a stream of text lines, yielding compressed blocks of bytes."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    pending = []
+    size = 0
+    for line in lines:
+        data = line.encode()
+        pending.append(data)
+        size += len(data)
+        if size >= flush_size:
+            block = compressor.compress(b''.join(pending))
+            pending, size = [], 0
+            if block:
+                yield block
+    yield compressor.compress(b''.join(pending)) + compressor.flush()
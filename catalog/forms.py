@@ -1,9 +1,24 @@
 import datetime
+import uuid
 
 from django import forms
+from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
 
+from catalog.models import BookInstance
+
+def validate_renewal_date(data):
+    """Renewal rules shared by the single and bulk renewal forms."""
+    # Check if a date is not in the past
+    if data < datetime.date.today():
+        # (_ ()) in case to translate the site later
+        raise ValidationError(_('Invalid date - renewal in the past'))
+
+    # Check if a date is in the allowed range (+4 weeks from today)
+    if data > datetime.date.today() + datetime.timedelta(weeks=4):
+        raise ValidationError(_('Invalid date - renewal more than 4 weeks ahead'))
+
 class RenewBookForm(forms.Form):
     renewal_date = forms.DateField(help_text = "Enter a date between now and 4 weeks (default 3).")
 
@@ -11,15 +26,68 @@ class RenewBookForm(forms.Form):
     def clean_renewal_date(self):
         # Gets the data "cleaned" and converted to correct standard type
         data = self.cleaned_data['renewal_date']
+        validate_renewal_date(data)
 
-        # Check if a date is not in the past
-        if data < datetime.date.today():
-            # (_ ()) in case to translate the site later
-            raise ValidationError(_('Invalid date - renewal in the past'))
+        # Remember to always return the cleaned data
+        return data
 
-        # Check if a date is in the allowed range (+4 weeks from today)
-        if data > datetime.date.today():
-            raise ValidationError(_('Invalid date - renewal more than 4 weeks ahead'))
+class MultipleUUIDField(forms.Field):
+    """A list of UUIDs, e.g. the ids of the copies ticked on a list page."""
+    widget = forms.MultipleHiddenInput
+    default_error_messages = {
+        'invalid': _('Enter a list of valid copy ids.'),
+    }
 
-        # Remember to always return the cleaned data
-        return data
\ No newline at end of file
+    def to_python(self, value):
+        if not value:
+            return []
+        if not isinstance(value, (list, tuple)):
+            raise ValidationError(self.error_messages['invalid'], code='invalid')
+        try:
+            return [uuid.UUID(str(item)) for item in value]
+        except ValueError:
+            raise ValidationError(self.error_messages['invalid'], code='invalid')
+
+class BulkRenewBookForm(RenewBookForm):
+    """Renew many copies at once; the date follows the same rules as RenewBookForm."""
+    copies = MultipleUUIDField(error_messages={'required': _('Select at least one book to renew.')})
+
+class CopyVersionForm(forms.Form):
+    """Carries the version of the copy the librarian was looking at, so a change
+    made meanwhile by someone else is refused rather than overwritten (see catalog/loans.py)."""
+    version = forms.IntegerField(widget=forms.HiddenInput, min_value=0)
+
+class RenewCopyForm(RenewBookForm, CopyVersionForm):
+    pass
+
+class CheckoutForm(CopyVersionForm):
+    borrower = forms.ModelChoiceField(queryset=User.objects.all(), to_field_name='username',
+                                      widget=forms.TextInput, help_text="The borrower's username.",
+                                      error_messages={'invalid_choice': _('No user with that username.')})
+    due_back = forms.DateField(help_text="Enter a date between now and 4 weeks (default 3).")
+
+    def clean_due_back(self):
+        data = self.cleaned_data['due_back']
+        validate_renewal_date(data)
+        return data
+
+class BookInstanceAdminForm(forms.ModelForm):
+    """The admin form of a copy, refused if the copy changed (e.g. was checked
+    out) after the form was shown. BookInstance.save() checks the version once more."""
+    seen_version = forms.IntegerField(widget=forms.HiddenInput, required=False)
+
+    class Meta:
+        model = BookInstance
+        fields = '__all__'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.instance._state.adding:
+            self.fields['seen_version'].initial = self.instance.version
+
+    def clean(self):
+        cleaned_data = super().clean()
+        seen = cleaned_data.get('seen_version')
+        if not self.instance._state.adding and seen is not None and seen != self.instance.version:
+            raise ValidationError(_('The copy was changed by someone else, reload the page and try again.'))
+        return cleaned_data
@@ -0,0 +1,97 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from catalog import availability
+from catalog.cache import bump_version
+from catalog.models import BookInstance, Hold
+
+# Times allocate_copy looks for the next hold when a concurrent allocation
+# takes the one it found first
+ALLOCATE_ATTEMPTS = 5
+
+
+def waiting(book_id):
+    """The waiting holds on a book, in queue order (hold_queue_idx)."""
+    return Hold.objects.filter(book_id=book_id, status='w').order_by('placed_at', 'id')
+
+
+def place_hold(book, patron):
+    """Put ``patron`` at the back of the queue for ``book`` and return the Hold.
+
+    If a copy is available right now it is set aside straight away. A patron
+    who already has an active hold on the book gets that one back."""
+    try:
+        with transaction.atomic():
+            hold = Hold.objects.create(book=book, patron=patron)
+    except IntegrityError:
+        return Hold.objects.get(book=book, patron=patron, status__in=['w', 'r'])
+    if offer_available_copy(book.pk) is not None:
+        hold.refresh_from_db()
+    return hold
+
+
+def offer_available_copy(book_id):
+    """If a copy of the book is on the shelf, set it aside for the next hold."""
+    copy_id = BookInstance.objects.filter(book_id=book_id, status='a').values_list('pk', flat=True).first()
+    return None if copy_id is None else allocate_copy(copy_id)
+
+
+def allocate_copy(copy_id):
+    """Set an available copy aside for the next patron in line for its book.
+
+    Returns the Hold that got it, or None if nobody is waiting or the copy is
+    no longer available. Safe to call from concurrent returns of the same
+    copy: the hold and the copy are each claimed with a conditional UPDATE
+    (``WHERE status = ...``), so only one caller can move either of them, and
+    a caller that loses the race on the copy rolls back its claim on the hold."""
+    copy = BookInstance.objects.filter(pk=copy_id, status='a').values('book_id').first()
+    if copy is None or copy['book_id'] is None:
+        return None
+    book_id = copy['book_id']
+    now = timezone.now()
+    with transaction.atomic():
+        for _ in range(ALLOCATE_ATTEMPTS):
+            # One index seek to the front of the queue
+            hold_id = waiting(book_id).values_list('pk', flat=True).first()
+            if hold_id is None:
+                return None
+            if Hold.objects.filter(pk=hold_id, status='w').update(status='r', copy_id=copy_id, ready_at=now):
+                break
+        else:
+            return None
+        if not BookInstance.objects.filter(pk=copy_id, status='a').update(status='r', updated_at=now, version=F('version') + 1):
+            # Someone else lent or set aside the copy first
+            transaction.set_rollback(True)
+            return None
+        # update() skips the signal handlers that keep these in step
+        availability.copy_changed((book_id, 'a'), (book_id, 'r'))
+    bump_version(BookInstance)
+    return Hold.objects.get(pk=hold_id)
+
+
+def cancel_hold(hold):
+    """Take a waiting or ready hold out of the queue; a copy set aside for it
+    goes to the next patron in line, or back on the shelf."""
+    with transaction.atomic():
+        if not Hold.objects.filter(pk=hold.pk, status__in=['w', 'r']).update(status='c'):
+            return False
+        copy_id = Hold.objects.filter(pk=hold.pk).values_list('copy_id', flat=True).get()
+        if copy_id is not None and BookInstance.objects.filter(pk=copy_id, status='r').update(
+                status='a', updated_at=timezone.now(), version=F('version') + 1):
+            availability.copy_changed((hold.book_id, 'r'), (hold.book_id, 'a'))
+    hold.status = 'c'
+    if copy_id is not None:
+        bump_version(BookInstance)
+        allocate_copy(copy_id)
+    return True
+
+
+def queue_position(hold):
+    """1 for the first waiting hold on the book, None once the hold isn't waiting.
+    Counted on the index range before the hold, not the whole queue."""
+    if hold.status != 'w':
+        return None
+    ahead = waiting(hold.book_id).filter(
+        Q(placed_at__lt=hold.placed_at) | Q(placed_at=hold.placed_at, id__lt=hold.id))
+    return ahead.count() + 1
@@ -0,0 +1,225 @@
+"""Background jobs: a queue in the Job table, run by "manage.py run_workers".
+
+Views and admin actions call enqueue() and return straight away; a worker
+claims the oldest queued job that is due, runs its task (a function
+registered with @task, see catalog/tasks.py) and stores the result or the
+error. The job's status page (/catalog/jobs/<id>/) shows how it went.
+
+A job is claimed with one conditional UPDATE that only matches while it is
+still queued, so two workers never run the same job, the same way loans
+are changed in catalog/loans.py. The same UPDATE refuses the claim while
+``concurrency`` jobs of that task are already running, e.g. to never run
+two imports at once.
+
+A task that raises is retried up to ``max_attempts`` times, waiting
+JOB_RETRY_DELAY, then twice as long, and so on. While a job runs, its worker
+records a heartbeat every JOB_HEARTBEAT, however long the task takes. A
+running job without one for JOB_STALE_AFTER has lost its worker (the process
+was killed, the machine restarted): requeue_stale(), which run_workers calls
+every JOB_STALE_CHECK, queues it again if it has attempts left and fails it
+otherwise. Its outcome is only recorded by the worker that holds it, so if
+the first worker was merely stuck it can't overwrite the result of the one
+that took over.
+"""
+import contextlib
+import datetime
+import json
+import threading
+import time
+import traceback
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import OperationalError, close_old_connections, connection
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from catalog.models import Job
+
+JOB_RETRY_DELAY = datetime.timedelta(seconds=30)
+JOB_HEARTBEAT = datetime.timedelta(seconds=30)
+# Several missed heartbeats, so a busy database doesn't make a job look stale
+JOB_STALE_AFTER = datetime.timedelta(minutes=5)
+JOB_STALE_CHECK = datetime.timedelta(minutes=1)
+# Seconds between attempts to record a job's outcome while the database is locked
+JOB_SAVE_DELAYS = (0.1, 0.5, 2, 5, None)
+
+# Task name -> Task, filled by the @task decorator
+TASKS = {}
+
+
+class Task:
+    def __init__(self, function, name, max_attempts, concurrency):
+        self.function = function
+        self.name = name
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+
+    def __call__(self, **arguments):
+        return self.function(**arguments)
+
+
+def task(name=None, max_attempts=3, concurrency=None):
+    """Register a function as a task that jobs can run. It is called with the
+    job's keyword arguments, which (like its return value) must be JSON.
+    ``concurrency`` caps how many jobs of the task run at the same time."""
+    def decorator(function):
+        TASKS[name or function.__name__] = Task(function, name or function.__name__, max_attempts, concurrency)
+        return function
+    return decorator
+
+
+class UnknownTask(Exception):
+    pass
+
+
+def enqueue(task_name, user=None, **arguments):
+    """Queue a job running ``task_name`` with ``arguments``; returns the Job."""
+    if task_name not in TASKS:
+        raise UnknownTask(task_name)
+    return Job.objects.create(task=task_name, arguments=json.dumps(arguments, cls=DjangoJSONEncoder),
+                              max_attempts=TASKS[task_name].max_attempts, created_by=user)
+
+
+def claim(worker, tasks=None):
+    """Claim the oldest due job (of ``tasks``, default any registered task) for
+    ``worker`` and mark it running; returns it, or None if there is nothing to do."""
+    tasks = list(TASKS) if tasks is None else tasks
+    while True:
+        now = timezone.now()
+        candidates = Job.objects.filter(status='q', run_after__lte=now, task__in=tasks).order_by('run_after', 'id')
+        candidate = candidates.values('id', 'task').first()
+        if candidate is None:
+            return None
+        claimable = Job.objects.filter(pk=candidate['id'], status='q')
+        limit = TASKS[candidate['task']].concurrency
+        if limit:
+            # Jobs of the task running right now, counted in the same statement
+            running = (Job.objects.filter(task=OuterRef('task'), status='r').order_by()
+                       .values('task').annotate(count=Count('pk')).values('count'))
+            claimable = claimable.annotate(running=Coalesce(Subquery(running), 0)).filter(running__lt=limit)
+        if claimable.update(status='r', worker=worker, started_at=now, heartbeat_at=now,
+                            attempts=F('attempts') + 1):
+            return Job.objects.get(pk=candidate['id'])
+        if Job.objects.filter(pk=candidate['id'], status='q').exists():
+            # At its concurrency limit: look at the other tasks
+            tasks = [name for name in tasks if name != candidate['task']]
+        # Otherwise another worker was quicker, try the next one
+
+
+@contextlib.contextmanager
+def heartbeat(job):
+    """Record that the worker running ``job`` is alive every JOB_HEARTBEAT,
+    from a thread of its own, until the block ends."""
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(JOB_HEARTBEAT.total_seconds()):
+                try:
+                    Job.objects.filter(pk=job.pk, worker=job.worker, status='r').update(heartbeat_at=timezone.now())
+                except OperationalError:
+                    # E.g. the database was locked: the next beat will do
+                    pass
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f'heartbeat-{job.pk}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run(job):
+    """Run a claimed job and record how it went. Returns the job."""
+    task = TASKS.get(job.task)
+    try:
+        if task is None:
+            raise UnknownTask(job.task)
+        with heartbeat(job):
+            result = task(**json.loads(job.arguments))
+    except Exception:
+        job.error = traceback.format_exc()
+        if task is not None and job.attempts < job.max_attempts:
+            job.status = 'q'
+            job.run_after = timezone.now() + JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+        else:
+            job.status = 'f'
+            job.finished_at = timezone.now()
+    else:
+        job.status = 'd'
+        job.result = json.dumps(result, cls=DjangoJSONEncoder)
+        job.error = ''
+        job.finished_at = timezone.now()
+    finally:
+        # The task may have left a broken connection behind
+        close_old_connections()
+    # Losing the outcome would leave the job running until requeue_stale()
+    for delay in JOB_SAVE_DELAYS:
+        try:
+            # Only while this worker still holds the job: requeue_stale() may
+            # have given it to another one meanwhile
+            saved = Job.objects.filter(pk=job.pk, worker=job.worker, status='r').update(
+                status=job.status, run_after=job.run_after, result=job.result, error=job.error,
+                finished_at=job.finished_at)
+            break
+        except OperationalError:
+            if delay is None:
+                raise
+            time.sleep(delay)
+    if not saved:
+        job.refresh_from_db()
+    return job
+
+
+def run_next(worker, tasks=None):
+    """Claim and run one job; returns it, or None if there was nothing to do."""
+    job = claim(worker, tasks)
+    return job and run(job)
+
+
+def work(worker, stop=None, poll=1.0, tasks=None, drain=False):
+    """A worker's loop: run jobs one after the other until ``stop`` (an Event)
+    is set, or with ``drain`` until no job is due. Returns the number run."""
+    done = 0
+    while not (stop and stop.is_set()):
+        try:
+            job = run_next(worker, tasks)
+        except OperationalError:
+            # E.g. the database was locked for longer than its timeout: try again
+            job = None
+        else:
+            if job is not None:
+                done += 1
+                continue
+            if drain:
+                break
+        if stop:
+            stop.wait(poll)
+        else:
+            time.sleep(poll)
+    connection.close()
+    return done
+
+
+def requeue_stale(older_than=JOB_STALE_AFTER):
+    """Queue again the running jobs whose worker gave no heartbeat for ``older_than``,
+    so it stopped, if they have attempts left; fail the others.
+    Returns how many were requeued and how many failed."""
+    now = timezone.now()
+    cutoff = now - older_than
+    # Jobs claimed before heartbeats were recorded only have started_at
+    stale = Job.objects.filter(Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff),
+                               status='r')
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(
+        status='f', finished_at=now, error=f'No heartbeat for {older_than}: its worker stopped.')
+    requeued = stale.update(status='q', run_after=now, worker='')
+    return requeued, failed
+
+
+def retry(jobs):
+    """Queue failed ``jobs`` (a queryset) again with a fresh set of attempts."""
+    return jobs.filter(status='f').update(status='q', attempts=0, run_after=timezone.now(), finished_at=None)
@@ -0,0 +1,132 @@
+import collections
+import contextlib
+import datetime
+import threading
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import TruncMonth
+
+from catalog.models import BookMonthlyLoans, LoanEvent, PatronMonthlyActivity
+
+# Inside batch(), events are buffered per thread and written with one bulk
+# INSERT when this many are waiting and when the batch ends
+LEDGER_BATCH_SIZE = 500
+
+_buffer = threading.local()
+
+
+def _pending():
+    if not hasattr(_buffer, 'events'):
+        _buffer.events = []
+        _buffer.depth = 0
+    return _buffer.events
+
+
+@contextlib.contextmanager
+def batch():
+    """Buffer the events recorded inside the block and write them in batches,
+    e.g. for a bulk renewal or an import. Without it each event is written
+    as it is recorded, so none can be lost if the process stops."""
+    _pending()
+    _buffer.depth += 1
+    try:
+        yield
+    finally:
+        _buffer.depth -= 1
+        if not _buffer.depth:
+            flush()
+
+
+def record(kind, book_id, patron_id, due_back=None, date=None):
+    """Add a checkout, renewal or return (LoanEvent.CHECKOUT etc.) to the ledger.
+
+    Call it once the change has been made. Events without a book (a copy
+    whose book was deleted) are dropped."""
+    if book_id is None:
+        return
+    events = _pending()
+    events.append(LoanEvent(kind=kind, book_id=book_id, patron_id=patron_id, due_back=due_back,
+                            date=date or datetime.date.today()))
+    if not _buffer.depth or len(events) >= LEDGER_BATCH_SIZE:
+        flush()
+
+
+def flush():
+    """Write the buffered events, and add them to the monthly rollups, in one transaction."""
+    events = _pending()
+    if not events:
+        return 0
+    _buffer.events = []
+    with transaction.atomic():
+        LoanEvent.objects.bulk_create(events)
+        _add_to_rollups(events)
+    return len(events)
+
+
+def _month(date):
+    return date.replace(day=1)
+
+
+def _add_to_rollups(events):
+    loans = collections.Counter()
+    activity = collections.defaultdict(collections.Counter)
+    column = {LoanEvent.CHECKOUT: 'checkouts', LoanEvent.RENEWAL: 'renewals', LoanEvent.RETURN: 'returns'}
+    for event in events:
+        month = _month(event.date)
+        if event.kind == LoanEvent.CHECKOUT:
+            loans[event.book_id, month] += 1
+        if event.patron_id is not None:
+            activity[event.patron_id, month][column[event.kind]] += 1
+
+    for (book_id, month), count in loans.items():
+        _increment(BookMonthlyLoans, {'book_id': book_id, 'month': month}, {'loans': count})
+    for (patron_id, month), counts in activity.items():
+        _increment(PatronMonthlyActivity, {'patron_id': patron_id, 'month': month}, counts)
+
+
+def _increment(model, key, counts):
+    """Add ``counts`` to the rollup row for ``key``, creating it if needed."""
+    changes = {name: F(name) + count for name, count in counts.items()}
+    if model.objects.filter(**key).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**key, **counts)
+    except IntegrityError:
+        # Created by a concurrent flush in the meantime
+        model.objects.filter(**key).update(**changes)
+
+
+def rebuild_rollups():
+    """Recompute both rollups from the whole ledger, e.g. after importing history.
+    Returns the number of book and patron rows written.
+
+    The ledger is grouped by the database; only the grouped rows come back."""
+    with transaction.atomic():
+        BookMonthlyLoans.objects.all().delete()
+        PatronMonthlyActivity.objects.all().delete()
+        monthly = LoanEvent.objects.annotate(month=TruncMonth('date')).order_by()
+        books = BookMonthlyLoans.objects.bulk_create(
+            BookMonthlyLoans(book_id=row['book_id'], month=row['month'], loans=row['loans'])
+            for row in monthly.filter(kind=LoanEvent.CHECKOUT).values('book_id', 'month').annotate(
+                loans=Count('id')).iterator())
+        patrons = PatronMonthlyActivity.objects.bulk_create(
+            PatronMonthlyActivity(patron_id=row['patron_id'], month=row['month'], checkouts=row['checkouts'],
+                                  renewals=row['renewals'], returns=row['returns'])
+            for row in monthly.filter(patron__isnull=False).values('patron_id', 'month').annotate(
+                checkouts=Count('id', filter=Q(kind=LoanEvent.CHECKOUT)),
+                renewals=Count('id', filter=Q(kind=LoanEvent.RENEWAL)),
+                returns=Count('id', filter=Q(kind=LoanEvent.RETURN))).iterator())
+    return len(books), len(patrons)
+
+
+def popular_books(month, limit=10):
+    """The most checked out books in the month containing ``month``, read from the rollup."""
+    return (BookMonthlyLoans.objects.filter(month=_month(month)).select_related('book')
+            .order_by('-loans', 'book_id')[:limit])
+
+
+def patron_activity(patron_id, months=12):
+    """A patron's monthly activity, newest month first, read from the rollup."""
+    return PatronMonthlyActivity.objects.filter(patron_id=patron_id).order_by('-month')[:months]
@@ -0,0 +1,93 @@
+import datetime
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from catalog import availability, holds, ledger
+from catalog.cache import bump_version
+from catalog.models import BookInstance, Hold, LoanEvent
+
+# Loan period when a due date isn't given
+LOAN_PERIOD = datetime.timedelta(weeks=3)
+
+
+class LoanError(Exception):
+    """The copy can't be checked out, returned or renewed (wrong status, or it
+    changed since the librarian looked at it)."""
+
+
+def _current(copy_id):
+    state = BookInstance.objects.filter(pk=copy_id).values('book_id', 'status', 'version', 'borrower_id').first()
+    if state is None:
+        raise LoanError('No such copy.')
+    return state
+
+
+def _transition(copy_id, state, expected_version, **changes):
+    """Apply ``changes`` to the copy with one conditional UPDATE that only
+    matches while it still has the status and version read in ``state``.
+
+    This is the whole concurrency control: two librarians acting on the same
+    copy both issue the UPDATE, the database serializes them on the row, and
+    the second one matches nothing because the first bumped the version. No
+    table or row locks are held between reading the copy and writing it."""
+    if expected_version is not None and expected_version != state['version']:
+        raise LoanError('The copy was changed by someone else, reload the page and try again.')
+    changed = BookInstance.objects.filter(pk=copy_id, status=state['status'], version=state['version']).update(
+        updated_at=timezone.now(), version=F('version') + 1, **changes)
+    if not changed:
+        raise LoanError('The copy was changed by someone else, reload the page and try again.')
+    return state['version'] + 1
+
+
+def checkout(copy_id, borrower, due_back=None, expected_version=None):
+    """Lend a copy to ``borrower``. Returns the copy's new version.
+
+    The copy must be Available, or Reserved for a hold of ``borrower`` (which
+    is then fulfilled). Pass the version the librarian saw as
+    ``expected_version`` to refuse the checkout if the copy changed since."""
+    state = _current(copy_id)
+    with transaction.atomic():
+        if state['status'] == 'r':
+            if not Hold.objects.filter(copy_id=copy_id, status='r', patron=borrower).update(status='f'):
+                raise LoanError('The copy is set aside for another patron.')
+        elif state['status'] != 'a':
+            raise LoanError('The copy is not available.')
+        due_back = due_back or datetime.date.today() + LOAN_PERIOD
+        version = _transition(copy_id, state, expected_version, status='o', borrower=borrower, due_back=due_back)
+        # update() skips the signal handlers that keep these in step
+        availability.copy_changed((state['book_id'], state['status']), (state['book_id'], 'o'))
+        # The ledger row commits (or not) with the loan itself
+        ledger.record(LoanEvent.CHECKOUT, state['book_id'], borrower.pk, due_back)
+    bump_version(BookInstance)
+    return version
+
+
+def return_copy(copy_id, expected_version=None):
+    """Take a copy back. It goes to the next patron waiting for the book, or
+    back on the shelf. Returns the copy's new version."""
+    state = _current(copy_id)
+    if state['status'] != 'o':
+        raise LoanError('The copy is not on loan.')
+    with transaction.atomic():
+        version = _transition(copy_id, state, expected_version, status='a', borrower=None, due_back=None)
+        availability.copy_changed((state['book_id'], 'o'), (state['book_id'], 'a'))
+        # In the same transaction, so the copy is never seen on the shelf while a patron is waiting
+        if holds.allocate_copy(copy_id) is not None:
+            version += 1
+        ledger.record(LoanEvent.RETURN, state['book_id'], state['borrower_id'])
+    bump_version(BookInstance)
+    return version
+
+
+def renew(copy_id, due_back, expected_version=None):
+    """Move the due date of a copy on loan. Returns the copy's new version."""
+    state = _current(copy_id)
+    if state['status'] != 'o':
+        raise LoanError('The copy is not on loan.')
+    with transaction.atomic():
+        version = _transition(copy_id, state, expected_version, due_back=due_back)
+        ledger.record(LoanEvent.RENEWAL, state['book_id'], state['borrower_id'], due_back)
+    bump_version(BookInstance)
+    return version
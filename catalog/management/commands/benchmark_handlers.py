@@ -0,0 +1,167 @@
+import asyncio
+import collections
+import json
+import os
+import statistics
+import tempfile
+import time
+import wsgiref.util
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from catalog.cache import isolated_caches, page_cache
+from catalog.models import Author, Book
+from catalog.synthetic import generate_catalog
+from locallibrary.asgi import ThreadPoolASGIHandler
+
+HOST = 'localhost'
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway test database with a synthetic catalog and load-test the '
+            'read-heavy catalog pages through the WSGI and ASGI handlers with many '
+            'concurrent clients, reporting requests per second and latency percentiles.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--copies', type=int, default=20000,
+                            help='Number of BookInstance rows to seed (default 20,000).')
+        parser.add_argument('--clients', type=int, default=200,
+                            help='Concurrent clients (default 200).')
+        parser.add_argument('--requests', type=int, default=10,
+                            help='Requests made by each client, one after the other (default 10).')
+        parser.add_argument('--threads', type=int, default=32,
+                            help='Worker threads of the WSGI server and the ASGI handler (default 32).')
+        parser.add_argument('--json', dest='json_path',
+                            help='Also write the results to this file as JSON.')
+
+    def handle(self, *args, **options):
+        # A throwaway database file rather than SQLite's shared in-memory one,
+        # so concurrent connections behave as they do in production
+        fd, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = path
+        old_name = connection.settings_dict['NAME']
+        # Caches of its own too, so the server's cached pages are left alone
+        with tempfile.TemporaryDirectory() as cache_dir, override_settings(CACHES=isolated_caches(cache_dir)):
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                results = self.run(options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def run(self, options):
+        start = time.perf_counter()
+        counts = generate_catalog(options['copies'])
+        self.stdout.write(f'Seeded {counts} in {time.perf_counter() - start:.1f}s')
+        # The page handlers open their own connections, one per thread
+        connection.close()
+
+        urls = self.urls()
+        ThreadPoolASGIHandler.executor = ThreadPoolExecutor(options['threads'], thread_name_prefix='asgi')
+        runs = {
+            'wsgi': self.wsgi_caller(WSGIHandler(), options['threads']),
+            'asgi': self.asgi_caller(ThreadPoolASGIHandler()),
+            # Django's own handler, for comparison: every view on one thread
+            'asgi_stock': self.asgi_caller(ASGIHandler()),
+        }
+        results = {'rows': counts, 'clients': options['clients'], 'requests_per_client': options['requests'],
+                   'threads': options['threads'], 'handlers': {}}
+        for name, call in runs.items():
+            # Every handler starts with the same cold page cache
+            page_cache().clear()
+            results['handlers'][name] = result = asyncio.run(
+                self.load(call, urls, options['clients'], options['requests']))
+            self.report(name, result)
+        return results
+
+    def urls(self):
+        books = list(Book.objects.order_by('pk').values_list('pk', flat=True)[:50])
+        authors = list(Author.objects.order_by('pk').values_list('pk', flat=True)[:20])
+        urls = [reverse('index'), reverse('books'), reverse('authors')]
+        urls += [reverse('book-detail', args=[pk]) for pk in books]
+        urls += [reverse('author-detail', args=[pk]) for pk in authors]
+        return urls
+
+    @staticmethod
+    def wsgi_caller(handler, threads):
+        """Call the WSGI handler on a fixed pool of threads, like a threaded WSGI server."""
+        pool = ThreadPoolExecutor(threads, thread_name_prefix='wsgi')
+
+        def request(url):
+            environ = {'PATH_INFO': url, 'REQUEST_METHOD': 'GET', 'HTTP_HOST': HOST}
+            wsgiref.util.setup_testing_defaults(environ)
+            status = []
+            body = handler(environ, lambda s, headers, exc_info=None: status.append(int(s.split()[0])))
+            try:
+                for _ in body:
+                    pass
+            finally:
+                body.close()
+            return status[0]
+
+        async def call(url):
+            return await asyncio.get_running_loop().run_in_executor(pool, request, url)
+        return call
+
+    @staticmethod
+    def asgi_caller(handler):
+        """Call the ASGI application directly on the event loop, as an ASGI server would."""
+        async def call(url):
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                'method': 'GET', 'scheme': 'http', 'path': url, 'raw_path': url.encode(),
+                'root_path': '', 'query_string': b'', 'headers': [(b'host', HOST.encode())],
+                'client': ('127.0.0.1', 50000), 'server': (HOST, 80),
+            }
+            status = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+
+            await handler(scope, receive, send)
+            return status[0]
+        return call
+
+    async def load(self, call, urls, clients, per_client):
+        latencies = []
+        statuses = collections.Counter()
+
+        async def client(number):
+            for i in range(per_client):
+                url = urls[(number * per_client + i) % len(urls)]
+                start = time.perf_counter()
+                statuses[await call(url)] += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(number) for number in range(clients)))
+        elapsed = time.perf_counter() - start
+        quantiles = statistics.quantiles(latencies, n=100)
+        return {
+            'requests': len(latencies),
+            'seconds': round(elapsed, 3),
+            'requests_per_second': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(quantiles[49], 2),
+            'p99_ms': round(quantiles[98], 2),
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        }
+
+    def report(self, name, result):
+        self.stdout.write(self.style.MIGRATE_HEADING(name))
+        self.stdout.write(f'  {result["requests_per_second"]:.0f} requests/s, '
+                          f'p50 {result["p50_ms"]:.1f} ms, p99 {result["p99_ms"]:.1f} ms, '
+                          f'statuses {result["statuses"]}')
@@ -0,0 +1,107 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from catalog.models import Author, BookInstance
+from catalog.synthetic import generate_catalog
+from catalog.views import LOANED_BOOK_FIELDS
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway test database with a synthetic catalog and compare the '
+            'query plans and latency of the loan and author queries with and without '
+            'the BookInstance/Author indexes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--copies', type=int, default=1000000,
+                            help='Number of BookInstance rows to seed (default 1,000,000).')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Timed runs per query; the median is reported.')
+        parser.add_argument('--json', dest='json_path',
+                            help='Also write the results to this file as JSON.')
+
+    def handle(self, *args, **options):
+        # Run against a separate test database so the real one is never touched
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def run(self, options):
+        start = time.perf_counter()
+        counts = generate_catalog(options['copies'])
+        self.stdout.write(f'Seeded {counts} in {time.perf_counter() - start:.1f}s')
+        self.analyze()
+
+        # Pick a borrower with loans so the per-user query has rows to return
+        borrower_id = (BookInstance.objects.filter(status__exact='o').values_list('borrower', flat=True)
+                       .order_by('borrower')[:1].get())
+        cases = self.cases(borrower_id)
+
+        results = {'rows': counts, 'queries': {}}
+        indexed = {name: self.measure(queryset, evaluate, options['repeat'])
+                   for name, (queryset, evaluate) in cases.items()}
+        self.drop_indexes()
+        for name, (queryset, evaluate) in cases.items():
+            plain = self.measure(queryset, evaluate, options['repeat'])
+            results['queries'][name] = {'indexed': indexed[name], 'unindexed': plain}
+            self.report(name, indexed[name], plain)
+        return results
+
+    def cases(self, borrower_id):
+        """Queries issued by the views the indexes are meant for."""
+        on_loan = BookInstance.objects.filter(status__exact='o')
+        return {
+            # AllLoanedBooksListView: COUNT for the paginator, then the first page
+            'all_borrowed_count': (on_loan, lambda qs: qs.count()),
+            'all_borrowed_page': (
+                on_loan.select_related('book', 'borrower')
+                .only(*LOANED_BOOK_FIELDS, 'borrower', 'borrower__username').order_by('due_back')[:10],
+                list),
+            # LoanedBooksByUserListView
+            'borrowed_by_user_page': (
+                on_loan.filter(borrower_id=borrower_id).select_related('book')
+                .only(*LOANED_BOOK_FIELDS).order_by('due_back')[:10],
+                list),
+            # index: copies available
+            'available_count': (BookInstance.objects.filter(status__exact='a'), lambda qs: qs.count()),
+            # AuthorListView: first page in Meta ordering
+            'author_page': (Author.objects.only('first_name', 'last_name')[:4], list),
+        }
+
+    def measure(self, queryset, evaluate, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            evaluate(queryset.all())
+            timings.append((time.perf_counter() - start) * 1000)
+        return {'median_ms': round(statistics.median(timings), 3), 'plan': queryset.explain()}
+
+    def drop_indexes(self):
+        with connection.schema_editor() as editor:
+            for model in (BookInstance, Author):
+                for index in model._meta.indexes:
+                    editor.remove_index(model, index)
+        self.analyze()
+
+    def analyze(self):
+        # Refresh the planner statistics after bulk loads and schema changes
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def report(self, name, indexed, plain):
+        speedup = plain['median_ms'] / indexed['median_ms'] if indexed['median_ms'] else float('inf')
+        self.stdout.write(self.style.MIGRATE_HEADING(name))
+        self.stdout.write(f'  without indexes: {plain["median_ms"]:.3f} ms')
+        self.stdout.write(f'    {plain["plan"]}')
+        self.stdout.write(f'  with indexes:    {indexed["median_ms"]:.3f} ms ({speedup:.1f}x)')
+        self.stdout.write(f'    {indexed["plan"]}')
@@ -0,0 +1,164 @@
+import datetime
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections, connection, connections
+from django.test.utils import override_settings
+
+from catalog.models import Book, BookInstance, CopyChanged
+from catalog.synthetic import generate_catalog
+
+# Database settings compared by the benchmark: Django's defaults, closing the
+# connection after every request, and the production profile from settings.py
+PROFILES = {
+    'default': {'CONN_MAX_AGE': 0, 'OPTIONS': {}, 'pragmas': {'journal_mode': 'DELETE'}},
+    'production': {'CONN_MAX_AGE': 600, 'OPTIONS': {'timeout': 20}, 'pragmas': settings.SQLITE_PRODUCTION_PRAGMAS},
+}
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway SQLite database file with a synthetic catalog and compare the '
+            'throughput of mixed read/write traffic from concurrent threads under the '
+            'default database settings and the production profile (WAL, pragmas, '
+            'persistent connections).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--copies', type=int, default=100000,
+                            help='Number of BookInstance rows to seed (default 100,000).')
+        parser.add_argument('--threads', type=int, default=16,
+                            help='Concurrent workers, each acting like a request thread (default 16).')
+        parser.add_argument('--seconds', type=float, default=10,
+                            help='How long to run each profile (default 10).')
+        parser.add_argument('--write-ratio', type=float, default=0.2,
+                            help='Share of operations that write (default 0.2).')
+        parser.add_argument('--json', dest='json_path',
+                            help='Also write the results to this file as JSON.')
+
+    def handle(self, *args, **options):
+        # A real file: WAL and locking don't apply to in-memory databases
+        fd, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = path
+        old_name = connection.settings_dict['NAME']
+        old_settings = {key: connection.settings_dict.get(key) for key in ('CONN_MAX_AGE', 'OPTIONS')}
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = self.run(options)
+        finally:
+            connection.settings_dict.update(old_settings)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def run(self, options):
+        start = time.perf_counter()
+        counts = generate_catalog(options['copies'])
+        self.stdout.write(f'Seeded {counts} in {time.perf_counter() - start:.1f}s')
+        book_ids = list(Book.objects.values_list('pk', flat=True))
+        copy_ids = list(BookInstance.objects.values_list('pk', flat=True))
+
+        results = {'rows': counts, 'threads': options['threads'], 'seconds': options['seconds'],
+                   'write_ratio': options['write_ratio'], 'profiles': {}}
+        for name, profile in PROFILES.items():
+            # Worker threads build their connections from this (shared) settings dict
+            connections.close_all()
+            connection.settings_dict['CONN_MAX_AGE'] = profile['CONN_MAX_AGE']
+            connection.settings_dict['OPTIONS'] = profile['OPTIONS']
+            with override_settings(SQLITE_PRAGMAS=profile['pragmas']):
+                # Opening a connection switches the journal mode, which sticks to the file
+                connection.ensure_connection()
+                connection.close()
+                results['profiles'][name] = result = self.load(book_ids, copy_ids, options)
+            self.report(name, result)
+        return results
+
+    def load(self, book_ids, copy_ids, options):
+        deadline = time.perf_counter() + options['seconds']
+        lock = threading.Lock()
+        latencies = {'read': [], 'write': []}
+        errors = []
+
+        def worker(seed):
+            rng = random.Random(seed)
+            mine = {'read': [], 'write': []}
+            failed = []
+            while time.perf_counter() < deadline:
+                kind = 'write' if rng.random() < options['write_ratio'] else 'read'
+                start = time.perf_counter()
+                try:
+                    if kind == 'read':
+                        self.read(rng.choice(book_ids))
+                    else:
+                        self.write(rng, rng.choice(copy_ids))
+                except OperationalError as e:
+                    failed.append(str(e))
+                else:
+                    mine[kind].append((time.perf_counter() - start) * 1000)
+                finally:
+                    # What happens at the end of every request
+                    close_old_connections()
+            connection.close()
+            with lock:
+                for key in mine:
+                    latencies[key].extend(mine[key])
+                errors.extend(failed)
+
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(options['threads'])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        result = {'ops_per_second': round((len(latencies['read']) + len(latencies['write'])) / elapsed, 1),
+                  'errors': len(errors), 'error_messages': sorted(set(errors))}
+        for kind, timings in latencies.items():
+            quantiles = statistics.quantiles(timings, n=100) if len(timings) > 1 else [0.0] * 99
+            result[kind] = {'count': len(timings), 'per_second': round(len(timings) / elapsed, 1),
+                            'p50_ms': round(quantiles[49], 2), 'p99_ms': round(quantiles[98], 2)}
+        return result
+
+    @staticmethod
+    def read(book_id):
+        """What the book detail page reads."""
+        book = Book.objects.select_related('author', 'language').get(pk=book_id)
+        list(book.genre.all())
+        list(BookInstance.objects.filter(book=book).only('id', 'imprint', 'status', 'due_back')
+             .order_by('due_back', 'id')[:20])
+
+    @staticmethod
+    def write(rng, copy_id):
+        """A renewal or a copy changing status (which also updates the book's counters)."""
+        if rng.random() < 0.5:
+            BookInstance.objects.filter(pk=copy_id).renew(datetime.date.today() + datetime.timedelta(weeks=3))
+        else:
+            copy = BookInstance.objects.get(pk=copy_id)
+            copy.status = 'm' if copy.status != 'm' else 'a'
+            try:
+                copy.save()
+            except CopyChanged:
+                # Another writer changed it in between, as a librarian would be told
+                pass
+
+    def report(self, name, result):
+        self.stdout.write(self.style.MIGRATE_HEADING(name))
+        self.stdout.write(f'  {result["ops_per_second"]:.0f} operations/s, {result["errors"]} errors')
+        for kind in ('read', 'write'):
+            stats = result[kind]
+            self.stdout.write(f'  {kind}s: {stats["per_second"]:.0f}/s, p50 {stats["p50_ms"]:.2f} ms, '
+                              f'p99 {stats["p99_ms"]:.2f} ms')
+        for message in result['error_messages']:
+            self.stdout.write(f'  error: {message}')
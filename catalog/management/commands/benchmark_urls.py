@@ -0,0 +1,84 @@
+import datetime
+import json
+import platform
+import tempfile
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from catalog import benchmarks
+from catalog.cache import isolated_caches
+from catalog.synthetic import generate_catalog
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway test database with a synthetic catalog and benchmark every '
+            'page in catalog.urls on query count, latency and memory. With --baseline, '
+            'fail if any page got worse than in that earlier run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=10000,
+                            help='Number of Book rows to seed (default 10,000; up to 1,000,000).')
+        parser.add_argument('--copies-per-book', type=int, default=3,
+                            help='BookInstance rows per book (default 3).')
+        parser.add_argument('--runs', type=int, default=10,
+                            help='Timed requests per page; the median is compared (default 10).')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed of the synthetic catalog, the same seed gives the same data.')
+        parser.add_argument('--json', dest='json_path',
+                            help='Write the results to this file as JSON.')
+        parser.add_argument('--baseline',
+                            help='JSON results of an earlier run to compare with.')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed latency and memory increase over the baseline (default 0.25 = 25%%).')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        # Run against a separate test database so the real one is never touched,
+        # and with caches of its own so the server's cached pages are neither
+        # cleared nor mixed with pages of the synthetic catalog
+        old_name = connection.settings_dict['NAME']
+        with tempfile.TemporaryDirectory() as cache_dir, override_settings(CACHES=isolated_caches(cache_dir)):
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                results = self.run(options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if baseline is not None:
+            if baseline['rows'] != results['rows']:
+                raise CommandError(f'The baseline was measured on a different catalog: {baseline["rows"]}')
+            regressions = benchmarks.compare(results['urls'], baseline['urls'], options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions:\n  ' + '\n  '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions'))
+
+    def run(self, options):
+        start = time.perf_counter()
+        counts = generate_catalog(options['books'] * options['copies_per_book'], num_books=options['books'],
+                                  seed=options['seed'])
+        self.stdout.write(f'Seeded {counts} in {time.perf_counter() - start:.1f}s')
+        self.stdout.write(f'{"page":24} {"status":>6} {"queries":>8} {"repeats":>8} {"median ms":>10} {"min ms":>8} {"peak KiB":>9}')
+        return {
+            'rows': counts,
+            'runs': options['runs'],
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'urls': benchmarks.run(options['runs'], progress=self.report),
+        }
+
+    def report(self, name, result):
+        self.stdout.write(f'{name:24} {result["status"]:>6} {result["queries"]:>8} {result["duplicate_queries"]:>8} {result["median_ms"]:>10.1f} '
+                          f'{result["min_ms"]:>8.1f} {result["peak_kb"]:>9.0f}')
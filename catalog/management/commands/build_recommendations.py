@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog import recommendations
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the "readers also borrowed" recommendations (RelatedBook) from the '
+            'checkouts in the loan ledger. Meant to run nightly; the book pages only read '
+            'the stored results.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=recommendations.RECOMMENDATIONS_TOP_K,
+                            help=f'Related books kept per book (default {recommendations.RECOMMENDATIONS_TOP_K}).')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        written = recommendations.rebuild_recommendations(options['top_k'])
+        engine = 'NumPy/SciPy' if recommendations.numpy is not None else 'Python'
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {written} recommendations in {time.perf_counter() - start:.1f}s ({engine})'))
@@ -0,0 +1,220 @@
+import csv
+import datetime
+import gzip
+import io
+import itertools
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from catalog import search
+from catalog.availability import rebuild_availability
+from catalog.cache import bump_version
+from catalog.models import Author, Book, BookInstance, Genre, Language
+
+# Columns (CSV header or JSONL keys). Only title and isbn are required.
+#   title, isbn, summary, author_first_name, author_last_name, language,
+#   genres       several genre names separated by ";" (or a list in JSONL)
+#   copies       number of copies of this book to create (default 1, may be 0)
+#   imprint, status, due_back   applied to each of those copies
+# Rows with an ISBN that is already in the catalog (or earlier in the file)
+# only add copies to that book.
+STATUSES = {status for status, _ in BookInstance.LOAN_STATUS}
+
+
+class Command(BaseCommand):
+    help = 'Bulk import books, authors, genres, languages and copies from a CSV or JSONL file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSONL file to import, optionally gzip-compressed (.gz).')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='File format (default: guessed from the file extension).')
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help='Rows written per transaction (default 5000).')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or self.guess_format(path)
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1.')
+        self.authors = {}
+        self.genres = {}
+        self.languages = {}
+
+        start = time.perf_counter()
+        rows = copies = 0
+        with self.open(path) as f:
+            reader = self.read_csv(f) if file_format == 'csv' else self.read_jsonl(f)
+            while True:
+                chunk = list(itertools.islice(reader, options['chunk_size']))
+                if not chunk:
+                    break
+                copies += self.import_chunk(chunk)
+                rows += len(chunk)
+                elapsed = time.perf_counter() - start
+                self.stdout.write(f'{rows} rows, {copies} copies ({rows / elapsed:.0f} rows/s)')
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {rows} rows and {copies} copies in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)'))
+
+    @staticmethod
+    def guess_format(path):
+        name = path[:-3] if path.endswith('.gz') else path
+        if name.endswith('.csv'):
+            return 'csv'
+        if name.endswith(('.jsonl', '.ndjson')):
+            return 'jsonl'
+        raise CommandError(f'Cannot tell the format of {path}; pass --format.')
+
+    @staticmethod
+    def open(path):
+        try:
+            if path.endswith('.gz'):
+                return io.TextIOWrapper(gzip.open(path), encoding='utf-8', newline='')
+            return open(path, encoding='utf-8', newline='')
+        except OSError as e:
+            raise CommandError(e)
+
+    @staticmethod
+    def read_csv(f):
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            yield line, row
+
+    @staticmethod
+    def read_jsonl(f):
+        for line, text in enumerate(f, start=1):
+            if text.strip():
+                try:
+                    row = json.loads(text)
+                except ValueError as e:
+                    raise CommandError(f'Line {line}: {e}')
+                if not isinstance(row, dict):
+                    raise CommandError(f'Line {line}: expected a JSON object.')
+                yield line, row
+
+    def import_chunk(self, chunk):
+        """Write one chunk of rows in a single transaction; returns the number of copies created."""
+        parsed = [self.parse(line, row) for line, row in chunk]
+        with transaction.atomic():
+            # ISBN -> id of the book it maps to, looked up for this chunk only
+            # (books of earlier chunks are in the database by now)
+            books = self.book_ids({row['isbn'] for row in parsed})
+            new_books = {}
+            for row in parsed:
+                if row['isbn'] not in books and row['isbn'] not in new_books:
+                    new_books[row['isbn']] = row
+            new_ids = self.create_books(new_books)
+            books.update(new_ids)
+
+            copies = [
+                BookInstance(book_id=books[row['isbn']], imprint=row['imprint'],
+                             status=row['status'], due_back=row['due_back'])
+                for row in parsed
+                for _ in range(row['copies'])
+            ]
+            BookInstance.objects.bulk_create(copies)
+
+            # bulk_create skips the signal handlers, so update what they maintain
+            touched = list(set(books.values()))
+            for start in range(0, len(touched), search.ID_CHUNK_SIZE):
+                rebuild_availability(Book.objects.filter(pk__in=touched[start:start + search.ID_CHUNK_SIZE]))
+            search.reindex_books(list(new_ids.values()))
+        # Nor do the cached pages and home page counters built from these rows
+        # know about them: make them stale now that the chunk is committed
+        for model in (Book, BookInstance, Author):
+            bump_version(model)
+        return len(copies)
+
+    def parse(self, line, row):
+        def text(name):
+            return str(row.get(name) or '').strip()
+
+        title, isbn = text('title'), text('isbn')
+        if not title or not isbn:
+            raise CommandError(f'Line {line}: title and isbn are required.')
+        genres = row.get('genres') or []
+        if isinstance(genres, str):
+            genres = genres.split(';')
+        status = text('status') or 'a'
+        if status not in STATUSES:
+            raise CommandError(f'Line {line}: unknown status {status!r}.')
+        try:
+            copies = 1 if row.get('copies') in (None, '') else int(row['copies'])
+            due_back = datetime.date.fromisoformat(text('due_back')) if text('due_back') else None
+        except ValueError as e:
+            raise CommandError(f'Line {line}: {e}')
+        if copies < 0:
+            raise CommandError(f'Line {line}: copies must not be negative.')
+        return {
+            'title': title,
+            'isbn': isbn,
+            'summary': text('summary'),
+            'author': (text('author_first_name'), text('author_last_name')),
+            'language': text('language'),
+            'genres': [name.strip() for name in genres if name.strip()],
+            'copies': copies,
+            'imprint': text('imprint'),
+            'status': status,
+            'due_back': due_back,
+        }
+
+    @staticmethod
+    def book_ids(isbns):
+        """{isbn: book id} for the ``isbns`` already in the catalog (the newest book of an ISBN)."""
+        isbns = list(isbns)
+        ids = {}
+        for start in range(0, len(isbns), search.ID_CHUNK_SIZE):
+            chunk = isbns[start:start + search.ID_CHUNK_SIZE]
+            ids.update(Book.objects.filter(isbn__in=chunk).order_by('id').values_list('isbn', 'id'))
+        return ids
+
+    def create_books(self, new_books):
+        """bulk_create the books first seen in this chunk, with their genres; returns {isbn: id}."""
+        if not new_books:
+            return {}
+        Book.objects.bulk_create([
+            Book(title=row['title'], isbn=isbn, summary=row['summary'],
+                 author_id=self.author_id(*row['author']), language_id=self.language_id(row['language']))
+            for isbn, row in new_books.items()
+        ])
+        # bulk_create doesn't return primary keys on SQLite, read them back
+        # (the newest book with each ISBN is the one just created)
+        ids = self.book_ids(new_books)
+
+        through = Book.genre.through
+        through.objects.bulk_create([
+            through(book_id=ids[isbn], genre_id=self.genre_id(name))
+            for isbn, row in new_books.items()
+            for name in set(row['genres'])
+        ])
+        return ids
+
+    def author_id(self, first_name, last_name):
+        if not first_name and not last_name:
+            return None
+        key = (first_name, last_name)
+        if key not in self.authors:
+            author = Author.objects.filter(first_name=first_name, last_name=last_name).first()
+            self.authors[key] = (author or Author.objects.create(first_name=first_name, last_name=last_name)).id
+        return self.authors[key]
+
+    def genre_id(self, name):
+        if name not in self.genres:
+            self.genres[name] = self.get_or_create_named(Genre, name)
+        return self.genres[name]
+
+    def language_id(self, name):
+        if not name:
+            return None
+        if name not in self.languages:
+            self.languages[name] = self.get_or_create_named(Language, name)
+        return self.languages[name]
+
+    @staticmethod
+    def get_or_create_named(model, name):
+        # Names aren't unique in the schema, so reuse the first match if there are several
+        existing = model.objects.filter(name=name).order_by('id').first()
+        return (existing or model.objects.create(name=name)).id
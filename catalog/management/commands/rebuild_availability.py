@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog.availability import rebuild_availability
+from catalog.models import Book
+
+
+class Command(BaseCommand):
+    help = ('Recount the per-book copy counters (Book.copies_*) from the BookInstance table, '
+            'e.g. after a bulk load or QuerySet.update() that skipped model signals.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('book_ids', nargs='*', type=int,
+                            help='Only recount these books (default: every book).')
+
+    def handle(self, *args, **options):
+        books = Book.objects.filter(pk__in=options['book_ids']) if options['book_ids'] else None
+        start = time.perf_counter()
+        updated = rebuild_availability(books)
+        self.stdout.write(self.style.SUCCESS(
+            f'Recounted copies of {updated} books in {time.perf_counter() - start:.1f}s'))
@@ -0,0 +1,16 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog.ledger import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = ('Recompute the monthly loan rollups (popular books, patron activity) from the '
+            'loan ledger, e.g. after importing historical loans into catalog_loanevent.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        books, patrons = rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {books} book and {patrons} patron monthly rows in {time.perf_counter() - start:.1f}s'))
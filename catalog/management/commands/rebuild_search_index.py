@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog.search import rebuild_search_index, search_enabled
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text book search table, e.g. after a bulk load that skipped model signals.'
+
+    def handle(self, *args, **options):
+        if not search_enabled():
+            self.stdout.write('Full-text search is only available on SQLite; nothing to rebuild.')
+            return
+        start = time.perf_counter()
+        rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the search index in {time.perf_counter() - start:.1f}s'))
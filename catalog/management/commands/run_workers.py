@@ -0,0 +1,87 @@
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+
+from catalog import jobs
+
+
+def process_worker(*args):
+    """A worker process. Ctrl-C reaches every process of the group: the children
+    ignore it and finish their running job once the parent sets ``stop``."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    return jobs.work(*args)
+
+
+class Command(BaseCommand):
+    help = ('Run queued background jobs (catalog.models.Job) on a pool of worker threads '
+            'or processes until interrupted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Jobs run at the same time (default 4).')
+        parser.add_argument('--processes', action='store_true',
+                            help='Run each worker in its own process rather than a thread, for CPU-bound tasks.')
+        parser.add_argument('--task', action='append', dest='tasks', choices=sorted(jobs.TASKS),
+                            help='Only run jobs of this task; repeat for several (default: all).')
+        parser.add_argument('--poll', type=float, default=1.0,
+                            help='Seconds to wait before looking again when no job is due (default 1).')
+        parser.add_argument('--drain', action='store_true',
+                            help='Stop once no job is due instead of waiting for more, e.g. from cron.')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+        self.requeue_stale()
+
+        prefix = f'{socket.gethostname()}:{os.getpid()}'
+        work_args = (options['poll'], options['tasks'], options['drain'])
+        if options['processes']:
+            # Forked children must not inherit open database connections
+            connections.close_all()
+            context = multiprocessing.get_context('fork')
+            stop = context.Event()
+            workers = [context.Process(target=process_worker, args=(f'{prefix}:{i}', stop, *work_args))
+                       for i in range(options['workers'])]
+        else:
+            stop = threading.Event()
+            workers = [threading.Thread(target=jobs.work, args=(f'{prefix}:{i}', stop, *work_args))
+                       for i in range(options['workers'])]
+
+        self.stdout.write(f'Running {len(workers)} workers ({"processes" if options["processes"] else "threads"})')
+        for worker in workers:
+            worker.start()
+        try:
+            self.supervise(workers)
+        except KeyboardInterrupt:
+            # Let the running jobs finish
+            self.stdout.write('Stopping after the running jobs')
+            stop.set()
+            for worker in workers:
+                worker.join()
+        self.stdout.write(self.style.SUCCESS('Workers stopped'))
+
+    def supervise(self, workers):
+        """Wait for the workers to stop, meanwhile looking every JOB_STALE_CHECK
+        for jobs whose worker stopped (in this pool or any other) to run them again."""
+        while True:
+            deadline = time.monotonic() + jobs.JOB_STALE_CHECK.total_seconds()
+            for worker in workers:
+                worker.join(max(0, deadline - time.monotonic()))
+            if not any(worker.is_alive() for worker in workers):
+                return
+            self.requeue_stale()
+
+    def requeue_stale(self):
+        try:
+            requeued, failed = jobs.requeue_stale()
+        except OperationalError:
+            # E.g. the database was locked: look again next time
+            return
+        if requeued or failed:
+            self.stdout.write(f'Requeued {requeued} and failed {failed} jobs left running by a stopped worker')
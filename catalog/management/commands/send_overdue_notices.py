@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog.notices import NOTICE_BATCH_SIZE, send_overdue_notices
+
+
+class Command(BaseCommand):
+    help = ('E-mail every borrower with overdue loans one notice listing them, through '
+            'settings.EMAIL_BACKEND. Loans already noticed at their current due date are '
+            'skipped, so the command can run as often as needed (e.g. daily).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=NOTICE_BATCH_SIZE,
+                            help=f'Borrowers per batch of messages (default {NOTICE_BATCH_SIZE}).')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Count the notices that would be sent without sending or recording them.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        counts = send_overdue_notices(batch_size=options['batch_size'], dry_run=options['dry_run'],
+                                      progress=self.progress if options['verbosity'] > 1 else None)
+        verb = 'Would send' if options['dry_run'] else 'Sent'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {counts["borrowers"]} notices covering {counts["loans"]} overdue loans in '
+            f'{time.perf_counter() - start:.1f}s; {counts["skipped"]} borrowers have no e-mail address'))
+
+    def progress(self, counts):
+        self.stdout.write(f'  {counts["borrowers"]} notices, {counts["loans"]} loans')
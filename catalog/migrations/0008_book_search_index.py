@@ -0,0 +1,37 @@
+from django.db import migrations
+
+
+# Full-text search table over each book's title, summary, author name and genre
+# names (see catalog/search.py). FTS5 is only available on SQLite, so this is a
+# no-op on other databases, which search with LIKE instead.
+CREATE_SQL = [
+    """CREATE VIRTUAL TABLE catalog_book_fts USING fts5(
+           title, summary, author, genres, tokenize = 'unicode61 remove_diacritics 2')""",
+    """INSERT INTO catalog_book_fts (rowid, title, summary, author, genres)
+       SELECT b.id, b.title, b.summary,
+              COALESCE(a.first_name || ' ' || a.last_name, ''),
+              COALESCE((SELECT group_concat(g.name, ' ') FROM catalog_book_genre bg
+                        JOIN catalog_genre g ON g.id = bg.genre_id WHERE bg.book_id = b.id), '')
+       FROM catalog_book b LEFT JOIN catalog_author a ON a.id = b.author_id""",
+]
+DROP_SQL = ['DROP TABLE IF EXISTS catalog_book_fts']
+
+
+def run_sqlite(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for sql in statements:
+            schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0007_loan_and_author_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_sqlite(CREATE_SQL), run_sqlite(DROP_SQL)),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 3.0.14 on 2026-10-18 18:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catalog', '0012_bookinstance_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatronMonthlyActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('checkouts', models.PositiveIntegerField(default=0)),
+                ('renewals', models.PositiveIntegerField(default=0)),
+                ('returns', models.PositiveIntegerField(default=0)),
+                ('patron', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LoanEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, 'Checkout'), (2, 'Renewal'), (3, 'Return')])),
+                ('date', models.DateField()),
+                ('due_back', models.DateField(null=True)),
+                ('book', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='catalog.Book')),
+                ('patron', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='BookMonthlyLoans',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('loans', models.PositiveIntegerField(default=0)),
+                ('book', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='catalog.Book')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='patronmonthlyactivity',
+            constraint=models.UniqueConstraint(fields=('patron', 'month'), name='patronmonthlyactivity_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='loanevent',
+            index=models.Index(fields=['book', 'date'], name='loanevent_book_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loanevent',
+            index=models.Index(fields=['patron', 'date'], name='loanevent_patron_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookmonthlyloans',
+            index=models.Index(fields=['month', '-loans'], name='bookmonthlyloans_popular_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='bookmonthlyloans',
+            constraint=models.UniqueConstraint(fields=('book', 'month'), name='bookmonthlyloans_unique'),
+        ),
+    ]
@@ -1,8 +1,10 @@
-from django.db import models
+from django.db import models, transaction
 from django.urls import reverse # Used to generate URLs by reversing the URL patterns
 import uuid # Required for unique book instances
 from django.contrib.auth.models import User #used to import the user model
 from datetime import date
+from django.utils import timezone
+from catalog.cache import bump_version
 
 # Create your models here.
 # Genre Model
@@ -44,6 +46,18 @@ class Book(models.Model):
     genre = models.ManyToManyField(Genre, help_text='Select a genre for this book')
     
     language = models.ForeignKey('Language', on_delete=models.SET_NULL, null = True)
+
+    # Number of copies (BookInstance records) of this book, in total and per loan status.
+    # Denormalized so lists can show availability without counting copies; kept up to
+    # date by catalog/availability.py and rebuilt with "manage.py rebuild_availability"
+    copies_total = models.PositiveIntegerField(default=0, editable=False)
+    copies_available = models.PositiveIntegerField(default=0, editable=False)
+    copies_on_loan = models.PositiveIntegerField(default=0, editable=False)
+    copies_reserved = models.PositiveIntegerField(default=0, editable=False)
+    copies_maintenance = models.PositiveIntegerField(default=0, editable=False)
+
+    # Last time the row was saved, used for Last-Modified/ETag headers (see catalog/conditional.py)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     
     # ---- Methods ----
     def __str__(self):
@@ -58,9 +72,42 @@ class Book(models.Model):
     def display_genre(self):
         """Create a string for the Genre. This is required to display genre in Admin.
             Only shows the first three values of genre."""
-        return ', '.join(genre.name for genre in self.genre.all()[:3])
+        # Sliced in Python so a prefetch_related('genre') (as in BookAdmin) is used
+        return ', '.join(genre.name for genre in list(self.genre.all())[:3])
 
     display_genre.short_description = 'Genre'
+class BookInstanceQuerySet(models.QuerySet):
+    """Loan queries done in SQL rather than per row in Python."""
+
+    def on_loan(self):
+        """Copies currently lent out (status = 'o')."""
+        return self.filter(status__exact='o')
+
+    def overdue(self, today=None):
+        """Copies on loan whose due date has passed, the SQL form of is_overdue."""
+        return self.on_loan().filter(due_back__lt=today or date.today())
+
+    def renew(self, renewal_date):
+        """Move the due date of every copy on loan in the queryset with a single UPDATE,
+        and record the renewals in the loan ledger in one batch.
+        Returns the number of copies renewed. Validate the date with RenewBookForm first."""
+        from catalog import ledger  # imports this module
+        with transaction.atomic():
+            loans = list(self.on_loan().values_list('book_id', 'borrower_id'))
+            # update() skips auto_now and the signal handlers, so bump updated_at
+            # here and mark the cached catalog pages showing due dates as stale
+            renewed = self.on_loan().update(due_back=renewal_date, updated_at=timezone.now(),
+                                            version=models.F('version') + 1)
+            # Ledger rows for the whole renewal in one batch
+            with ledger.batch():
+                for book_id, borrower_id in loans:
+                    ledger.record(LoanEvent.RENEWAL, book_id, borrower_id, renewal_date)
+        bump_version(self.model)
+        return renewed
+
+class CopyChanged(Exception):
+    """A BookInstance was saved from an instance older than the copy in the database."""
+
 class BookInstance(models.Model):
     """Model representing a specific copy of a book (i.e. that can be borrowed from the library)."""
     # ---- Fields ----
@@ -71,6 +118,14 @@ class BookInstance(models.Model):
     due_back = models.DateField(null=True, blank=True, help_text = 'The date the book is due')
     borrower = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
 
+    # Last time the row was saved, used for Last-Modified/ETag headers (see catalog/conditional.py)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Incremented by every change, so a checkout, return or renewal based on
+    # an out of date copy is refused instead of overwriting (see catalog/loans.py)
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = BookInstanceQuerySet.as_manager()
+
     # Key-pair values - Value is a display value the user can select
     # Keys are the values that are actually saved if it selected
     LOAN_STATUS = (
@@ -98,11 +153,37 @@ class BookInstance(models.Model):
     class Meta:
         ordering = ['due_back']
         permissions = (("catalog.can_mark_returned", "Can edit the book"),)
+        # Indexes for the loan lists: all copies on loan (and the available
+        # count on the home page) filter by status, a user's loans filter by
+        # borrower and status, and both are ordered by due_back
+        indexes = [
+            models.Index(fields=['status', 'due_back'], name='bookinst_status_due_idx'),
+            models.Index(fields=['borrower', 'status', 'due_back'], name='bookinst_borrower_due_idx'),
+        ]
 
     # ---- Methods ----
+    def save(self, *args, **kwargs):
+        # A save (e.g. from the admin) is a change like any other: it claims the
+        # next version in SQL, and only if the copy is still at the version this
+        # instance was loaded with, the same check as catalog/loans.py
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            claimed = BookInstance.objects.filter(pk=self.pk, version=self.version).update(
+                version=models.F('version') + 1)
+            if not claimed:
+                raise CopyChanged('The copy was changed by someone else, reload the page and try again.')
+            self.version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+            super().save(*args, **kwargs)
+
     def __str__ (self):
         """String for representing the Model Object."""
-        return f'{self.id} ({self.book.title})'
+        # Load with select_related('book') when listing copies, otherwise every
+        # call fetches the book. A copy whose book was deleted has no title.
+        title = self.book.title if self.book_id else None
+        return f'{self.id} ({title})'
 
 class Author (models.Model):
     """Model representing an author."""
@@ -111,10 +192,16 @@ class Author (models.Model):
     last_name = models.CharField(max_length=100)
     date_of_birth = models.DateField(null=True, blank=True)
     date_of_death = models.DateField('Died', null = True, blank = True)
+    # Last time the row was saved, used for Last-Modified/ETag headers (see catalog/conditional.py)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     # Will be sorted alphabetically by last name and then first name
     class Meta:
         ordering = ['last_name', 'first_name']
+        # Lets the database return authors in ordering without sorting the table
+        indexes = [
+            models.Index(fields=['last_name', 'first_name'], name='author_name_idx'),
+        ]
 
     # ---- Methods ----
     # reverses the author-detail URL mapping to get the URL for displaying an individual author
@@ -125,3 +212,211 @@ class Author (models.Model):
     def __str__ (self):
         """String for representing the Model object."""
         return f'{self.last_name}, {self.first_name}'
+
+class Hold(models.Model):
+    """Model representing a patron's place in the queue for a book.
+
+    Holds on a book are served oldest first: when a copy becomes available it
+    is set aside (status Reserved) for the first waiting hold, see catalog/holds.py."""
+    # ---- Fields ----
+    book = models.ForeignKey('Book', on_delete=models.CASCADE)
+    patron = models.ForeignKey(User, on_delete=models.CASCADE)
+    placed_at = models.DateTimeField(default=timezone.now)
+    # The copy set aside for the patron, once the hold is ready for pickup
+    copy = models.ForeignKey('BookInstance', on_delete=models.SET_NULL, null=True, blank=True)
+    ready_at = models.DateTimeField(null=True, blank=True)
+
+    HOLD_STATUS = (
+        ('w', 'Waiting'),
+        ('r', 'Ready for pickup'),
+        ('f', 'Fulfilled'),
+        ('c', 'Cancelled'),
+    )
+
+    status = models.CharField(max_length=1, choices=HOLD_STATUS, default='w')
+
+    # Will be sorted in queue order
+    class Meta:
+        ordering = ['placed_at', 'id']
+        # The queue of a book is one range of this index in order, so the next
+        # patron in line and a hold's position never scan the rest of the queue
+        indexes = [
+            models.Index(fields=['book', 'status', 'placed_at', 'id'], name='hold_queue_idx'),
+            models.Index(fields=['patron', 'status'], name='hold_patron_idx'),
+        ]
+        # A patron can only be in a book's queue once at a time
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'patron'], condition=models.Q(status__in=['w', 'r']),
+                                    name='hold_one_active_per_patron'),
+        ]
+
+    # ---- Methods ----
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'Hold {self.id} on book {self.book_id} ({self.get_status_display()})'
+
+class LoanEvent(models.Model):
+    """Model representing one checkout, renewal or return of a copy.
+
+    Rows are only ever appended (see catalog/ledger.py), so the
+    history survives the copy being lent again. Kept small: integer keys,
+    a small integer kind and plain dates; the copy itself isn't recorded."""
+    CHECKOUT = 1
+    RENEWAL = 2
+    RETURN = 3
+    EVENT_KIND = (
+        (CHECKOUT, 'Checkout'),
+        (RENEWAL, 'Renewal'),
+        (RETURN, 'Return'),
+    )
+
+    # ---- Fields ----
+    kind = models.PositiveSmallIntegerField(choices=EVENT_KIND)
+    # No database constraints, so the history outlives deleted books and users
+    book = models.ForeignKey('Book', on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    patron = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, null=True, related_name='+')
+    date = models.DateField()
+    due_back = models.DateField(null=True)
+
+    class Meta:
+        ordering = ['id']
+        # A book's or a patron's history, in date order
+        indexes = [
+            models.Index(fields=['book', 'date'], name='loanevent_book_date_idx'),
+            models.Index(fields=['patron', 'date'], name='loanevent_patron_date_idx'),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.get_kind_display()} of book {self.book_id} by {self.patron_id} on {self.date}'
+
+class BookMonthlyLoans(models.Model):
+    """Rollup of the ledger: how many times a book was checked out in a month."""
+    book = models.ForeignKey('Book', on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    # First day of the month
+    month = models.DateField()
+    loans = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'month'], name='bookmonthlyloans_unique'),
+        ]
+        # The most borrowed books of a month are the start of this index
+        indexes = [
+            models.Index(fields=['month', '-loans'], name='bookmonthlyloans_popular_idx'),
+        ]
+
+class PatronMonthlyActivity(models.Model):
+    """Rollup of the ledger: a patron's checkouts, renewals and returns in a month."""
+    patron = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    # First day of the month
+    month = models.DateField()
+    checkouts = models.PositiveIntegerField(default=0)
+    renewals = models.PositiveIntegerField(default=0)
+    returns = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['patron', 'month'], name='patronmonthlyactivity_unique'),
+        ]
+
+class RelatedBook(models.Model):
+    """Model representing one "readers also borrowed" recommendation for a book.
+
+    Computed offline from the loan ledger by catalog/recommendations.py
+    ("manage.py build_recommendations"); the book detail page only reads it."""
+    # ---- Fields ----
+    book = models.ForeignKey('Book', on_delete=models.CASCADE, related_name='related_books')
+    related = models.ForeignKey('Book', on_delete=models.CASCADE, related_name='+')
+    # 0 for the best recommendation
+    rank = models.PositiveSmallIntegerField()
+    # Patrons who borrowed both books
+    co_borrowers = models.PositiveIntegerField()
+    # co_borrowers / sqrt(borrowers of book * borrowers of related), so a
+    # popular book isn't recommended for everything
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ['book', 'rank']
+        # Also the index the detail page reads from
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'rank'], name='relatedbook_unique_rank'),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'{self.book_id} -> {self.related_id} ({self.score:.2f})'
+
+class OverdueNotice(models.Model):
+    """Model representing an overdue notice e-mailed to a borrower about one loan.
+
+    One per loan and due date, so "manage.py send_overdue_notices" can run
+    any number of times; a renewed loan that becomes overdue again gets a
+    new notice."""
+    # ---- Fields ----
+    copy = models.ForeignKey('BookInstance', on_delete=models.CASCADE, related_name='overdue_notices')
+    borrower = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    due_back = models.DateField()
+    sent_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['copy', 'borrower', 'due_back'], name='overduenotice_once_per_loan'),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'Overdue notice for {self.copy_id} due {self.due_back}'
+
+class Job(models.Model):
+    """Model representing a background task, queued by a view or admin action
+    and run by "manage.py run_workers" (see catalog/jobs.py)."""
+    JOB_STATUS = (
+        ('q', 'Queued'),
+        ('r', 'Running'),
+        ('d', 'Done'),
+        ('f', 'Failed'),
+    )
+
+    # ---- Fields ----
+    # Name of a task registered in catalog/tasks.py
+    task = models.CharField(max_length=100)
+    # Keyword arguments of the task, as JSON
+    arguments = models.TextField(default='{}')
+    status = models.CharField(max_length=1, choices=JOB_STATUS, default='q')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    # Not picked up before this, e.g. waiting to be retried
+    run_after = models.DateTimeField(default=timezone.now)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Name of the worker running (or that last ran) the job
+    worker = models.CharField(max_length=100, blank=True)
+    # Last sign of life of the worker running the job, given every
+    # JOB_HEARTBEAT while it runs (see catalog/jobs.py)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    # Return value of the task as JSON, or the last error
+    result = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        # Workers look for the oldest queued job that is due, and count the running ones per task
+        indexes = [
+            models.Index(fields=['status', 'run_after', 'id'], name='job_queue_idx'),
+            models.Index(fields=['task', 'status'], name='job_task_status_idx'),
+        ]
+
+    def __str__(self):
+        """String for representing the Model object."""
+        return f'Job {self.id}: {self.task} ({self.get_status_display()})'
+
+    def get_absolute_url(self):
+        """Returns the url to access the job's status page."""
+        return reverse('job-detail', args=[str(self.id)])
+
+    @property
+    def is_finished(self):
+        return self.status in ('d', 'f')
@@ -0,0 +1,97 @@
+"""Overdue notices: one e-mail per borrower listing their overdue loans.
+
+Loans are selected in SQL (BookInstance.objects.overdue()) minus the ones
+already noticed (OverdueNotice), and processed NOTICE_BATCH_SIZE borrowers
+at a time: one query for the next borrower ids (keyset on the id), one for
+their loans, one send_messages() call on a mail connection opened once for
+the whole run, and one INSERT recording the notices. Memory stays at one
+batch however many loans are overdue.
+
+Notices are recorded after their batch was handed to the mail backend, so
+a run that stops half way resends at most the batch that was being sent.
+Borrowers without an e-mail address are skipped and not recorded.
+"""
+import datetime
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.template.loader import render_to_string
+
+from catalog.models import BookInstance, OverdueNotice
+
+NOTICE_BATCH_SIZE = 200
+
+NOTICE_SUBJECT = 'Overdue books at the Local Library'
+
+
+def pending_loans(today=None):
+    """Overdue loans without a notice for their current borrower and due date."""
+    noticed = OverdueNotice.objects.filter(copy=OuterRef('pk'), borrower=OuterRef('borrower'),
+                                           due_back=OuterRef('due_back'))
+    return BookInstance.objects.overdue(today).filter(borrower__isnull=False).filter(~Exists(noticed))
+
+
+def borrower_batches(today=None, batch_size=NOTICE_BATCH_SIZE):
+    """Yield lists of (borrower values, [loan values]), ``batch_size`` borrowers at a time."""
+    pending = pending_loans(today)
+    last = 0
+    while True:
+        borrower_ids = list(pending.filter(borrower_id__gt=last).order_by('borrower_id')
+                            .values_list('borrower_id', flat=True).distinct()[:batch_size])
+        if not borrower_ids:
+            return
+        last = borrower_ids[-1]
+        loans = (pending.filter(borrower_id__in=borrower_ids).order_by('borrower_id', 'due_back', 'id')
+                 .values('id', 'due_back', 'imprint', 'book__title', 'borrower_id', 'borrower__username',
+                         'borrower__first_name', 'borrower__email'))
+        batch = []
+        for loan in loans:
+            if not batch or batch[-1][0]['id'] != loan['borrower_id']:
+                borrower = {'id': loan['borrower_id'], 'username': loan['borrower__username'],
+                            'first_name': loan['borrower__first_name'], 'email': loan['borrower__email']}
+                batch.append((borrower, []))
+            batch[-1][1].append(loan)
+        yield batch
+
+
+def notice_message(borrower, loans, today, connection=None):
+    body = render_to_string('catalog/overdue_notice_email.txt',
+                            {'borrower': borrower, 'loans': loans, 'today': today})
+    return EmailMessage(NOTICE_SUBJECT, body, settings.DEFAULT_FROM_EMAIL, [borrower['email']],
+                        connection=connection)
+
+
+def send_overdue_notices(today=None, batch_size=NOTICE_BATCH_SIZE, dry_run=False, progress=None):
+    """Send the pending overdue notices. Returns counts of borrowers mailed,
+    loans noticed and borrowers skipped for having no e-mail address.
+    ``progress`` is called with the counts after every batch."""
+    today = today or datetime.date.today()
+    counts = {'borrowers': 0, 'loans': 0, 'skipped': 0}
+    connection = get_connection()
+    if not dry_run:
+        # One SMTP session for every batch
+        connection.open()
+    try:
+        for batch in borrower_batches(today, batch_size):
+            messages, notices = [], []
+            for borrower, loans in batch:
+                if not borrower['email']:
+                    counts['skipped'] += 1
+                    continue
+                messages.append(notice_message(borrower, loans, today, connection))
+                notices.extend(OverdueNotice(copy_id=loan['id'], borrower_id=borrower['id'],
+                                             due_back=loan['due_back']) for loan in loans)
+            if messages and not dry_run:
+                connection.send_messages(messages)
+                with transaction.atomic():
+                    # A concurrent run may have recorded some of them already
+                    OverdueNotice.objects.bulk_create(notices, ignore_conflicts=True)
+            counts['borrowers'] += len(messages)
+            counts['loans'] += len(notices)
+            if progress:
+                progress(counts)
+    finally:
+        connection.close()
+    return counts
@@ -0,0 +1,266 @@
+import base64
+import binascii
+import collections.abc
+import datetime
+import functools
+import json
+import math
+import operator
+import uuid
+
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connections
+from django.db.models import F, Q
+from django.http import Http404, HttpResponseRedirect
+
+
+def encode_cursor(values, direction, number):
+    """Pack the boundary row's ordering values into an opaque, URL-safe cursor."""
+    payload = json.dumps({'v': values, 'd': direction, 'n': number}, default=_json_default,
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (values, direction, number) from a cursor made by encode_cursor."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values, direction, number = payload['v'], payload['d'], int(payload['n'])
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise Http404('Invalid cursor')
+    if direction not in ('next', 'prev') or not isinstance(values, list) or number < 1:
+        raise Http404('Invalid cursor')
+    return values, direction, number
+
+
+# Integers are stored in at most 64 bits by every database Django supports,
+# the drivers raise OverflowError for larger ones when the query runs
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def field_value(field, value):
+    """Return ``field.to_python(value)`` for a value from a cursor or a query
+    string, raising ValidationError also for the values to_python() doesn't
+    expect (e.g. a list) and integers no database column can hold."""
+    try:
+        value = field.to_python(value)
+    except (TypeError, OverflowError) as e:
+        raise ValidationError(str(e))
+    if isinstance(value, int) and not -MAX_INTEGER - 1 <= value <= MAX_INTEGER:
+        raise ValidationError(f'{value} is out of range')
+    return value
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f'Cannot encode {value!r} in a cursor')
+
+
+class KeysetPaginator:
+    """Paginator metadata for a keyset page; count and num_pages are None when skipped."""
+
+    def __init__(self, per_page, count=None):
+        self.per_page = per_page
+        self.count = count
+        self.num_pages = None if count is None else max(1, math.ceil(count / per_page))
+
+
+class KeysetPage(collections.abc.Sequence):
+    """A page of results that links to its neighbours with cursors instead of offsets.
+
+    Provides the parts of django.core.paginator.Page the templates use, so
+    ``page_obj.has_next`` etc. keep working."""
+
+    def __init__(self, object_list, number, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return f'<Keyset page {self.number}>'
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+
+class KeysetPaginationMixin:
+    """Cursor-based pagination for a ListView.
+
+    Each page is fetched with a WHERE clause on the ordering columns of the
+    row it starts after (``?cursor=...``) rather than an OFFSET, so every
+    page costs the same however deep it is, given an index on the ordering.
+    The ordering comes from ``keyset_ordering``, else the queryset or model
+    Meta ordering, and always ends with the primary key so rows with equal
+    values are never skipped. NULLs sort as the smallest value, as they do
+    natively on SQLite and MySQL. Set ``keyset_count = False`` to skip the COUNT(*) used for the
+    total number of pages. Links with a page number (``?page=N``, e.g. old
+    bookmarks) are redirected to the cursor of that page."""
+    keyset_ordering = None
+    keyset_count = True
+    cursor_kwarg = 'cursor'
+
+    def get(self, request, *args, **kwargs):
+        if self.page_kwarg in request.GET and not request.GET.get(self.cursor_kwarg):
+            return self.redirect_page_number(request.GET[self.page_kwarg])
+        return super().get(request, *args, **kwargs)
+
+    def redirect_page_number(self, number):
+        """Redirect ``?page=number`` to the same page by cursor; 404 if there is no such page.
+        Finding it costs one OFFSET query, once."""
+        try:
+            number = int(number)
+        except ValueError:
+            raise Http404('Invalid page')
+        if number < 1:
+            raise Http404('Invalid page')
+        query = self.request.GET.copy()
+        del query[self.page_kwarg]
+        if number > 1:
+            queryset = self.get_queryset()
+            page_size = self.get_paginate_by(queryset)
+            ordering, fields = self._keyset_fields(queryset)
+            nulls_smallest = connections[queryset.db].vendor in ('sqlite', 'mysql')
+            ordered = queryset.order_by(*self._order_expressions(ordering, fields, False, nulls_smallest))
+            # The last row of the page before
+            offset = (number - 1) * page_size - 1
+            rows = list(ordered.values_list(*[field.attname for field in fields])[offset:offset + 1])
+            if not rows:
+                raise Http404('Invalid page')
+            query[self.cursor_kwarg] = encode_cursor(list(rows[0]), 'next', number)
+        url = self.request.path + (f'?{query.urlencode()}' if query else '')
+        return HttpResponseRedirect(url)
+
+    def _keyset_fields(self, queryset):
+        ordering = self.get_keyset_ordering(queryset)
+        if any('__' in name for name in ordering):
+            raise ImproperlyConfigured(f'{self.__class__.__name__} can only order by local, non-relation fields.')
+        fields = [queryset.model._meta.get_field(name.lstrip('-')) for name in ordering]
+        if any(field.is_relation for field in fields):
+            raise ImproperlyConfigured(f'{self.__class__.__name__} can only order by local, non-relation fields.')
+        return ordering, fields
+
+    def get_keyset_ordering(self, queryset):
+        pk_name = queryset.model._meta.pk.name
+        ordering = []
+        for name in self.keyset_ordering or queryset.query.order_by or queryset.model._meta.ordering:
+            descending, field = name.startswith('-'), name.lstrip('-')
+            ordering.append(('-' if descending else '') + (pk_name if field == 'pk' else field))
+        if not any(name.lstrip('-') == pk_name for name in ordering):
+            ordering.append(pk_name)
+        return ordering
+
+    def paginate_queryset(self, queryset, page_size):
+        ordering, fields = self._keyset_fields(queryset)
+
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        if cursor:
+            values, direction, number = decode_cursor(cursor)
+            if len(values) != len(ordering):
+                raise Http404('Invalid cursor')
+            try:
+                values = [field_value(field, value) for field, value in zip(fields, values)]
+            except ValidationError:
+                raise Http404('Invalid cursor')
+        else:
+            values, direction, number = None, 'next', 1
+
+        backwards = direction == 'prev'
+        nulls_smallest = connections[queryset.db].vendor in ('sqlite', 'mysql')
+        page_queryset = queryset.order_by(*self._order_expressions(ordering, fields, backwards, nulls_smallest))
+        if values is not None:
+            page_queryset = page_queryset.filter(self._after(ordering, values, backwards))
+        # Fetch one extra row to find out if there is another page in this direction
+        rows = list(page_queryset[:page_size + 1])
+        if (values is not None and values[0] is not None and fields[0].null
+                and ordering[0].startswith('-') != backwards and len(rows) <= page_size):
+            # Walking towards the NULLs in the leading column: they are all
+            # before the cursor, so continue into them once the rest run out
+            nulls = queryset.filter(**{f'{fields[0].name}__isnull': True})
+            rows += nulls.order_by(*page_queryset.query.order_by)[:page_size + 1 - len(rows)]
+        more = len(rows) > page_size
+        rows = rows[:page_size]
+        if backwards:
+            rows.reverse()
+
+        def boundary(row, row_direction, row_number):
+            row_values = [getattr(row, field.attname) for field in fields]
+            return encode_cursor(row_values, row_direction, row_number)
+
+        has_next = more if not backwards else True
+        has_previous = values is not None if not backwards else more
+        next_cursor = boundary(rows[-1], 'next', number + 1) if rows and has_next else None
+        previous_cursor = boundary(rows[0], 'prev', max(1, number - 1)) if rows and has_previous else None
+
+        count = queryset.count() if self.keyset_count else None
+        page = KeysetPage(rows, number, KeysetPaginator(page_size, count), next_cursor, previous_cursor)
+        return (page.paginator, page, page.object_list, page.has_other_pages())
+
+    @staticmethod
+    def _order_expressions(ordering, fields, backwards, nulls_smallest):
+        expressions = []
+        for name, field in zip(ordering, fields):
+            descending = name.startswith('-') != backwards
+            if not field.null or nulls_smallest:
+                # Plain ordering, so the database can walk an index on these columns
+                expressions.append(('-' if descending else '') + field.name)
+                continue
+            # Other backends (e.g. PostgreSQL) sort NULL as the largest value
+            expression = F(field.name)
+            expressions.append(expression.desc(nulls_last=True) if descending else expression.asc(nulls_first=True))
+        return expressions
+
+    @staticmethod
+    def _after(ordering, values, backwards):
+        """Build the filter for rows strictly after ``values`` in the (possibly reversed) ordering.
+
+        (a, b, pk) > (x, y, z) is expanded to
+        a > x OR (a = x AND b > y) OR (a = x AND b = y AND pk > z)."""
+        conditions = []
+        equal = Q()
+        for name, value in zip(ordering, values):
+            field = name.lstrip('-')
+            greater = name.startswith('-') == backwards
+            if greater:
+                # Everything except NULL is greater than NULL
+                step = Q(**{f'{field}__isnull': False}) if value is None else Q(**{f'{field}__gt': value})
+                conditions.append(equal & step)
+            elif value is not None:
+                # NULL is smaller than everything else (and nothing is smaller than NULL)
+                conditions.append(equal & (Q(**{f'{field}__lt': value}) | Q(**{f'{field}__isnull': True})))
+            equal &= Q(**{f'{field}__isnull': True}) if value is None else Q(**{field: value})
+        condition = functools.reduce(operator.or_, conditions, Q(pk__in=[]))
+        # Repeat the bound on the leading column on its own, so the database can
+        # turn it into an index range scan instead of evaluating the OR per row
+        field, value = ordering[0].lstrip('-'), values[0]
+        if value is not None:
+            if ordering[0].startswith('-') == backwards:
+                condition &= Q(**{f'{field}__gte': value})
+            else:
+                # Rows where it is NULL also come before the bound, paginate_queryset
+                # fetches them separately rather than OR them in here
+                condition &= Q(**{f'{field}__lte': value})
+        return condition
@@ -0,0 +1,251 @@
+"""Per-view latency and SQL profiling, collected in process by ProfilingMiddleware.
+
+For every request the middleware measures the wall time, the time spent
+rendering a TemplateResponse (the generic views; render() in a function
+view counts as view time), and each SQL statement through a connection
+execute wrapper: how many ran, how long they took, how many were exact
+repeats (same SQL and parameters) and which SQL ran many times with
+different parameters. The latter is what an N+1 looks like (one query per
+row of a list): a statement run PROFILING_REPEATED_QUERIES times or more in
+one request is flagged and logged to the 'catalog.profiling' logger.
+
+Numbers are aggregated per view name into fixed-bucket histograms, so
+memory doesn't grow with traffic and p50/p95/p99 are accurate to a bucket
+(about 19% for times). Each process keeps its own. Staff can read them at
+/catalog/profiling/ (?format=json for the raw numbers), and with
+PROFILING_FILE set they are written there as JSON at most every
+PROFILING_FLUSH_SECONDS.
+"""
+import bisect
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger('catalog.profiling')
+
+# Upper bounds of the histogram buckets: milliseconds from 0.05 ms to about
+# 2 minutes, 4 buckets per doubling, and statement counts from 0 to about 10,000
+TIME_BOUNDS = [0.05 * 2 ** (i / 4) for i in range(86)]
+COUNT_BOUNDS = sorted({0} | {round(1.25 ** i) for i in range(42)})
+
+# N+1 candidates kept per view, the ones repeated most
+PROFILING_TOP_REPEATED = 10
+
+
+class Histogram:
+    """Counts of values per bucket, with percentiles read off the buckets."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the ``q``-th percentile (never above the maximum)."""
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                bound = self.bounds[index] if index < len(self.bounds) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return None
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 3),
+            'p50': round(self.percentile(50), 3),
+            'p95': round(self.percentile(95), 3),
+            'p99': round(self.percentile(99), 3),
+            'max': round(self.max, 3),
+        }
+
+
+class RequestProfile:
+    """What one request did; record_query() is the execute wrapper."""
+
+    def __init__(self):
+        self.wall_ms = 0
+        self.template_ms = None
+        self.sql_ms = 0
+        self.statements = collections.Counter()
+        self.executions = collections.Counter()
+
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_ms += (time.perf_counter() - start) * 1000
+            self.statements[sql] += 1
+            if not many:
+                self.executions[sql, repr(params)] += 1
+
+    def rendered(self, start):
+        self.template_ms = (time.perf_counter() - start) * 1000
+
+    @property
+    def queries(self):
+        return sum(self.statements.values())
+
+    @property
+    def duplicates(self):
+        """Executions that repeated an earlier one exactly, parameters included."""
+        return sum(count - 1 for count in self.executions.values())
+
+    def repeated(self, threshold):
+        """{sql: executions} for the statements run at least ``threshold`` times."""
+        return {sql: count for sql, count in self.statements.items() if count >= threshold}
+
+
+class ViewStats:
+    def __init__(self):
+        self.requests = 0
+        self.wall_ms = Histogram(TIME_BOUNDS)
+        self.template_ms = Histogram(TIME_BOUNDS)
+        self.sql_ms = Histogram(TIME_BOUNDS)
+        self.queries = Histogram(COUNT_BOUNDS)
+        self.duplicates = 0
+        self.flagged_requests = 0
+        # sql -> [requests flagged, most executions in one request]
+        self.repeated = {}
+
+    def add(self, profile, repeated):
+        self.requests += 1
+        self.wall_ms.add(profile.wall_ms)
+        if profile.template_ms is not None:
+            self.template_ms.add(profile.template_ms)
+        self.sql_ms.add(profile.sql_ms)
+        self.queries.add(profile.queries)
+        self.duplicates += profile.duplicates
+        if repeated:
+            self.flagged_requests += 1
+        for sql, count in repeated.items():
+            seen = self.repeated.setdefault(sql, [0, 0])
+            seen[0] += 1
+            seen[1] = max(seen[1], count)
+        if len(self.repeated) > PROFILING_TOP_REPEATED:
+            keep = sorted(self.repeated.items(), key=lambda item: -item[1][1])[:PROFILING_TOP_REPEATED]
+            self.repeated = dict(keep)
+
+    def summary(self):
+        return {
+            'requests': self.requests,
+            'wall_ms': self.wall_ms.summary(),
+            'template_ms': self.template_ms.summary(),
+            'sql_ms': self.sql_ms.summary(),
+            'queries': self.queries.summary(),
+            'duplicate_queries': self.duplicates,
+            'n_plus_one_requests': self.flagged_requests,
+            'n_plus_one': [{'sql': sql, 'requests': requests, 'max_executions': most}
+                           for sql, (requests, most) in sorted(self.repeated.items(), key=lambda item: -item[1][1])],
+        }
+
+
+class Collector:
+    """The ViewStats of every view seen by this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.views = collections.defaultdict(ViewStats)
+            self.started = time.time()
+            self.flushed = time.monotonic()
+
+    def add(self, view_name, profile):
+        threshold = settings.PROFILING_REPEATED_QUERIES
+        repeated = profile.repeated(threshold)
+        for sql, count in repeated.items():
+            logger.warning('Possible N+1 in %s: %d executions of %s', view_name, count, sql)
+        with self.lock:
+            self.views[view_name].add(profile, repeated)
+
+    def snapshot(self):
+        with self.lock:
+            views = {name: stats.summary() for name, stats in sorted(self.views.items())}
+        return {'pid': os.getpid(), 'since': self.started, 'views': views}
+
+    def flush_if_due(self):
+        """Write the snapshot to PROFILING_FILE if PROFILING_FLUSH_SECONDS have passed."""
+        path = settings.PROFILING_FILE
+        if not path:
+            return False
+        with self.lock:
+            if time.monotonic() - self.flushed < settings.PROFILING_FLUSH_SECONDS:
+                return False
+            self.flushed = time.monotonic()
+        write_snapshot(path.format(pid=os.getpid()), self.snapshot())
+        return True
+
+
+def write_snapshot(path, snapshot):
+    # Readers never see a half-written file
+    temporary = f'{path}.{threading.get_ident()}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(snapshot, f, indent=2)
+    os.replace(temporary, path)
+
+
+collector = Collector()
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    return match.view_name or match._func_path
+
+
+class ProfilingMiddleware:
+    """Records every request in ``collector``. List it first in MIDDLEWARE so
+    the timings include the other middleware."""
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile = request._profile = RequestProfile()
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(profile.record_query))
+            response = self.get_response(request)
+        profile.wall_ms = (time.perf_counter() - start) * 1000
+        collector.add(view_name(request), profile)
+        collector.flush_if_due()
+        return response
+
+    def process_template_response(self, request, response):
+        # Called last of all the middleware, right before the response is
+        # rendered; pages from the page cache come already rendered
+        if response.is_rendered:
+            return response
+        start = time.perf_counter()
+        response.add_post_render_callback(lambda rendered: request._profile.rendered(start))
+        return response
@@ -0,0 +1,136 @@
+"""Readers also borrowed: books borrowed by the same patrons, computed offline.
+
+Every patron who checked out both book A and book B counts once towards the
+pair. Pairs are scored by cosine similarity,
+
+    score = co_borrowers / sqrt(borrowers of A * borrowers of B)
+
+so a book everyone borrows isn't the top recommendation for every other
+book, and the best RECOMMENDATIONS_TOP_K of each book are stored in
+RelatedBook. The book detail page reads that table and never computes
+anything itself; rebuild it nightly with "manage.py build_recommendations".
+
+Patrons who borrowed more than RECOMMENDATIONS_MAX_BOOKS_PER_PATRON
+distinct books are left out: borrowing nearly everything says little about
+which books go together, and each of them would add that many squared
+pairs to count.
+
+With NumPy and SciPy installed the co-borrowing counts come from one sparse
+matrix product (patrons x books, transposed, times itself). Without them
+the same counts and the same top K are computed in plain Python, one book
+at a time, so memory grows with the number of loans rather than with the
+number of pairs of books borrowed together.
+"""
+import collections
+import heapq
+import itertools
+import math
+
+from django.db import transaction
+
+from catalog.cache import bump_version
+from catalog.models import Book, LoanEvent, RelatedBook
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+RECOMMENDATIONS_TOP_K = 5
+
+# Patrons with more distinct books than this don't count (see above)
+RECOMMENDATIONS_MAX_BOOKS_PER_PATRON = 500
+
+# Rows per INSERT when writing RelatedBook
+RECOMMENDATIONS_BATCH_SIZE = 5000
+
+
+def loan_pairs():
+    """Distinct (patron id, book id) pairs from the checkouts in the loan ledger,
+    for books that still exist."""
+    return (LoanEvent.objects.filter(kind=LoanEvent.CHECKOUT, patron__isnull=False,
+                                     book_id__in=Book.objects.values('pk'))
+            .order_by().values_list('patron_id', 'book_id').distinct())
+
+
+def _related_python(pairs, top_k, max_books=RECOMMENDATIONS_MAX_BOOKS_PER_PATRON):
+    books_of = collections.defaultdict(list)
+    for patron_id, book_id in pairs:
+        books_of[patron_id].append(book_id)
+    patrons_of = collections.defaultdict(list)
+    for patron_id, books in list(books_of.items()):
+        if len(books) > max_books:
+            del books_of[patron_id]
+            continue
+        for book_id in books:
+            patrons_of[book_id].append(patron_id)
+
+    # One book at a time: only its own co-borrowing counts are in memory
+    for book_id in sorted(patrons_of):
+        counts = collections.Counter()
+        for patron_id in patrons_of[book_id]:
+            counts.update(books_of[patron_id])
+        del counts[book_id]
+        borrowers = len(patrons_of[book_id])
+        scored = ((count / math.sqrt(borrowers * len(patrons_of[other_id])), other_id, count)
+                  for other_id, count in counts.items())
+        best = heapq.nsmallest(top_k, scored, key=lambda item: (-item[0], item[1]))
+        for rank, (score, other_id, count) in enumerate(best):
+            yield book_id, other_id, rank, count, score
+
+
+def _related_sparse(pairs, top_k, max_books=RECOMMENDATIONS_MAX_BOOKS_PER_PATRON):
+    pairs = numpy.array(list(pairs), dtype=numpy.int64).reshape(-1, 2)
+    _, patron_index, books_per_patron = numpy.unique(pairs[:, 0], return_inverse=True, return_counts=True)
+    pairs = pairs[books_per_patron[patron_index] <= max_books]
+    if not len(pairs):
+        return
+    _, patron_index = numpy.unique(pairs[:, 0], return_inverse=True)
+    book_ids, book_index = numpy.unique(pairs[:, 1], return_inverse=True)
+    borrowed = sparse.csr_matrix((numpy.ones(len(pairs), dtype=numpy.int32), (patron_index, book_index)),
+                                 shape=(patron_index.max() + 1, len(book_ids)))
+    # Book x book: patrons who borrowed both; the diagonal is each book's borrowers
+    together = (borrowed.T @ borrowed).tocoo()
+    borrowers = numpy.asarray(borrowed.sum(axis=0)).ravel()
+    off_diagonal = together.row != together.col
+    rows, cols = together.row[off_diagonal], together.col[off_diagonal]
+    counts = together.data[off_diagonal]
+    scores = counts / numpy.sqrt(borrowers[rows].astype(numpy.float64) * borrowers[cols])
+
+    # Per book, best score first and then the lowest related id, as above
+    order = numpy.lexsort((book_ids[cols], -scores, rows))
+    rows, cols, counts, scores = rows[order], cols[order], counts[order], scores[order]
+    ranks = numpy.arange(len(rows)) - numpy.searchsorted(rows, rows)
+    keep = ranks < top_k
+    yield from zip(book_ids[rows[keep]].tolist(), book_ids[cols[keep]].tolist(), ranks[keep].tolist(),
+                   counts[keep].tolist(), scores[keep].tolist())
+
+
+def compute_related(pairs, top_k=RECOMMENDATIONS_TOP_K):
+    """(book id, related book id, rank, co-borrowers, score) for the ``top_k``
+    best related books of every book in the (patron id, book id) ``pairs``."""
+    if numpy is not None:
+        return _related_sparse(pairs, top_k)
+    return _related_python(pairs, top_k)
+
+
+def rebuild_recommendations(top_k=RECOMMENDATIONS_TOP_K):
+    """Replace the whole RelatedBook table from the loan ledger, in one transaction.
+    Returns the number of recommendations written."""
+    related = compute_related(loan_pairs().iterator(), top_k)
+    written = 0
+    with transaction.atomic():
+        RelatedBook.objects.all().delete()
+        while True:
+            batch = [RelatedBook(book_id=book_id, related_id=related_id, rank=rank, co_borrowers=count, score=score)
+                     for book_id, related_id, rank, count, score
+                     in itertools.islice(related, RECOMMENDATIONS_BATCH_SIZE)]
+            if not batch:
+                break
+            RelatedBook.objects.bulk_create(batch)
+            written += len(batch)
+    # The detail pages show them
+    bump_version(RelatedBook)
+    return written
+
@@ -0,0 +1,157 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from catalog.models import Author, Book, Genre
+
+# SQLite FTS5 table holding one row per Book (rowid = book id), created by
+# migration 0008. The author and genre columns are denormalized copies kept in
+# sync by the signal handlers in catalog/signals.py.
+SEARCH_TABLE = 'catalog_book_fts'
+
+# bm25 weight of each column (title, summary, author, genres): a match in the
+# title counts the most, one in the summary the least
+SEARCH_WEIGHTS = (10.0, 1.0, 5.0, 2.0)
+
+# Columns the results template renders
+LISTED_BOOK_FIELDS = ('title', 'author', 'author__first_name', 'author__last_name',
+                      'copies_total', 'copies_available')
+
+# Bound parameters per statement when reindexing a list of ids
+ID_CHUNK_SIZE = 500
+
+
+def search_enabled():
+    """FTS5 is SQLite only; other databases fall back to a LIKE search."""
+    return connection.vendor == 'sqlite'
+
+
+def _index_sql(where):
+    """SQL that (re)builds the search rows for the books matching ``where``."""
+    book = Book._meta.db_table
+    author = Author._meta.db_table
+    genre = Genre._meta.db_table
+    book_genre = Book.genre.through._meta.db_table
+    return [
+        f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN (SELECT b.id FROM {book} b WHERE {where})',
+        f'''INSERT INTO {SEARCH_TABLE} (rowid, title, summary, author, genres)
+            SELECT b.id, b.title, b.summary,
+                   COALESCE(a.first_name || ' ' || a.last_name, ''),
+                   COALESCE((SELECT group_concat(g.name, ' ') FROM {book_genre} bg
+                             JOIN {genre} g ON g.id = bg.genre_id WHERE bg.book_id = b.id), '')
+            FROM {book} b LEFT JOIN {author} a ON a.id = b.author_id
+            WHERE {where}''',
+    ]
+
+
+def _reindex(where, params=()):
+    if not search_enabled():
+        return
+    with connection.cursor() as cursor:
+        for sql in _index_sql(where):
+            cursor.execute(sql, params)
+
+
+def reindex_books(book_ids):
+    """Rebuild the search rows of the given books."""
+    book_ids = list(book_ids)
+    for start in range(0, len(book_ids), ID_CHUNK_SIZE):
+        chunk = book_ids[start:start + ID_CHUNK_SIZE]
+        _reindex(f'b.id IN ({", ".join(["%s"] * len(chunk))})', chunk)
+
+
+def reindex_author(author_id):
+    """Rebuild the search rows of every book by an author (e.g. after a rename)."""
+    _reindex('b.author_id = %s', [author_id])
+
+
+def reindex_genre(genre_id):
+    """Rebuild the search rows of every book in a genre (e.g. after a rename)."""
+    book_genre = Book.genre.through._meta.db_table
+    _reindex(f'b.id IN (SELECT book_id FROM {book_genre} WHERE genre_id = %s)', [genre_id])
+
+
+def remove_books(book_ids):
+    """Drop deleted books from the search table."""
+    if not search_enabled():
+        return
+    book_ids = list(book_ids)
+    with connection.cursor() as cursor:
+        for start in range(0, len(book_ids), ID_CHUNK_SIZE):
+            chunk = book_ids[start:start + ID_CHUNK_SIZE]
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({", ".join(["%s"] * len(chunk))})', chunk)
+
+
+def rebuild_search_index():
+    """Rebuild the whole search table, e.g. after bulk loads that skip signals."""
+    if not search_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        cursor.execute(_index_sql('1 = 1')[1])
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
+
+
+def to_match_expression(query):
+    """Turn free text into a safe FTS5 query: every word must match, the last as a prefix."""
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+class SearchResults:
+    """Book search results in bm25 rank order, sliceable and countable so they
+    can be handed to a Paginator. Only the requested page of books is loaded."""
+
+    def __init__(self, query):
+        self.query = query
+        self.match = to_match_expression(query)
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            if self.match is None:
+                self._count = 0
+            elif search_enabled():
+                with connection.cursor() as cursor:
+                    cursor.execute(f'SELECT COUNT(*) FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s', [self.match])
+                    self._count = cursor.fetchone()[0]
+            else:
+                self._count = self._fallback().count()
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start, stop = index.start or 0, index.stop
+        if self.match is None or (stop is not None and stop <= start):
+            return []
+        if not search_enabled():
+            return list(self._fallback()[start:stop])
+
+        weights = ', '.join(str(weight) for weight in SEARCH_WEIGHTS)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s '
+                f'ORDER BY bm25({SEARCH_TABLE}, {weights}) LIMIT %s OFFSET %s',
+                [self.match, -1 if stop is None else stop - start, start])
+            ids = [row[0] for row in cursor.fetchall()]
+        books = Book.objects.select_related('author').only(*LISTED_BOOK_FIELDS).in_bulk(ids)
+        return [books[book_id] for book_id in ids if book_id in books]
+
+    def _fallback(self):
+        terms = re.findall(r'\w+', self.query)
+        condition = Q()
+        for term in terms:
+            condition &= (Q(title__icontains=term) | Q(summary__icontains=term)
+                          | Q(author__first_name__icontains=term) | Q(author__last_name__icontains=term)
+                          | Q(genre__name__icontains=term))
+        return (Book.objects.filter(condition).distinct().select_related('author')
+                .only(*LISTED_BOOK_FIELDS).order_by('title', 'id'))
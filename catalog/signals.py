@@ -0,0 +1,151 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from catalog import availability, holds, ledger, search
+from catalog.cache import bump_version
+from catalog.models import Author, Book, BookInstance, Genre, Language, LoanEvent
+
+
+# ---- Full-text search ----
+# Keep catalog_book_fts in step with the book, author and genre rows it copies
+# text from (see catalog/search.py).
+@receiver(post_save, sender=Book, dispatch_uid='catalog_search_book_saved')
+def search_book_saved(sender, instance, **kwargs):
+    search.reindex_books([instance.pk])
+
+
+@receiver(post_delete, sender=Book, dispatch_uid='catalog_search_book_deleted')
+def search_book_deleted(sender, instance, **kwargs):
+    search.remove_books([instance.pk])
+
+
+@receiver(m2m_changed, sender=Book.genre.through, dispatch_uid='catalog_search_book_genres_changed')
+def search_book_genres_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # book.genre.add(...) / remove(...) / clear()
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            search.reindex_books([instance.pk])
+    elif action == 'pre_clear':
+        # genre.book_set.clear() doesn't say which books it removes
+        instance._search_book_ids = list(instance.book_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        search.reindex_books(getattr(instance, '_search_book_ids', []))
+    elif action in ('post_add', 'post_remove'):
+        search.reindex_books(pk_set)
+
+
+@receiver(post_save, sender=Author, dispatch_uid='catalog_search_author_saved')
+def search_author_saved(sender, instance, created, **kwargs):
+    if not created:
+        search.reindex_author(instance.pk)
+
+
+@receiver(post_save, sender=Genre, dispatch_uid='catalog_search_genre_saved')
+def search_genre_saved(sender, instance, created, **kwargs):
+    if not created:
+        search.reindex_genre(instance.pk)
+
+
+# Deleting an author or genre updates its books without saving them, so note
+# which books are affected before the delete and reindex them afterwards
+@receiver(pre_delete, sender=Author, dispatch_uid='catalog_search_author_deleting')
+@receiver(pre_delete, sender=Genre, dispatch_uid='catalog_search_genre_deleting')
+def search_books_changing(sender, instance, **kwargs):
+    instance._search_book_ids = list(instance.book_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Author, dispatch_uid='catalog_search_author_deleted')
+@receiver(post_delete, sender=Genre, dispatch_uid='catalog_search_genre_deleted')
+def search_books_changed(sender, instance, **kwargs):
+    search.reindex_books(getattr(instance, '_search_book_ids', []))
+
+
+# ---- Per-book availability counters ----
+# Book.copies_* follow each copy's book and status (see catalog/availability.py).
+# The values a copy had in the database are looked up before it is saved.
+# The loan fields are read in the same query for the ledger handler below.
+@receiver(pre_save, sender=BookInstance, dispatch_uid='catalog_availability_copy_saving')
+def availability_copy_saving(sender, instance, update_fields=None, raw=False, **kwargs):
+    instance._availability_old = None
+    instance._loan_old = None
+    if raw or instance._state.adding:
+        return
+    if update_fields is not None and not {'book', 'status', 'borrower', 'due_back'} & set(update_fields):
+        instance._availability_old = (instance.book_id, instance.status)
+        instance._loan_old = (instance.borrower_id, instance.due_back)
+        return
+    old = BookInstance.objects.filter(pk=instance.pk).values_list('book', 'status', 'borrower', 'due_back').first()
+    if old is not None:
+        instance._availability_old = old[:2]
+        instance._loan_old = old[2:]
+
+
+@receiver(post_save, sender=BookInstance, dispatch_uid='catalog_availability_copy_saved')
+def availability_copy_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    availability.copy_changed(getattr(instance, '_availability_old', None), (instance.book_id, instance.status))
+
+
+@receiver(post_delete, sender=BookInstance, dispatch_uid='catalog_availability_copy_deleted')
+def availability_copy_deleted(sender, instance, **kwargs):
+    availability.copy_changed((instance.book_id, instance.status), None)
+
+
+# ---- Loan ledger ----
+# Loans changed by saving a copy (e.g. in the admin) are recorded like the ones
+# made through catalog/loans.py.
+@receiver(post_save, sender=BookInstance, dispatch_uid='catalog_ledger_copy_saved')
+def ledger_copy_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    old_book, old_status = getattr(instance, '_availability_old', None) or (None, None)
+    old_borrower, old_due_back = getattr(instance, '_loan_old', None) or (None, None)
+    was_lent, is_lent = old_status == 'o', instance.status == 'o'
+    same_loan = was_lent and is_lent and old_borrower == instance.borrower_id and old_book == instance.book_id
+    if was_lent and not same_loan:
+        ledger.record(LoanEvent.RETURN, old_book, old_borrower)
+    if is_lent and not same_loan:
+        ledger.record(LoanEvent.CHECKOUT, instance.book_id, instance.borrower_id, instance.due_back)
+    elif same_loan and old_due_back != instance.due_back:
+        ledger.record(LoanEvent.RENEWAL, instance.book_id, instance.borrower_id, instance.due_back)
+
+
+# ---- Holds ----
+# A copy that becomes available goes to the next patron waiting for its book
+# (see catalog/holds.py). Runs after the availability handlers above.
+@receiver(post_save, sender=BookInstance, dispatch_uid='catalog_holds_copy_saved')
+def holds_copy_saved(sender, instance, raw=False, **kwargs):
+    if raw or instance.status != 'a':
+        return
+    old = getattr(instance, '_availability_old', None)
+    if old is not None and old[1] == 'a':
+        return
+    if holds.allocate_copy(instance.pk) is not None:
+        # allocate_copy() changed the row with an UPDATE, claiming the next version
+        instance.status = 'r'
+        instance.version += 1
+
+
+# ---- Cached catalog pages and home page counters ----
+# Pages cached with catalog.cache.cache_catalog_page, and the counters in
+# catalog/stats.py, are keyed on a version per model, so changing a row makes
+# everything built from that model stale.
+@receiver(post_save, sender=Book, dispatch_uid='catalog_pages_book_saved')
+@receiver(post_delete, sender=Book, dispatch_uid='catalog_pages_book_deleted')
+@receiver(post_save, sender=BookInstance, dispatch_uid='catalog_pages_bookinstance_saved')
+@receiver(post_delete, sender=BookInstance, dispatch_uid='catalog_pages_bookinstance_deleted')
+@receiver(post_save, sender=Author, dispatch_uid='catalog_pages_author_saved')
+@receiver(post_delete, sender=Author, dispatch_uid='catalog_pages_author_deleted')
+@receiver(post_save, sender=Genre, dispatch_uid='catalog_pages_genre_saved')
+@receiver(post_delete, sender=Genre, dispatch_uid='catalog_pages_genre_deleted')
+@receiver(post_save, sender=Language, dispatch_uid='catalog_pages_language_saved')
+@receiver(post_delete, sender=Language, dispatch_uid='catalog_pages_language_deleted')
+def catalog_pages_changed(sender, **kwargs):
+    bump_version(sender)
+
+
+@receiver(m2m_changed, sender=Book.genre.through, dispatch_uid='catalog_pages_book_genres_changed')
+def catalog_pages_book_genres_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version(Book)
@@ -0,0 +1,17 @@
+from django.conf import settings
+
+
+def configure_connection(sender, connection, **kwargs):
+    """connection_created handler running ``PRAGMA name = value`` for each
+    entry of settings.SQLITE_PRAGMAS on every new SQLite connection.
+
+    Pragmas such as synchronous, cache_size and busy_timeout only last as long
+    as the connection, so they have to be set each time one is opened."""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', None)
+    if not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
@@ -0,0 +1,67 @@
+import hashlib
+
+from django.core.cache import cache
+from django.db import connection
+
+from catalog.cache import bump_version, get_versions
+from catalog.models import Author, Book, BookInstance, Genre
+
+# The home page counters are cached in each process, keyed on the page cache
+# versions of the counted models (see catalog/cache.py). The signal handlers
+# in catalog/signals.py bump those versions in the cache every process shares,
+# so a change made anywhere makes every process's snapshot stale; the timeout
+# is only a safety net for writes that bypass signals (bulk_create,
+# QuerySet.update, raw SQL) without calling invalidate_catalog_stats().
+CATALOG_STATS_CACHE_KEY = 'catalog:stats'
+CATALOG_STATS_MODELS = (Book, BookInstance, Author, Genre)
+CATALOG_STATS_TIMEOUT = 60 * 15
+
+
+def _counter_querysets():
+    """Return the querysets counted on the home page, keyed by context name."""
+    return {
+        'num_books': Book.objects.all(),
+        'num_instances': BookInstance.objects.all(),
+        # Available books (status = 'a')
+        'num_instances_available': BookInstance.objects.filter(status__exact='a'),
+        'num_authors': Author.objects.all(),
+        'num_genres': Genre.objects.all(),
+        'num_books_game': Book.objects.filter(title__contains='game'),
+    }
+
+
+def compute_catalog_stats():
+    """Count every home page counter in a single query.
+
+    Each queryset is compiled by the ORM and wrapped in a scalar COUNT(*)
+    subquery, so the database answers all of them in one round trip.
+    """
+    names, columns, params = [], [], []
+    for name, queryset in _counter_querysets().items():
+        sql, sql_params = queryset.order_by().values('pk').query.sql_with_params()
+        names.append(name)
+        columns.append(f'(SELECT COUNT(*) FROM ({sql}) counted_{name})')
+        params.extend(sql_params)
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT ' + ', '.join(columns), params)
+        row = cursor.fetchone()
+    return dict(zip(names, row))
+
+
+def get_catalog_stats():
+    """Return the home page counters, computing them only on a cache miss."""
+    versions = hashlib.md5(':'.join(get_versions(CATALOG_STATS_MODELS)).encode()).hexdigest()
+    key = f'{CATALOG_STATS_CACHE_KEY}:{versions}'
+    stats = cache.get(key)
+    if stats is None:
+        stats = compute_catalog_stats()
+        cache.set(key, stats, CATALOG_STATS_TIMEOUT)
+    return stats
+
+
+def invalidate_catalog_stats():
+    """Make the cached counters of every process stale, after changes that
+    sent no signals, so the next home page hit recomputes them."""
+    for model in CATALOG_STATS_MODELS:
+        bump_version(model)
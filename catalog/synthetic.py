@@ -0,0 +1,120 @@
+import datetime
+import random
+import uuid
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from catalog.availability import rebuild_availability
+from catalog.models import Author, Book, BookInstance, Genre, Language
+from catalog.search import rebuild_search_index
+from catalog.stats import invalidate_catalog_stats
+
+# Share of copies in each loan status, roughly what a busy branch looks like
+STATUS_WEIGHTS = (('a', 50), ('o', 30), ('r', 10), ('m', 10))
+
+WORDS = (
+    'game', 'kings', 'silent', 'river', 'shadow', 'winter', 'garden', 'night',
+    'empire', 'house', 'stone', 'glass', 'storm', 'city', 'island', 'fire',
+    'letters', 'voyage', 'memory', 'crown', 'forest', 'machine', 'ocean', 'wolf',
+)
+
+
+def generate_catalog(num_copies, num_books=None, num_authors=None, num_genres=20,
+                     num_languages=5, num_borrowers=None, batch_size=5000, seed=0,
+                     progress=None):
+    """Bulk-create a synthetic catalog with ``num_copies`` BookInstance rows.
+
+    The other table sizes default to a ratio of the copies (10 copies per book,
+    10 books per author, 100 loans per borrower). Rows are written with
+    bulk_create, so no model signals fire; the cached home page counters are
+    invalidated and the search table and per-book counters rebuilt once at
+    the end. The same seed always produces the same titles, statuses and due
+    dates. ``progress`` is called with (table name, rows written) after every
+    batch. Returns the row counts.
+    """
+    rng = random.Random(seed)
+    num_books = num_books or max(1, num_copies // 10)
+    num_authors = num_authors or max(1, num_books // 10)
+    num_borrowers = num_borrowers or max(1, num_copies // 100)
+    today = datetime.date.today()
+
+    def write(model, rows):
+        written = 0
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            with transaction.atomic():
+                model.objects.bulk_create(batch)
+            written += len(batch)
+            if progress:
+                progress(model._meta.db_table, written)
+
+    genres = [Genre(name=f'Genre {i}') for i in range(num_genres)]
+    write(Genre, genres)
+    languages = [Language(name=f'Language {i}') for i in range(num_languages)]
+    write(Language, languages)
+    write(Author, [
+        Author(first_name=rng.choice(WORDS).title(), last_name=f'{rng.choice(WORDS).title()} {i}')
+        for i in range(num_authors)
+    ])
+    write(User, [User(username=f'reader{i}', password='!') for i in range(num_borrowers)])
+
+    # Fetch the primary keys back, bulk_create only sets them on some backends
+    author_ids = list(Author.objects.values_list('id', flat=True))
+    language_ids = list(Language.objects.values_list('id', flat=True))
+    genre_ids = list(Genre.objects.values_list('id', flat=True))
+    borrower_ids = list(User.objects.filter(username__startswith='reader').values_list('id', flat=True))
+
+    write(Book, [
+        Book(
+            title=' '.join(rng.choice(WORDS) for _ in range(3)).capitalize(),
+            summary=' '.join(rng.choice(WORDS) for _ in range(30)),
+            isbn=f'{9780000000000 + i}',
+            author_id=rng.choice(author_ids),
+            language_id=rng.choice(language_ids),
+        )
+        for i in range(num_books)
+    ])
+    book_ids = list(Book.objects.values_list('id', flat=True))
+
+    through = Book.genre.through
+    write(through, [
+        through(book_id=book_id, genre_id=genre_id)
+        for book_id in book_ids
+        for genre_id in rng.sample(genre_ids, min(2, len(genre_ids)))
+    ])
+
+    statuses = [status for status, _ in STATUS_WEIGHTS]
+    weights = [weight for _, weight in STATUS_WEIGHTS]
+    # Copies are generated and written batch by batch to keep memory flat
+    written = 0
+    while written < num_copies:
+        batch = []
+        for _ in range(min(batch_size, num_copies - written)):
+            status = rng.choices(statuses, weights)[0]
+            on_loan = status == 'o'
+            batch.append(BookInstance(
+                id=uuid.UUID(int=rng.getrandbits(128), version=4),
+                book_id=rng.choice(book_ids),
+                imprint=f'Imprint {rng.randrange(100)}',
+                status=status,
+                due_back=today + datetime.timedelta(days=rng.randint(-30, 30)) if on_loan else None,
+                borrower_id=rng.choice(borrower_ids) if on_loan else None,
+            ))
+        with transaction.atomic():
+            BookInstance.objects.bulk_create(batch)
+        written += len(batch)
+        if progress:
+            progress(BookInstance._meta.db_table, written)
+
+    invalidate_catalog_stats()
+    rebuild_search_index()
+    rebuild_availability()
+    return {
+        'genres': num_genres,
+        'languages': num_languages,
+        'authors': num_authors,
+        'borrowers': num_borrowers,
+        'books': num_books,
+        'copies': num_copies,
+    }
@@ -0,0 +1,64 @@
+"""Tasks that views and admin actions run in the background (see catalog/jobs.py).
+
+Each one wraps an existing operation; arguments and return values are JSON.
+"""
+import datetime
+from io import StringIO
+
+from django.core.management import call_command
+
+from catalog import ledger, notices, recommendations
+from catalog.availability import rebuild_availability as recount_copies
+from catalog.jobs import task
+from catalog.models import Book, BookInstance
+from catalog.search import rebuild_search_index as reindex
+
+# Renewing more copies than this at once is left to a job
+RENEW_INLINE_LIMIT = 200
+
+
+@task()
+def renew_loans(copy_ids, renewal_date):
+    """Renew the copies on loan among ``copy_ids`` to ``renewal_date`` (ISO date)."""
+    return BookInstance.objects.filter(pk__in=copy_ids).renew(datetime.date.fromisoformat(renewal_date))
+
+
+@task(concurrency=1)
+def rebuild_availability(book_ids=None):
+    books = Book.objects.filter(pk__in=book_ids) if book_ids is not None else None
+    return recount_copies(books)
+
+
+@task(concurrency=1)
+def rebuild_search_index():
+    reindex()
+
+
+@task(concurrency=1)
+def rebuild_loan_rollups():
+    return ledger.rebuild_rollups()
+
+
+@task(concurrency=1)
+def build_recommendations(top_k=recommendations.RECOMMENDATIONS_TOP_K):
+    return recommendations.rebuild_recommendations(top_k)
+
+
+# One run at a time: two would send the same notices before either records them
+@task(max_attempts=1, concurrency=1)
+def send_overdue_notices():
+    return notices.send_overdue_notices()
+
+
+# Imports and exports read and write files on the worker's machine
+@task(max_attempts=1, concurrency=1)
+def import_catalog(path, file_format=None):
+    out = StringIO()
+    call_command('import_catalog', path, format=file_format, stdout=out)
+    return out.getvalue()
+
+
+@task(concurrency=2)
+def export_catalog(dataset, output, file_format='csv', gzip=False):
+    call_command('export_catalog', dataset, format=file_format, gzip=gzip, output=output, stderr=StringIO())
+    return output
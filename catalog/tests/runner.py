@@ -0,0 +1,23 @@
+import shutil
+import tempfile
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+from catalog.cache import isolated_caches
+
+
+class CatalogTestRunner(DiscoverRunner):
+    """Run the tests with caches of their own, so the pages and versions they
+    write never reach a server running from the same checkout."""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_dir = tempfile.mkdtemp(prefix='catalog-test-cache-')
+        self.caches_override = override_settings(CACHES=isolated_caches(self.cache_dir))
+        self.caches_override.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.caches_override.disable()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
@@ -0,0 +1,94 @@
+import datetime
+
+from django.test import TestCase
+from django.urls import reverse
+
+from catalog.models import Author, Book, BookInstance, Genre
+from catalog.pagination import encode_cursor
+
+
+class CatalogApiTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(first_name='John', last_name='Smith')
+        cls.fantasy = Genre.objects.create(name='Fantasy')
+        cls.poetry = Genre.objects.create(name='Poetry')
+        cls.book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG', author=cls.author)
+        cls.book.genre.set([cls.fantasy, cls.poetry])
+        cls.orphan = Book.objects.create(title='No author', summary='Summary', isbn='HIJKLMN')
+        cls.copy = BookInstance.objects.create(book=cls.book, imprint='Imprint', status='o',
+                                               due_back=datetime.date(2030, 1, 1))
+        BookInstance.objects.create(book=cls.book, imprint='Imprint', status='a')
+
+    def get(self, resource, **params):
+        return self.client.get(reverse('api', args=[resource]), params)
+
+    def test_books_default_fields(self):
+        response = self.get('books')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'next': None, 'results': [
+            {'id': self.book.id, 'title': 'Book',
+             'author': {'id': self.author.id, 'first_name': 'John', 'last_name': 'Smith'},
+             'availability': {'total': 2, 'available': 1, 'on_loan': 1, 'reserved': 0, 'maintenance': 0}},
+            {'id': self.orphan.id, 'title': 'No author', 'author': None,
+             'availability': {'total': 0, 'available': 0, 'on_loan': 0, 'reserved': 0, 'maintenance': 0}},
+        ]})
+
+    def test_field_selection(self):
+        response = self.get('books', fields='isbn,genres', ids=str(self.book.id))
+        self.assertEqual(response.json()['results'], [
+            {'id': self.book.id, 'isbn': 'ABCDEFG',
+             'genres': [{'id': self.fantasy.id, 'name': 'Fantasy'}, {'id': self.poetry.id, 'name': 'Poetry'}]},
+        ])
+        self.assertEqual(self.get('books', fields='title,borrower').status_code, 400)
+
+    def test_batch_by_ids(self):
+        response = self.get('books', ids=f'{self.orphan.id},{self.book.id},999', fields='title')
+        body = response.json()
+        self.assertEqual([book['id'] for book in body['results']], [self.book.id, self.orphan.id])
+        self.assertEqual(body['missing'], [999])
+        self.assertEqual(self.get('books', ids='one,two').status_code, 400)
+        # Ids no database integer can hold
+        response = self.get('books', ids='1000000000000000000000000000000')
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'Invalid book id.'}))
+        self.assertEqual(self.get('copies', book=str(2 ** 63)).status_code, 400)
+
+    def test_keyset_pagination(self):
+        first = self.get('genres', limit=1).json()
+        self.assertEqual(first['results'], [{'id': self.fantasy.id, 'name': 'Fantasy'}])
+        second = self.client.get(first['next']).json()
+        self.assertEqual(second, {'next': None, 'results': [{'id': self.poetry.id, 'name': 'Poetry'}]})
+        self.assertEqual(self.get('genres', limit=501).status_code, 400)
+        response = self.get('genres', cursor='nonsense')
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'Invalid cursor.'}))
+        # A cursor of another listing, with two values
+        self.assertEqual(self.get('genres', cursor=encode_cursor(['Fantasy', 1], 'next', 2)).status_code, 400)
+        for value in ['Fantasy', [1], 10 ** 30]:
+            response = self.get('genres', cursor=encode_cursor([value], 'next', 2))
+            self.assertEqual((response.status_code, response.json()), (400, {'error': 'Invalid cursor.'}))
+
+    def test_copies_of_a_book(self):
+        response = self.get('copies', book=str(self.book.id), fields='status,due_back')
+        copies = {copy['id']: copy for copy in response.json()['results']}
+        self.assertEqual(copies[str(self.copy.id)], {'id': str(self.copy.id), 'status': 'o', 'due_back': '2030-01-01'})
+        self.assertEqual(len(copies), 2)
+        self.assertEqual(self.get('copies', ids=str(self.copy.id)).json()['results'][0]['book'], self.book.id)
+
+    def test_unknown_resource(self):
+        self.assertEqual(self.get('users').status_code, 404)
+
+    def test_500_books_in_a_fixed_number_of_queries(self):
+        Book.objects.bulk_create([
+            Book(title=f'Book {i}', summary='Summary', isbn=f'{i:013}', author=self.author) for i in range(500)])
+        through = Book.genre.through
+        through.objects.bulk_create([through(book_id=book_id, genre_id=self.fantasy.id)
+                                     for book_id in Book.objects.values_list('id', flat=True)[2:]])
+        ids = ','.join(str(book_id) for book_id in Book.objects.values_list('id', flat=True)[:500])
+        # One query for the books with their authors and counters, one for the genres
+        with self.assertNumQueries(2):
+            response = self.get('books', ids=ids, fields='title,author,availability,genres')
+        self.assertEqual(len(response.json()['results']), 500)
+        with self.assertNumQueries(2):
+            response = self.get('books', limit=500, fields='title,author,availability,genres')
+        self.assertEqual(len(response.json()['results']), 500)
+        self.assertIsNotNone(response.json()['next'])
@@ -0,0 +1,338 @@
+import datetime
+import gzip
+import json
+import os
+import random
+import signal
+import tempfile
+import time
+import unittest
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver, reverse
+
+from catalog import benchmarks, jobs, ledger, recommendations
+from catalog.management.commands import run_workers
+from catalog.models import Author, Book, BookInstance, Genre, Job, Language, LoanEvent, OverdueNotice, RelatedBook
+from catalog.synthetic import generate_catalog
+
+class ImportCatalogCommandTest(TestCase):
+    def write(self, suffix, content):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_import_csv(self):
+        path = self.write('.csv', (
+            'title,isbn,author_first_name,author_last_name,language,genres,copies,status\n'
+            'Earthsea,111,Ursula,Le Guin,English,Fantasy;Classic,3,a\n'
+            'Dispossessed,222,Ursula,Le Guin,English,Science Fiction,1,m\n'
+            'Earthsea,111,,,,,2,o\n'
+        ))
+        call_command('import_catalog', path, chunk_size=2, stdout=StringIO())
+        self.assertEqual(Book.objects.count(), 2)
+        self.assertEqual(Author.objects.count(), 1)
+        self.assertEqual(Language.objects.count(), 1)
+        self.assertEqual(Genre.objects.count(), 3)
+        earthsea = Book.objects.get(isbn='111')
+        self.assertEqual(sorted(earthsea.genre.values_list('name', flat=True)), ['Classic', 'Fantasy'])
+        # Copies of the same ISBN in a later chunk go to the same book, and the
+        # availability counters are kept up to date
+        self.assertEqual((earthsea.copies_total, earthsea.copies_available, earthsea.copies_on_loan), (5, 3, 2))
+        self.assertEqual(BookInstance.objects.count(), 6)
+
+    def test_import_jsonl_into_existing_catalog(self):
+        author = Author.objects.create(first_name='Ursula', last_name='Le Guin')
+        Book.objects.create(title='Earthsea', isbn='111', summary='Summary', author=author)
+        path = self.write('.jsonl', '\n'.join(json.dumps(row) for row in [
+            {'title': 'Earthsea', 'isbn': '111', 'copies': 2},
+            {'title': 'Lathe of Heaven', 'isbn': '333', 'author_first_name': 'Ursula',
+             'author_last_name': 'Le Guin', 'genres': ['Fantasy'], 'copies': 0},
+        ]))
+        call_command('import_catalog', path, stdout=StringIO())
+        self.assertEqual(Author.objects.count(), 1)
+        self.assertEqual(Book.objects.get(isbn='111').bookinstance_set.count(), 2)
+        self.assertEqual(Book.objects.get(isbn='333').author, author)
+
+    def test_cached_pages_show_the_import(self):
+        book = Book.objects.create(title='Earthsea', isbn='111', summary='Summary')
+        url = reverse('books')
+        first = self.client.get(url)
+        self.assertContains(first, '0 of 0 available')
+        book.refresh_from_db()
+        path = self.write('.csv', 'title,isbn,copies\nEarthsea,111,3\n')
+        call_command('import_catalog', path, stdout=StringIO())
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertContains(response, '3 of 3 available')
+        self.assertGreater(Book.objects.get(pk=book.pk).updated_at, book.updated_at)
+
+    def test_invalid_row_reports_line(self):
+        path = self.write('.csv', 'title,isbn,status\nEarthsea,111,x\n')
+        with self.assertRaisesMessage(CommandError, 'Line 2: unknown status'):
+            call_command('import_catalog', path, stdout=StringIO())
+        path = self.write('.jsonl', '{"title": "Earthsea", "isbn": "111"}\n[1, 2]\n')
+        with self.assertRaisesMessage(CommandError, 'Line 2: expected a JSON object.'):
+            call_command('import_catalog', path, stdout=StringIO())
+
+    def test_chunk_size_must_be_positive(self):
+        path = self.write('.csv', 'title,isbn\nEarthsea,111\n')
+        with self.assertRaisesMessage(CommandError, '--chunk-size must be at least 1.'):
+            call_command('import_catalog', path, chunk_size=0, stdout=StringIO())
+
+    def test_only_the_chunks_books_are_looked_up(self):
+        for i in range(5):
+            Book.objects.create(title=f'Book {i}', isbn=f'00{i}', summary='Summary')
+        path = self.write('.csv', 'title,isbn\nEarthsea,111\nBook 1,001\n')
+        with CaptureQueriesContext(connection) as queries:
+            call_command('import_catalog', path, chunk_size=1, stdout=StringIO())
+        # Memory stays flat however big the catalog: never a read of every ISBN
+        self.assertFalse([query['sql'] for query in queries
+                          if query['sql'].startswith('SELECT') and 'FROM "catalog_book"' in query['sql']
+                          and 'WHERE' not in query['sql']])
+        self.assertEqual(Book.objects.get(isbn='001').bookinstance_set.count(), 1)
+
+class ExportCatalogTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(first_name='Ursula', last_name='Le Guin')
+        book = Book.objects.create(title='Earthsea', isbn='111', summary='Summary', author=author)
+        cls.copy = BookInstance.objects.create(book=book, imprint='Imprint', status='a')
+
+    def test_command_writes_csv(self):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        call_command('export_catalog', 'copies', output=path, stderr=StringIO())
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'id,book_id,book__title,imprint,status,due_back,borrower_id,borrower__username')
+        self.assertEqual(lines[1], f'{self.copy.id},{self.copy.book_id},Earthsea,Imprint,a,,,')
+
+    def test_command_writes_gzipped_jsonl(self):
+        fd, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        call_command('export_catalog', 'authors', format='jsonl', gzip=True, output=path, stderr=StringIO())
+        with gzip.open(path, 'rt') as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['last_name'], 'Le Guin')
+        self.assertIsNone(rows[0]['date_of_birth'])
+
+    def test_view_streams_for_librarians_only(self):
+        url = reverse('export-catalog', args=['books'])
+        self.assertEqual(self.client.get(url).status_code, 302)
+        User.objects.create_superuser(username='librarian', password='1X<ISRUkw+tuK')
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        response = self.client.get(url, {'format': 'jsonl'})
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(rows[0]['title'], 'Earthsea')
+        self.assertEqual(rows[0]['copies_available'], 1)
+        self.assertEqual(self.client.get(reverse('export-catalog', args=['users'])).status_code, 404)
+
+
+class BuildRecommendationsCommandTest(TestCase):
+    def setUp(self):
+        self.books = [Book.objects.create(title=f'Book {i}', summary='Summary', isbn=f'{i}') for i in range(4)]
+        self.patrons = [User.objects.create_user(username=f'patron{i}') for i in range(4)]
+
+    def borrow(self, patron, *books):
+        with ledger.batch():
+            for book in books:
+                ledger.record(LoanEvent.CHECKOUT, book.pk, patron.pk)
+
+    def test_related_books_are_stored_and_shown(self):
+        first, second, third, popular = self.books
+        # Everyone borrows the popular book; first and second go together
+        self.borrow(self.patrons[0], first, second, popular)
+        self.borrow(self.patrons[1], first, second, popular)
+        # Borrowing a book twice counts once
+        self.borrow(self.patrons[2], first, third, popular, popular)
+        self.borrow(self.patrons[3], popular)
+        out = StringIO()
+        call_command('build_recommendations', top_k=2, stdout=out)
+        self.assertIn('Stored', out.getvalue())
+        related = [(row.related, row.co_borrowers) for row in RelatedBook.objects.filter(book=first)]
+        # popular: 3 / sqrt(3 * 4), second: 2 / sqrt(3 * 2), third: 1 / sqrt(3 * 1)
+        self.assertEqual(related, [(popular, 3), (second, 2)])
+        self.assertAlmostEqual(RelatedBook.objects.get(book=first, rank=1).score, 2 / 6 ** 0.5)
+        self.assertEqual(RelatedBook.objects.filter(book=popular).count(), 2)
+
+        # The detail page reads the table with one query, and a rebuild shows on the cached page
+        response = self.client.get(reverse('book-detail', args=[first.pk]))
+        self.assertEqual([row.related for row in response.context['related_books']], [popular, second])
+        self.assertContains(response, 'Readers also borrowed')
+        self.borrow(self.patrons[3], third, first)
+        recommendations.rebuild_recommendations(top_k=1)
+        response = self.client.get(reverse('book-detail', args=[third.pk]))
+        self.assertEqual([row.related for row in response.context['related_books']], [first])
+
+    def test_patrons_borrowing_too_much_are_left_out(self):
+        # Patron 1 borrowed every book: only patron 0 counts
+        pairs = [(0, 1), (0, 2), (1, 1), (1, 2), (1, 3), (1, 4)]
+        related = list(recommendations._related_python(pairs, 5, max_books=3))
+        self.assertEqual([(book, other, count) for book, other, _, count, _ in related], [(1, 2, 1), (2, 1, 1)])
+        self.assertEqual(len(list(recommendations._related_python(pairs, 5, max_books=4))), 12)
+
+    @unittest.skipIf(recommendations.numpy is None, 'NumPy and SciPy are not installed')
+    def test_sparse_and_python_results_agree(self):
+        rng = random.Random(0)
+        pairs = {(rng.randrange(200), rng.randrange(100)) for _ in range(3000)}
+        self.assertEqual(sorted(recommendations._related_sparse(pairs, 5)),
+                         sorted(recommendations._related_python(pairs, 5)))
+        # Including which patrons are left out
+        self.assertEqual(sorted(recommendations._related_sparse(pairs, 5, max_books=15)),
+                         sorted(recommendations._related_python(pairs, 5, max_books=15)))
+
+
+class BenchmarkUrlsTest(TestCase):
+    def test_every_catalog_url_has_a_case(self):
+        names = {pattern.name for pattern in get_resolver('catalog.urls').url_patterns}
+        self.assertEqual(names, set(benchmarks.URL_CASES))
+
+    def test_every_case_renders_on_a_synthetic_catalog(self):
+        generate_catalog(300, num_books=30)
+        results = benchmarks.run(runs=1)
+        self.assertEqual({name: result['status'] for name, result in results.items()},
+                         {name: 200 for name, case in benchmarks.URL_CASES.items() if not isinstance(case, str)})
+        self.assertTrue(all(result['queries'] >= 1 and result['peak_kb'] > 0 for result in results.values()))
+
+    def test_compare_flags_regressions_beyond_tolerance(self):
+        baseline = {'books': {'status': 200, 'queries': 2, 'median_ms': 10, 'peak_kb': 100}}
+        same = {'books': {'status': 200, 'queries': 2, 'median_ms': 13, 'peak_kb': 150}}
+        self.assertEqual(benchmarks.compare(same, baseline, 0.25), [])
+        worse = {'books': {'status': 500, 'queries': 3, 'median_ms': 20, 'peak_kb': 400}}
+        self.assertEqual(len(benchmarks.compare(worse, baseline, 0.25)), 4)
+
+
+class SendOverdueNoticesCommandTest(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Earthsea', summary='Summary', isbn='111')
+        self.today = datetime.date.today()
+        self.late = self.today - datetime.timedelta(days=3)
+        self.ann = User.objects.create_user(username='ann', email='ann@example.com', first_name='Ann')
+        self.bob = User.objects.create_user(username='bob', email='bob@example.com')
+        self.nomail = User.objects.create_user(username='nomail')
+        self.loans = [self.lend(self.ann, self.late), self.lend(self.ann, self.late), self.lend(self.bob, self.late),
+                      self.lend(self.nomail, self.late)]
+        # Not overdue
+        self.lend(self.bob, self.today)
+
+    def lend(self, borrower, due_back):
+        return BookInstance.objects.create(book=self.book, imprint='Imprint', status='o', borrower=borrower,
+                                           due_back=due_back)
+
+    def send(self, **options):
+        out = StringIO()
+        call_command('send_overdue_notices', stdout=out, **options)
+        return out.getvalue()
+
+    def test_one_notice_per_borrower_once(self):
+        output = self.send(batch_size=1)
+        self.assertIn('Sent 2 notices covering 3 overdue loans', output)
+        self.assertIn('1 borrowers have no e-mail address', output)
+        messages = {message.to[0]: message for message in mail.outbox}
+        self.assertEqual(set(messages), {'ann@example.com', 'bob@example.com'})
+        self.assertIn('Dear Ann', messages['ann@example.com'].body)
+        self.assertEqual(messages['ann@example.com'].body.count('Earthsea (Imprint)'), 2)
+        self.assertEqual(OverdueNotice.objects.count(), 3)
+
+        # Idempotent: nothing new to send
+        self.assertIn('Sent 0 notices', self.send())
+        self.assertEqual(len(mail.outbox), 2)
+
+        # A renewed loan that becomes overdue again gets a new notice
+        BookInstance.objects.filter(pk=self.loans[2].pk).update(due_back=self.late + datetime.timedelta(days=1))
+        self.send()
+        self.assertEqual([message.to for message in mail.outbox[2:]], [['bob@example.com']])
+
+    def test_dry_run_sends_and_records_nothing(self):
+        self.assertIn('Would send 2 notices covering 3 overdue loans', self.send(dry_run=True))
+        self.assertEqual(mail.outbox, [])
+        self.assertFalse(OverdueNotice.objects.exists())
+
+    def test_queries_per_batch_not_per_loan(self):
+        for _ in range(20):
+            self.lend(self.bob, self.late)
+        # One borrower per batch: their id, their loans and the INSERT in a
+        # savepoint (no INSERT for the one without e-mail), then the empty
+        # query that ends the run; however many loans each has
+        with self.assertNumQueries(5 + 5 + 2 + 1):
+            self.send(batch_size=1)
+        self.assertEqual(len(mail.outbox), 2)
+
+
+class RunWorkersCommandTest(TransactionTestCase):
+    def test_drain_runs_every_queued_job(self):
+        book = Book.objects.create(title='Earthsea', summary='Summary', isbn='111')
+        BookInstance.objects.create(book=book, status='a')
+        Book.objects.filter(pk=book.pk).update(copies_total=0, copies_available=0)
+        librarian = User.objects.create_user(username='librarian')
+        queued = [jobs.enqueue('rebuild_availability', user=librarian, book_ids=[book.pk]),
+                  jobs.enqueue('rebuild_loan_rollups')]
+        out = StringIO()
+        # One worker: the in-memory test database has a single writer at a time
+        # and no busy timeout, so concurrent tasks would fail and wait for a retry
+        call_command('run_workers', workers=1, drain=True, poll=0.01, stdout=out)
+        self.assertIn('Running 1 workers (threads)', out.getvalue())
+        self.assertEqual(list(Job.objects.filter(pk__in=[job.pk for job in queued]).values_list('status', flat=True)),
+                         ['d', 'd'])
+        book.refresh_from_db()
+        self.assertEqual((book.copies_total, book.copies_available), (1, 1))
+
+    def register_slow_task(self):
+        patcher = mock.patch.dict(jobs.TASKS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        @jobs.task(name='slow')
+        def slow():
+            time.sleep(0.3)
+
+    def test_running_jobs_give_heartbeats(self):
+        self.register_slow_task()
+        job = jobs.enqueue('slow')
+        with mock.patch('catalog.jobs.JOB_HEARTBEAT', datetime.timedelta(milliseconds=20)):
+            job = jobs.run_next('worker')
+        self.assertEqual(job.status, 'd')
+        job.refresh_from_db()
+        self.assertGreater(job.heartbeat_at, job.started_at)
+
+    def test_stale_jobs_are_looked_for_while_running(self):
+        self.register_slow_task()
+        jobs.enqueue('slow')
+        with mock.patch('catalog.jobs.JOB_STALE_CHECK', datetime.timedelta(milliseconds=50)), \
+                mock.patch('catalog.jobs.requeue_stale', return_value=(0, 0)) as requeue_stale:
+            call_command('run_workers', workers=1, drain=True, poll=0.01, stdout=StringIO())
+        # Once at the start, then while the job ran
+        self.assertGreater(requeue_stale.call_count, 2)
+
+    def test_worker_processes_ignore_ctrl_c(self):
+        # Ctrl-C is sent to the children too: they must keep running their job
+        # and only stop through the parent's stop event
+        self.addCleanup(signal.signal, signal.SIGINT, signal.getsignal(signal.SIGINT))
+        # As in a process started from a terminal
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        done = []
+
+        def work(worker, stop, *args):
+            try:
+                os.kill(os.getpid(), signal.SIGINT)
+            except KeyboardInterrupt:
+                self.fail('Ctrl-C interrupted the running job')
+            done.append(worker)
+            return 1
+
+        with mock.patch('catalog.jobs.work', work):
+            self.assertEqual(run_workers.process_worker('worker', None), 1)
+        self.assertEqual(done, ['worker'])
@@ -0,0 +1,30 @@
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import TestCase, override_settings
+
+from catalog.sqlite import configure_connection
+
+
+class SqlitePragmasTest(TestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_handler_connected(self):
+        self.assertIn(configure_connection, [receiver() for _, receiver in connection_created.receivers])
+
+    def test_pragmas_applied(self):
+        old = {name: self.pragma(name) for name in ('cache_size', 'busy_timeout')}
+        try:
+            with override_settings(SQLITE_PRAGMAS={'cache_size': -1234, 'busy_timeout': 4321}):
+                configure_connection(sender=connection.__class__, connection=connection)
+            self.assertEqual(self.pragma('cache_size'), -1234)
+            self.assertEqual(self.pragma('busy_timeout'), 4321)
+        finally:
+            with override_settings(SQLITE_PRAGMAS=old):
+                configure_connection(sender=connection.__class__, connection=connection)
+
+    def test_nothing_by_default(self):
+        with self.assertNumQueries(0):
+            configure_connection(sender=connection.__class__, connection=connection)
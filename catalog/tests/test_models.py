@@ -1,5 +1,21 @@
-from django.test import TestCase
-from catalog.models import Author
+import datetime
+import random
+import threading
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection, connections
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from catalog import holds, jobs, ledger, loans
+from catalog.availability import rebuild_availability
+from catalog.cache import get_versions
+from catalog.forms import BookInstanceAdminForm
+from catalog.models import (Author, Book, BookInstance, BookMonthlyLoans, CopyChanged, Hold, Job, LoanEvent,
+                            PatronMonthlyActivity)
+from catalog.synthetic import generate_catalog
 
 # Create your tests here
 class AuthorTestClass(TestCase):
@@ -39,4 +55,467 @@ class AuthorTestClass(TestCase):
     def test_get_absolute_url(self):
         author = Author.objects.get(id=1)
         # This will also fail if the urlconf is not defined.
-        self.assertEquals(author.get_absolute_url(), '/catalog/author/1')
\ No newline at end of file
+        self.assertEquals(author.get_absolute_url(), '/catalog/author/1')
+
+
+class SyntheticCatalogTest(TestCase):
+    def test_generate_catalog_row_counts(self):
+        counts = generate_catalog(200, batch_size=50)
+        self.assertEqual(BookInstance.objects.count(), counts['copies'])
+        self.assertEqual(Book.objects.count(), counts['books'])
+        self.assertEqual(Author.objects.count(), counts['authors'])
+        # Only copies on loan have a borrower and a due date
+        self.assertFalse(BookInstance.objects.exclude(status='o').filter(borrower__isnull=False).exists())
+        self.assertFalse(BookInstance.objects.filter(status='o', due_back__isnull=True).exists())
+
+
+class BookAvailabilityCountersTest(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG')
+        self.other = Book.objects.create(title='Other', summary='Summary', isbn='ABCDEFG')
+
+    def counters(self, book):
+        book.refresh_from_db()
+        return (book.copies_total, book.copies_available, book.copies_on_loan,
+                book.copies_reserved, book.copies_maintenance)
+
+    def test_counters_follow_copy_changes(self):
+        copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+        BookInstance.objects.create(book=self.book, imprint='Imprint', status='m')
+        self.assertEqual(self.counters(self.book), (2, 1, 0, 0, 1))
+
+        copy.status = 'o'
+        copy.save()
+        self.assertEqual(self.counters(self.book), (2, 0, 1, 0, 1))
+
+        copy.book = self.other
+        copy.save()
+        self.assertEqual(self.counters(self.book), (1, 0, 0, 0, 1))
+        self.assertEqual(self.counters(self.other), (1, 0, 1, 0, 0))
+
+        copy.delete()
+        self.assertEqual(self.counters(self.other), (0, 0, 0, 0, 0))
+
+    def test_save_without_book_or_status_skips_lookup(self):
+        copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+        copy.imprint = 'New imprint'
+        # The version check and the save itself, in a savepoint, plus nothing
+        # else: no lookup of the old row, no counter update
+        with CaptureQueriesContext(connection) as queries:
+            copy.save(update_fields=['imprint'])
+        statements = [query['sql'].split()[0] for query in queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(statements, ['UPDATE', 'UPDATE'])
+
+    def test_rebuild_after_bulk_changes(self):
+        BookInstance.objects.bulk_create([
+            BookInstance(book=self.book, imprint='Imprint', status=status) for status in 'aaorm'
+        ])
+        self.assertEqual(self.counters(self.book), (0, 0, 0, 0, 0))
+        self.book.refresh_from_db()
+        updated_at, versions = self.book.updated_at, get_versions([Book])
+        rebuild_availability()
+        self.assertEqual(self.counters(self.book), (5, 2, 1, 1, 1))
+        self.assertEqual(self.counters(self.other), (0, 0, 0, 0, 0))
+        # The cached pages and conditional GETs see the new counts
+        self.book.refresh_from_db()
+        self.assertGreater(self.book.updated_at, updated_at)
+        self.assertNotEqual(get_versions([Book]), versions)
+
+
+class BookInstanceQuerySetTest(TestCase):
+    def setUp(self):
+        book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG')
+        today = datetime.date.today()
+        self.late = BookInstance.objects.create(book=book, status='o', due_back=today - datetime.timedelta(days=1))
+        self.due = BookInstance.objects.create(book=book, status='o', due_back=today)
+        self.returned = BookInstance.objects.create(book=book, status='a', due_back=today - datetime.timedelta(days=5))
+
+    def test_overdue_matches_is_overdue_for_loans(self):
+        self.assertEqual(list(BookInstance.objects.overdue()), [self.late])
+        self.assertTrue(self.late.is_overdue)
+        self.assertFalse(self.due.is_overdue)
+
+    def test_renew_is_one_update_and_skips_copies_not_on_loan(self):
+        renewal_date = datetime.date.today() + datetime.timedelta(weeks=2)
+        with CaptureQueriesContext(connection) as queries:
+            renewed = BookInstance.objects.all().renew(renewal_date)
+        self.assertEqual(renewed, 2)
+        # One UPDATE of the copies, and both renewals appended to the ledger with one INSERT
+        statements = [query['sql'].split(' ', 3)[:3] for query in queries]
+        self.assertEqual(statements.count(['UPDATE', '"catalog_bookinstance"', 'SET']), 1)
+        self.assertEqual(statements.count(['INSERT', 'INTO', '"catalog_loanevent"']), 1)
+        self.assertEqual(LoanEvent.objects.filter(kind=LoanEvent.RENEWAL, due_back=renewal_date).count(), 2)
+        self.assertFalse(BookInstance.objects.overdue().exists())
+        self.returned.refresh_from_db()
+        self.assertNotEqual(self.returned.due_back, renewal_date)
+
+
+class HoldQueueTest(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG')
+        self.copy = BookInstance.objects.create(book=self.book, status='o', due_back=datetime.date.today())
+        self.patrons = [User.objects.create_user(username=f'patron{i}') for i in range(3)]
+
+    def counters(self):
+        self.book.refresh_from_db()
+        return self.book.copies_available, self.book.copies_reserved
+
+    def test_returned_copy_goes_to_the_first_in_line(self):
+        first, second, _ = [holds.place_hold(self.book, patron) for patron in self.patrons]
+        self.assertEqual([holds.queue_position(first), holds.queue_position(second)], [1, 2])
+        self.copy.status = 'a'
+        self.copy.save()
+        first.refresh_from_db()
+        self.copy.refresh_from_db()
+        self.assertEqual((first.status, first.copy_id, self.copy.status), ('r', self.copy.id, 'r'))
+        self.assertEqual(self.counters(), (0, 1))
+        second.refresh_from_db()
+        self.assertEqual(holds.queue_position(second), 1)
+
+    def test_copy_set_aside_on_save_can_be_saved_again(self):
+        holds.place_hold(self.book, self.patrons[0])
+        self.copy.status = 'a'
+        self.copy.save()
+        self.assertEqual(self.copy.status, 'r')
+        self.copy.imprint = 'New imprint'
+        self.copy.save()
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.imprint), ('r', 'New imprint'))
+
+    def test_hold_on_an_available_copy_is_ready_at_once(self):
+        self.copy.status = 'a'
+        self.copy.save()
+        hold = holds.place_hold(self.book, self.patrons[0])
+        self.assertEqual(hold.status, 'r')
+        # Placing it again gives back the same hold
+        self.assertEqual(holds.place_hold(self.book, self.patrons[0]), hold)
+
+    def test_copy_is_only_allocated_once(self):
+        for patron in self.patrons:
+            holds.place_hold(self.book, patron)
+        BookInstance.objects.filter(pk=self.copy.pk).update(status='a')
+        self.assertIsNotNone(holds.allocate_copy(self.copy.pk))
+        # A second, concurrent return of the same copy finds it already set aside
+        self.assertIsNone(holds.allocate_copy(self.copy.pk))
+        self.assertEqual(Hold.objects.filter(status='r').count(), 1)
+
+    def test_cancelling_a_ready_hold_passes_the_copy_on(self):
+        first, second, _ = [holds.place_hold(self.book, patron) for patron in self.patrons]
+        self.copy.status = 'a'
+        self.copy.save()
+        first.refresh_from_db()
+        self.assertTrue(holds.cancel_hold(first))
+        second.refresh_from_db()
+        self.assertEqual((second.status, second.copy_id), ('r', self.copy.id))
+        self.assertFalse(holds.cancel_hold(first))
+
+    def test_next_in_line_is_an_index_seek(self):
+        patrons = User.objects.bulk_create([User(username=f'reader{i}') for i in range(2000)])
+        patrons = User.objects.filter(username__startswith='reader')
+        Hold.objects.bulk_create([Hold(book=self.book, patron=patron) for patron in patrons])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        plan = holds.waiting(self.book.pk).values_list('pk', flat=True)[:1].explain()
+        self.assertIn('hold_queue_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+        BookInstance.objects.filter(pk=self.copy.pk).update(status='a')
+        # The same statements (and savepoints) however long the queue is
+        with self.assertNumQueries(10):
+            holds.allocate_copy(self.copy.pk)
+
+
+class LoanTransitionTest(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG')
+        self.copy = BookInstance.objects.create(book=self.book, status='a')
+        self.patron = User.objects.create_user(username='patron')
+        self.other = User.objects.create_user(username='other')
+
+    def test_checkout_return_renew(self):
+        version = loans.checkout(self.copy.pk, self.patron)
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrower, self.copy.version), ('o', self.patron, version))
+        due = datetime.date.today() + datetime.timedelta(weeks=4)
+        version = loans.renew(self.copy.pk, due, expected_version=version)
+        version = loans.return_copy(self.copy.pk, expected_version=version)
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrower, self.copy.due_back, self.copy.version),
+                         ('a', None, None, version))
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.copies_available, self.book.copies_on_loan), (1, 0))
+
+    def test_stale_version_is_refused(self):
+        version = self.copy.version
+        loans.checkout(self.copy.pk, self.patron, expected_version=version)
+        with self.assertRaises(loans.LoanError):
+            loans.return_copy(self.copy.pk, expected_version=version)
+        with self.assertRaises(loans.LoanError):
+            loans.checkout(self.copy.pk, self.other)
+
+    def test_reserved_copy_only_goes_to_its_patron(self):
+        loans.checkout(self.copy.pk, self.other)
+        hold = holds.place_hold(self.book, self.patron)
+        loans.return_copy(self.copy.pk)
+        with self.assertRaises(loans.LoanError):
+            loans.checkout(self.copy.pk, self.other)
+        loans.checkout(self.copy.pk, self.patron)
+        hold.refresh_from_db()
+        self.assertEqual(hold.status, 'f')
+
+    def test_admin_saves_are_versioned(self):
+        self.copy.imprint = 'New imprint'
+        self.copy.save()
+        self.copy.save(update_fields=['imprint'])
+        self.copy.refresh_from_db()
+        self.assertEqual(self.copy.version, 2)
+
+    def test_stale_save_is_refused(self):
+        # E.g. an admin form opened before the checkout
+        stale = BookInstance.objects.get(pk=self.copy.pk)
+        version = loans.checkout(self.copy.pk, self.patron)
+        stale.status = 'm'
+        with self.assertRaises(CopyChanged):
+            stale.save()
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrower, self.copy.version), ('o', self.patron, version))
+        # The version the checkout returned still describes the copy
+        loans.return_copy(self.copy.pk, expected_version=version)
+
+    def test_admin_form_refuses_stale_copy(self):
+        form = BookInstanceAdminForm(instance=self.copy)
+        data = {'book': self.book.pk, 'imprint': 'Imprint', 'status': 'm', 'id': self.copy.pk,
+                'seen_version': form.fields['seen_version'].initial}
+        loans.checkout(self.copy.pk, self.patron)
+        form = BookInstanceAdminForm(data, instance=BookInstance.objects.get(pk=self.copy.pk))
+        self.assertFalse(form.is_valid())
+        self.assertIn('changed by someone else', str(form.non_field_errors()))
+
+
+class LoanStressTest(TransactionTestCase):
+    """Librarians racing on a handful of copies from several threads."""
+    threads = 8
+    operations = 60
+
+    def test_concurrent_checkouts_never_double_lend(self):
+        book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG')
+        copies = [BookInstance.objects.create(book=book, status='a').pk for _ in range(3)]
+        patrons = [User.objects.create_user(username=f'patron{i}') for i in range(self.threads)]
+        successes = []
+        lock = threading.Lock()
+
+        def librarian(number):
+            rng = random.Random(number)
+            try:
+                for _ in range(self.operations):
+                    copy_id = rng.choice(copies)
+                    action = rng.choice(['checkout', 'return'])
+                    try:
+                        if action == 'checkout':
+                            version = loans.checkout(copy_id, patrons[number])
+                        else:
+                            version = loans.return_copy(copy_id)
+                    except (loans.LoanError, OperationalError):
+                        continue
+                    with lock:
+                        successes.append((copy_id, version, action))
+            finally:
+                connections.close_all()
+
+        workers = [threading.Thread(target=librarian, args=(number,)) for number in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertTrue(successes)
+        # Every successful change produced a distinct version of its copy, so no
+        # two librarians ever acted on the same state of a copy
+        self.assertEqual(len({(copy_id, version) for copy_id, version, _ in successes}), len(successes))
+        # Per copy, checkouts and returns alternate
+        for copy_id in copies:
+            actions = [action for c, version, action in sorted(successes, key=lambda s: s[1]) if c == copy_id]
+            self.assertTrue(all(a != b for a, b in zip(actions, actions[1:])), actions)
+            copy = BookInstance.objects.get(pk=copy_id)
+            self.assertEqual(copy.status, 'o' if actions and actions[-1] == 'checkout' else 'a')
+            self.assertEqual(copy.borrower_id is not None, copy.status == 'o')
+        # The counters kept up with every change
+        book.refresh_from_db()
+        counted = (book.copies_total, book.copies_available, book.copies_on_loan)
+        rebuild_availability()
+        book.refresh_from_db()
+        self.assertEqual(counted, (book.copies_total, book.copies_available, book.copies_on_loan))
+
+
+class LoanLedgerTest(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG')
+        self.copy = BookInstance.objects.create(book=self.book, status='a')
+        self.patron = User.objects.create_user(username='patron')
+        self.month = datetime.date.today().replace(day=1)
+
+    def rollups(self):
+        books = list(BookMonthlyLoans.objects.order_by('book_id', 'month').values_list('book_id', 'month', 'loans'))
+        patrons = list(PatronMonthlyActivity.objects.order_by('patron_id', 'month').values_list(
+            'patron_id', 'month', 'checkouts', 'renewals', 'returns'))
+        return books, patrons
+
+    def test_loans_are_recorded_and_rolled_up(self):
+        version = loans.checkout(self.copy.pk, self.patron)
+        version = loans.renew(self.copy.pk, datetime.date.today() + datetime.timedelta(weeks=4), version)
+        loans.return_copy(self.copy.pk, version)
+        loans.checkout(self.copy.pk, self.patron)
+        kinds = list(LoanEvent.objects.order_by('id').values_list('kind', 'book_id', 'patron_id'))
+        self.assertEqual(kinds, [(kind, self.book.pk, self.patron.pk) for kind in (
+            LoanEvent.CHECKOUT, LoanEvent.RENEWAL, LoanEvent.RETURN, LoanEvent.CHECKOUT)])
+        self.assertEqual(self.rollups(), ([(self.book.pk, self.month, 2)],
+                                          [(self.patron.pk, self.month, 2, 1, 1)]))
+        # The incremental rollups agree with recomputing them from the ledger
+        expected = self.rollups()
+        self.assertEqual(ledger.rebuild_rollups(), (1, 1))
+        self.assertEqual(self.rollups(), expected)
+
+    def test_saving_a_copy_records_loan_changes(self):
+        # As the admin change form does
+        self.copy.status, self.copy.borrower = 'o', self.patron
+        self.copy.due_back = datetime.date.today()
+        self.copy.save()
+        self.copy.due_back += datetime.timedelta(weeks=1)
+        self.copy.save()
+        self.copy.imprint = 'New imprint'
+        self.copy.save()
+        self.copy.status, self.copy.borrower, self.copy.due_back = 'a', None, None
+        self.copy.save()
+        self.assertEqual(list(LoanEvent.objects.order_by('id').values_list('kind', flat=True)),
+                         [LoanEvent.CHECKOUT, LoanEvent.RENEWAL, LoanEvent.RETURN])
+
+    def test_batch_is_one_insert(self):
+        other = Book.objects.create(title='Other', summary='Summary', isbn='HIJKLMN')
+        last_month = self.month - datetime.timedelta(days=1)
+        with CaptureQueriesContext(connection) as queries:
+            with ledger.batch():
+                for day in range(5):
+                    ledger.record(LoanEvent.CHECKOUT, self.book.pk, self.patron.pk, date=last_month)
+                ledger.record(LoanEvent.CHECKOUT, other.pk, None)
+                self.assertFalse(LoanEvent.objects.exists())
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "catalog_loanevent"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(LoanEvent.objects.count(), 6)
+        popular = [(row.book, row.loans) for row in ledger.popular_books(last_month)]
+        self.assertEqual(popular, [(self.book, 5)])
+        self.assertEqual([(row.book, row.loans) for row in ledger.popular_books(self.month)], [(other, 1)])
+        activity = [(row.month, row.checkouts) for row in ledger.patron_activity(self.patron.pk)]
+        self.assertEqual(activity, [(last_month.replace(day=1), 5)])
+
+    def test_reports_use_the_rollup_index(self):
+        plan = ledger.popular_books(self.month).explain()
+        self.assertIn('bookmonthlyloans_popular_idx', plan)
+        self.assertNotIn('catalog_loanevent', plan)
+
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        # Tasks registered here are gone after the test
+        patcher = mock.patch.dict(jobs.TASKS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calls = []
+
+        @jobs.task(name='add')
+        def add(a, b):
+            self.calls.append((a, b))
+            return a + b
+
+        @jobs.task(name='flaky', max_attempts=2)
+        def flaky():
+            raise ValueError('Broken')
+
+        @jobs.task(name='import', concurrency=1)
+        def single():
+            pass
+
+    def test_enqueue_claim_and_run(self):
+        user = User.objects.create_user(username='librarian')
+        job = jobs.enqueue('add', user=user, a=1, b=2)
+        self.assertEqual((job.status, job.created_by, job.max_attempts), ('q', user, 3))
+        claimed = jobs.claim('worker-1')
+        self.assertEqual((claimed.pk, claimed.status, claimed.attempts, claimed.worker), (job.pk, 'r', 1, 'worker-1'))
+        # Running jobs aren't claimed twice
+        self.assertIsNone(jobs.claim('worker-2'))
+        jobs.run(claimed)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result, job.error), ('d', '3', ''))
+        self.assertTrue(job.is_finished)
+        self.assertEqual(self.calls, [(1, 2)])
+
+    def test_unknown_task(self):
+        with self.assertRaises(jobs.UnknownTask):
+            jobs.enqueue('missing')
+        # A job whose task is no longer registered fails without retrying
+        Job.objects.create(task='missing', status='r', worker='worker', attempts=1)
+        job = jobs.run(Job.objects.get(task='missing'))
+        self.assertEqual(job.status, 'f')
+        self.assertIn('UnknownTask', job.error)
+
+    def test_failures_are_retried_with_backoff_then_fail(self):
+        job = jobs.enqueue('flaky')
+        jobs.run_next('worker')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('q', 1))
+        self.assertIn('ValueError: Broken', job.error)
+        self.assertGreater(job.run_after, timezone.now() + jobs.JOB_RETRY_DELAY / 2)
+        # Not due yet
+        self.assertIsNone(jobs.run_next('worker'))
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        jobs.run_next('worker')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('f', 2))
+        self.assertIsNotNone(job.finished_at)
+
+        self.assertEqual(jobs.retry(Job.objects.all()), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.finished_at), ('q', 0, None))
+
+    def test_concurrency_limit(self):
+        first, second = jobs.enqueue('import'), jobs.enqueue('import')
+        add = jobs.enqueue('add', a=2, b=2)
+        self.assertEqual(jobs.claim('worker-1').pk, first.pk)
+        # The second import waits for the first, other tasks go ahead
+        self.assertEqual(jobs.claim('worker-2').pk, add.pk)
+        self.assertIsNone(jobs.claim('worker-3'))
+        jobs.run(Job.objects.get(pk=first.pk))
+        self.assertEqual(jobs.claim('worker-3').pk, second.pk)
+
+    def make_stale(self):
+        Job.objects.filter(status='r').update(heartbeat_at=timezone.now() - jobs.JOB_STALE_AFTER * 2)
+
+    def test_stale_jobs_are_requeued(self):
+        job = jobs.enqueue('add', a=1, b=1)
+        slow = jobs.claim('worker-1')
+        self.assertEqual(jobs.requeue_stale(), (0, 0))
+        # Running for long, but its worker is alive
+        Job.objects.filter(pk=job.pk).update(started_at=timezone.now() - jobs.JOB_STALE_AFTER * 10)
+        self.assertEqual(jobs.requeue_stale(), (0, 0))
+        self.make_stale()
+        self.assertEqual(jobs.requeue_stale(), (1, 0))
+        again = jobs.claim('worker-2')
+        self.assertEqual((again.pk, again.attempts), (job.pk, 2))
+        finished_at = jobs.run(again).finished_at
+        # The first worker was only slow: its outcome doesn't overwrite the second's
+        slow = jobs.run(slow)
+        self.assertEqual((slow.status, slow.worker, slow.finished_at), ('d', 'worker-2', finished_at))
+        job.refresh_from_db()
+        self.assertEqual((job.worker, job.finished_at), ('worker-2', finished_at))
+
+    def test_stale_jobs_without_attempts_left_fail(self):
+        job = jobs.enqueue('flaky')
+        jobs.claim('worker-1')
+        self.make_stale()
+        jobs.requeue_stale()
+        jobs.claim('worker-2')
+        self.make_stale()
+        # The second attempt of two: never started again
+        self.assertEqual(jobs.requeue_stale(), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('f', 2))
+        self.assertIn('its worker stopped', job.error)
+        self.assertIsNone(jobs.claim('worker-3'))
@@ -0,0 +1,842 @@
+import asyncio
+import datetime
+import functools
+import json
+import os
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from catalog import jobs, profiling
+from catalog.admin import BookAdmin, BookInstanceAdmin
+from catalog.cache import page_cache, page_cache_stats, reset_page_cache_stats
+from catalog.export import export_lines
+from catalog.models import Author, Book, BookInstance, Genre, Hold, Job, Language
+from catalog.pagination import encode_cursor
+from catalog.stats import get_catalog_stats
+from catalog.visits import VISITS_COOKIE
+from locallibrary.asgi import ThreadPoolASGIHandler
+
+class IndexViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = Author.objects.create(first_name='John', last_name='Smith')
+        Genre.objects.create(name='Fantasy')
+        book = Book.objects.create(title='The game of kings', summary='Summary', isbn='ABCDEFG', author=author)
+        BookInstance.objects.create(book=book, imprint='Imprint', status='a')
+        BookInstance.objects.create(book=book, imprint='Imprint', status='o')
+
+    def setUp(self):
+        # The counters are cached across requests, so start every test cold
+        cache.clear()
+
+    def test_stats_counts(self):
+        stats = get_catalog_stats()
+        self.assertEqual(stats, {
+            'num_books': 1,
+            'num_instances': 2,
+            'num_instances_available': 1,
+            'num_authors': 1,
+            'num_genres': 1,
+            'num_books_game': 1,
+        })
+
+    def test_stats_computed_in_one_query(self):
+        with self.assertNumQueries(1):
+            get_catalog_stats()
+
+    def test_stats_cached_when_warm(self):
+        get_catalog_stats()
+        with self.assertNumQueries(0):
+            get_catalog_stats()
+
+    def test_stats_invalidated_on_save_and_delete(self):
+        get_catalog_stats()
+        genre = Genre.objects.create(name='Horror')
+        self.assertEqual(get_catalog_stats()['num_genres'], 2)
+        genre.delete()
+        self.assertEqual(get_catalog_stats()['num_genres'], 1)
+
+    def test_stats_invalidated_by_another_process(self):
+        get_catalog_stats()
+        pid = os.fork()
+        if pid == 0:
+            # The child changes its own copy of the test database
+            status = 1
+            try:
+                Genre.objects.create(name='Horror')
+                status = 0
+            finally:
+                os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        with self.assertNumQueries(1):
+            get_catalog_stats()
+
+    def test_view_uses_correct_template_and_context(self):
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'index.html')
+        self.assertEqual(response.context['num_instances_available'], 1)
+        self.assertEqual(response.context['num_books_game'], 1)
+
+    def test_visits_counted_in_a_signed_cookie(self):
+        for expected in range(3):
+            self.assertEqual(self.client.get(reverse('index')).context['num_visits'], expected)
+        # A cookie the client edited counts from zero again
+        self.client.cookies[VISITS_COOKIE] = '1000'
+        self.assertEqual(self.client.get(reverse('index')).context['num_visits'], 0)
+
+    def test_visits_carried_over_from_the_session(self):
+        session = self.client.session
+        session['num_visits'] = 7
+        session.save()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        self.assertEqual(self.client.get(reverse('index')).context['num_visits'], 7)
+        self.assertEqual(self.client.get(reverse('index')).context['num_visits'], 8)
+
+    def test_no_database_writes(self):
+        User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        self.client.login(username='reader', password='1X<ISRUkw+tuK')
+        self.client.get(reverse('index'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('index'))
+        self.assertEqual([query['sql'] for query in queries if not query['sql'].startswith('SELECT')], [])
+
+class QueryCountGuardMixin:
+    """Assert that a list page runs the same number of queries whatever its size.
+
+    The page is fetched with a single row and again after filling it, so any
+    per-row lazy fetch (an N+1) shows up as a difference in the count."""
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertConstantQueries(self, url, add_row, page_size):
+        add_row(0)
+        baseline = self.count_queries(url)
+        for i in range(1, page_size * 2):
+            add_row(i)
+        self.assertEqual(self.count_queries(url), baseline)
+
+class ListViewQueryCountTest(QueryCountGuardMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='librarian', password='1X<ISRUkw+tuK')
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+
+    def add_book(self, i):
+        author = Author.objects.create(first_name=f'First {i}', last_name=f'Last {i}')
+        return Book.objects.create(title=f'Book {i}', summary='Summary', isbn='ABCDEFG', author=author)
+
+    def add_loan(self, i):
+        book = self.add_book(i)
+        BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.user,
+                                    due_back=datetime.date.today() + datetime.timedelta(days=i))
+
+    def test_book_list(self):
+        self.assertConstantQueries(reverse('books'), self.add_book, 4)
+
+    def test_author_list(self):
+        self.assertConstantQueries(reverse('authors'), self.add_book, 4)
+
+    def test_borrowed_by_user_list(self):
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        self.assertConstantQueries(reverse('my-borrowed'), self.add_loan, 10)
+
+    def test_all_borrowed_list(self):
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        self.assertConstantQueries(reverse('all-borrowed'), self.add_loan, 10)
+
+    def test_bookinstance_str_uses_selected_book(self):
+        self.add_loan(0)
+        copy = BookInstance.objects.select_related('book').get()
+        with self.assertNumQueries(0):
+            self.assertEqual(str(copy), f'{copy.id} (Book 0)')
+
+class DetailViewQueryCountTest(QueryCountGuardMixin, TestCase):
+    def setUp(self):
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG', author=self.author)
+        self.book.genre.add(Genre.objects.create(name='Fantasy'), Genre.objects.create(name='Horror'))
+
+    def add_copy(self, i):
+        BookInstance.objects.create(book=self.book, imprint=f'Imprint {i}', status='a')
+
+    def add_book(self, i):
+        Book.objects.create(title=f'Book {i}', summary='Summary', isbn='ABCDEFG', author=self.author)
+
+    def test_book_detail(self):
+        self.assertConstantQueries(self.book.get_absolute_url(), self.add_copy, 20)
+
+    def test_author_detail(self):
+        self.assertConstantQueries(self.author.get_absolute_url(), self.add_book, 20)
+
+    def test_book_detail_copies_are_paginated(self):
+        for i in range(25):
+            self.add_copy(i)
+        response = self.client.get(self.book.get_absolute_url())
+        self.assertEqual(len(response.context['copy_list']), 20)
+        response = self.client.get(self.book.get_absolute_url() + '?page=2')
+        self.assertEqual(len(response.context['copy_list']), 5)
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='librarian', password='1X<ISRUkw+tuK')
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG')
+        # Repeated and missing due dates, so pages must break ties on the id
+        for i in range(23):
+            due_back = None if i % 7 == 0 else datetime.date.today() + datetime.timedelta(days=i % 3)
+            BookInstance.objects.create(book=book, imprint='Imprint', status='o', borrower=self.user, due_back=due_back)
+        self.expected = list(BookInstance.objects.order_by('due_back', 'id').values_list('id', flat=True))
+
+    def walk(self, url, cursor_attr):
+        """Follow next_cursor or previous_cursor links, returning the ids on each page."""
+        pages, response = [], self.client.get(url)
+        while True:
+            pages.append([copy.id for copy in response.context['bookinstance_list']])
+            cursor = getattr(response.context['page_obj'], cursor_attr)
+            if cursor is None:
+                return pages, response
+            response = self.client.get(url, {'cursor': cursor})
+
+    def test_pages_cover_every_row_once_in_order(self):
+        pages, response = self.walk(reverse('all-borrowed'), 'next_cursor')
+        self.assertEqual([len(page) for page in pages], [10, 10, 3])
+        self.assertEqual(sum(pages, []), self.expected)
+        self.assertEqual(response.context['page_obj'].number, 3)
+        self.assertIsNone(response.context['page_obj'].paginator.num_pages)
+
+    def test_previous_cursor_returns_same_pages(self):
+        forward, response = self.walk(reverse('all-borrowed'), 'next_cursor')
+        cursor = response.context['page_obj'].previous_cursor
+        backward, response = self.walk(reverse('all-borrowed') + f'?cursor={cursor}', 'previous_cursor')
+        self.assertEqual(backward[::-1], forward[:-1])
+        self.assertEqual(response.context['page_obj'].number, 1)
+
+    def test_counted_view_reports_total_pages(self):
+        response = self.client.get(reverse('my-borrowed'))
+        self.assertEqual(response.context['page_obj'].paginator.num_pages, 3)
+        self.assertContains(response, 'Page 1 of 3.')
+
+    def test_invalid_cursor_is_404(self):
+        response = self.client.get(reverse('all-borrowed'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_values_of_the_wrong_type_are_404(self):
+        copy_id = str(BookInstance.objects.first().pk)
+        for url, values in [(reverse('books'), ['abc']), (reverse('books'), [[1]]), (reverse('books'), [10 ** 30]),
+                            (reverse('all-borrowed'), ['abc', copy_id]), (reverse('all-borrowed'), [None, [1]])]:
+            response = self.client.get(url, {'cursor': encode_cursor(values, 'next', 2)})
+            self.assertEqual(response.status_code, 404, values)
+
+    def test_page_number_redirects_to_its_cursor(self):
+        forward, _ = self.walk(reverse('all-borrowed'), 'next_cursor')
+        for number in (2, 3):
+            response = self.client.get(reverse('all-borrowed'), {'page': number})
+            self.assertEqual(response.status_code, 302)
+            self.assertNotIn('page=', response.url)
+            response = self.client.get(response.url)
+            self.assertEqual([copy.id for copy in response.context['bookinstance_list']], forward[number - 1])
+            self.assertEqual(response.context['page_obj'].number, number)
+
+    def test_first_page_number_redirects_to_plain_list(self):
+        response = self.client.get(reverse('all-borrowed'), {'page': 1})
+        self.assertRedirects(response, reverse('all-borrowed'))
+
+    def test_missing_page_number_is_404(self):
+        for number in ('4', '0', 'last', 'x'):
+            response = self.client.get(reverse('all-borrowed'), {'page': number})
+            self.assertEqual(response.status_code, 404)
+
+class BookSearchViewTest(TestCase):
+    def setUp(self):
+        self.author = Author.objects.create(first_name='Ursula', last_name='Le Guin')
+        self.fantasy = Genre.objects.create(name='Fantasy')
+        self.wizard = Book.objects.create(title='A Wizard of Earthsea', summary='A boy learns magic.',
+                                          isbn='ABCDEFG', author=self.author)
+        self.wizard.genre.add(self.fantasy)
+        self.other = Book.objects.create(title='Dispossessed', summary='Not a wizard in sight.', isbn='ABCDEFG')
+
+    def search(self, query):
+        response = self.client.get(reverse('book-search'), {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [book.title for book in response.context['book_list']]
+
+    def test_title_matches_rank_above_summary_matches(self):
+        self.assertEqual(self.search('wizard'), ['A Wizard of Earthsea', 'Dispossessed'])
+
+    def test_searches_author_and_genre_and_prefix(self):
+        self.assertEqual(self.search('guin'), ['A Wizard of Earthsea'])
+        self.assertEqual(self.search('fanta'), ['A Wizard of Earthsea'])
+
+    def test_index_follows_related_changes(self):
+        self.author.last_name = 'Tolkien'
+        self.author.save()
+        self.assertEqual(self.search('tolkien'), ['A Wizard of Earthsea'])
+        self.wizard.genre.remove(self.fantasy)
+        self.assertEqual(self.search('fantasy'), [])
+        self.wizard.delete()
+        self.assertEqual(self.search('wizard'), ['Dispossessed'])
+
+    def test_query_syntax_is_escaped(self):
+        self.assertEqual(self.search('"wizard" OR'), [])
+        self.assertEqual(self.search('***'), [])
+
+    def test_results_are_paginated(self):
+        for i in range(12):
+            Book.objects.create(title=f'Wizard {i}', summary='Summary', isbn='ABCDEFG')
+        response = self.client.get(reverse('book-search'), {'q': 'wizard', 'page': 2})
+        self.assertEqual(response.context['paginator'].count, 14)
+        self.assertEqual(len(response.context['book_list']), 4)
+
+
+class RenewBooksBulkViewTest(TestCase):
+    def setUp(self):
+        User.objects.create_superuser(username='librarian', password='1X<ISRUkw+tuK')
+        User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG')
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        self.copies = [BookInstance.objects.create(book=book, imprint='Imprint', status='o', due_back=yesterday)
+                       for _ in range(30)]
+
+    def post(self, renewal_date, copies=None):
+        ids = [str(copy.id) for copy in (self.copies if copies is None else copies)]
+        return self.client.post(reverse('renew-books-bulk'), {'copies': ids, 'renewal_date': renewal_date})
+
+    def test_redirects_to_login_unless_permitted(self):
+        self.client.login(username='reader', password='1X<ISRUkw+tuK')
+        response = self.post(datetime.date.today())
+        self.assertTrue(response.url.startswith('/accounts/login/'))
+        self.assertFalse(BookInstance.objects.filter(due_back=datetime.date.today()).exists())
+
+    def test_admin_action_renews_selected(self):
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        url = reverse('admin:catalog_bookinstance_changelist')
+        selected = [str(copy.id) for copy in self.copies[:5]]
+        response = self.client.post(url, {'action': 'renew_loans', '_selected_action': selected})
+        self.assertContains(response, 'Renew 5 selected books')
+        renewal_date = datetime.date.today() + datetime.timedelta(weeks=1)
+        response = self.client.post(url, {'action': 'renew_loans', '_selected_action': selected,
+                                          'apply': 'Renew', 'renewal_date': renewal_date})
+        self.assertRedirects(response, url)
+        self.assertEqual(BookInstance.objects.filter(due_back=renewal_date).count(), 5)
+
+    def test_renews_all_selected_in_one_update(self):
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        renewal_date = datetime.date.today() + datetime.timedelta(weeks=2)
+        # Session, user, then (in savepoints) reading the loans, the UPDATE and one
+        # INSERT into the loan ledger, however many copies are selected
+        with self.assertNumQueries(9):
+            response = self.post(renewal_date)
+        self.assertRedirects(response, reverse('all-borrowed'))
+        self.assertEqual(BookInstance.objects.filter(due_back=renewal_date).count(), 30)
+
+    def test_large_selections_are_renewed_by_a_job(self):
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        renewal_date = datetime.date.today() + datetime.timedelta(weeks=2)
+        with mock.patch('catalog.views.RENEW_INLINE_LIMIT', 20):
+            response = self.post(renewal_date)
+        job = Job.objects.get()
+        self.assertRedirects(response, job.get_absolute_url())
+        self.assertEqual(job.task, 'renew_loans')
+        self.assertFalse(BookInstance.objects.filter(due_back=renewal_date).exists())
+        jobs.run_next('worker')
+        self.assertEqual(BookInstance.objects.filter(due_back=renewal_date).count(), 30)
+        self.assertEqual(Job.objects.get().result, '30')
+
+    def test_renewal_date_rules_apply(self):
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        response = self.post(datetime.date.today() + datetime.timedelta(weeks=5))
+        self.assertEqual(response.status_code, 200)
+        self.assertFormError(response, 'form', 'renewal_date', 'Invalid date - renewal more than 4 weeks ahead')
+        response = self.post(datetime.date.today(), copies=[])
+        self.assertFormError(response, 'form', 'copies', 'Select at least one book to renew.')
+        self.assertFalse(BookInstance.objects.filter(due_back__gte=datetime.date.today()).exists())
+
+class AdminQueryCountTest(QueryCountGuardMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='librarian', password='1X<ISRUkw+tuK')
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG', author=self.author)
+        self.genres = [Genre.objects.create(name=f'Genre {i}') for i in range(4)]
+
+    def add_book(self, i):
+        author = Author.objects.create(first_name=f'First {i}', last_name=f'Last {i}')
+        book = Book.objects.create(title=f'Book {i}', summary='Summary', isbn='ABCDEFG', author=author)
+        book.genre.add(*self.genres)
+
+    def add_copy(self, i):
+        BookInstance.objects.create(book=self.book, imprint=f'Imprint {i}', status='o', borrower=self.user)
+
+    def test_book_changelist(self):
+        self.assertConstantQueries(reverse('admin:catalog_book_changelist'), self.add_book, 50)
+
+    def test_bookinstance_changelist(self):
+        self.assertConstantQueries(reverse('admin:catalog_bookinstance_changelist'), self.add_copy, 50)
+
+    def test_book_change_form_limits_copies_inline(self):
+        for i in range(30):
+            self.add_copy(i)
+        response = self.client.get(reverse('admin:catalog_book_change', args=[self.book.pk]))
+        self.assertEqual(response.context['inline_admin_formsets'][0].formset.initial_form_count(), 20)
+        self.assertContains(response, 'All 30 copies of this book')
+
+    def test_book_change_form_cost_is_constant(self):
+        # The borrowers' raw id labels come with the copies, and only the
+        # first 20 copies are loaded however many the book has
+        url = reverse('admin:catalog_book_change', args=[self.book.pk])
+        self.add_copy(0)
+        # Warm the content type cache used for the change link
+        self.count_queries(url)
+        single = self.count_queries(url)
+        for i in range(1, 60):
+            self.add_copy(i)
+        self.assertEqual(self.count_queries(url), single)
+        self.assertContains(self.client.get(url), '<strong><a href="/admin/auth/user/', count=20)
+
+    def test_copy_change_form_refuses_stale_copy(self):
+        copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+        url = reverse('admin:catalog_bookinstance_change', args=[copy.pk])
+        self.assertContains(self.client.get(url), 'name="seen_version" value="0"')
+        data = {'book': self.book.pk, 'imprint': 'Imprint', 'id': copy.pk, 'status': 'm', 'seen_version': 0}
+        # Checked out after the form was shown
+        BookInstance.objects.filter(pk=copy.pk).update(status='o', borrower=self.user, version=1)
+        response = self.client.post(url, data)
+        self.assertContains(response, 'The copy was changed by someone else')
+        copy.refresh_from_db()
+        self.assertEqual((copy.status, copy.version), ('o', 1))
+        response = self.client.post(url, {**data, 'seen_version': 1})
+        self.assertRedirects(response, reverse('admin:catalog_bookinstance_changelist'))
+        copy.refresh_from_db()
+        self.assertEqual((copy.status, copy.version), ('m', 2))
+
+    def test_copy_changed_during_save_is_a_form_error(self):
+        copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+        url = reverse('admin:catalog_bookinstance_change', args=[copy.pk])
+        data = {'book': self.book.pk, 'imprint': 'Imprint', 'id': copy.pk, 'status': 'm', 'seen_version': 0}
+
+        def checked_out_first(model_admin, request, obj, form, change):
+            # Checked out after the form's version check, just before the save
+            BookInstance.objects.filter(pk=copy.pk).update(status='o', borrower=self.user, version=1)
+            admin.ModelAdmin.save_model(model_admin, request, obj, form, change)
+
+        with mock.patch.object(BookInstanceAdmin, 'save_model', checked_out_first):
+            response = self.client.post(url, data)
+        self.assertContains(response, 'The copy was changed by someone else')
+        # The edit wasn't saved (nor, here, the checkout made in the same transaction)
+        copy.refresh_from_db()
+        self.assertEqual((copy.status, copy.version), ('a', 0))
+        # The inlines of a book's form, the same
+        url = reverse('admin:catalog_book_change', args=[self.book.pk])
+        prefix = 'bookinstance_set'
+        data = {'title': 'Book', 'summary': 'Summary', 'isbn': 'ABCDEFG', 'author': self.author.pk,
+                'genre': self.genres[0].pk, 'language': Language.objects.create(name='English').pk,
+                f'{prefix}-TOTAL_FORMS': 1, f'{prefix}-INITIAL_FORMS': 1,
+                f'{prefix}-0-id': copy.pk, f'{prefix}-0-book': self.book.pk, f'{prefix}-0-imprint': 'Imprint',
+                f'{prefix}-0-status': 'm', f'{prefix}-0-seen_version': 0}
+
+        def inline_checked_out_first(model_admin, request, form, formset, change):
+            BookInstance.objects.filter(pk=copy.pk).update(status='o', borrower=self.user, version=1)
+            admin.ModelAdmin.save_formset(model_admin, request, form, formset, change)
+
+        with mock.patch.object(BookAdmin, 'save_formset', inline_checked_out_first):
+            response = self.client.post(url, data)
+        self.assertContains(response, 'The copy was changed by someone else')
+        copy.refresh_from_db()
+        self.assertEqual((copy.status, copy.version), ('a', 0))
+
+
+class CatalogPageCacheTest(TestCase):
+    def setUp(self):
+        page_cache().clear()
+        reset_page_cache_stats()
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG', author=self.author)
+
+    def test_anonymous_hit_runs_no_queries(self):
+        url = self.book.get_absolute_url()
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(page_cache_stats(), {'hits': 1, 'misses': 1})
+
+    def test_model_changes_invalidate(self):
+        url = self.book.get_absolute_url()
+        self.client.get(url)
+        Language.objects.create(name='French')
+        self.book.title = 'New title'
+        self.book.save()
+        self.assertContains(self.client.get(url), 'New title')
+        BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+        self.assertContains(self.client.get(url), '1 available')
+        self.assertEqual(page_cache_stats()['hits'], 0)
+
+    def test_bump_in_another_process_invalidates(self):
+        # A management command (or a job in run_workers) runs in a process of
+        # its own: its bump must reach the pages cached by the web process
+        url = self.book.get_absolute_url()
+        self.client.get(url)
+        self.client.get(url)
+        pid = os.fork()
+        if pid == 0:
+            # The child works on its own copy of the test database
+            status = 1
+            try:
+                call_command('build_recommendations', stdout=StringIO())
+                status = 0
+            finally:
+                os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.client.get(url)
+        self.assertEqual(page_cache_stats(), {'hits': 1, 'misses': 2})
+
+    def test_pages_are_cached_separately(self):
+        for i in range(5):
+            Author.objects.create(first_name=f'First {i}', last_name=f'Last {i}')
+        first = self.client.get(reverse('authors'))
+        second = self.client.get(reverse('authors'), {'cursor': first.context['page_obj'].next_cursor})
+        self.assertNotEqual(first.content, second.content)
+        self.assertEqual(page_cache_stats(), {'hits': 0, 'misses': 2})
+
+    def test_logged_in_users_bypass_cache(self):
+        User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        self.client.login(username='reader', password='1X<ISRUkw+tuK')
+        self.client.get(reverse('books'))
+        self.client.get(reverse('books'))
+        self.assertEqual(page_cache_stats(), {'hits': 0, 'misses': 0})
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        page_cache().clear()
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG', author=self.author)
+        self.copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='o',
+                                                due_back=datetime.date.today())
+
+    def revalidate(self, url, response):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_validators_on_every_catalog_page(self):
+        for url in [reverse('books'), self.book.get_absolute_url(),
+                    reverse('authors'), self.author.get_absolute_url()]:
+            response = self.client.get(url)
+            self.assertIn('ETag', response)
+            self.assertIn('Last-Modified', response)
+            self.assertEqual(self.revalidate(url, response).status_code, 304)
+
+    def test_not_modified_runs_no_queries(self):
+        url = self.book.get_absolute_url()
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            second = self.revalidate(url, first)
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.content, b'')
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_if_modified_since(self):
+        url = self.book.get_absolute_url()
+        first = self.client.get(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified']).status_code, 304)
+
+    def test_changes_give_a_new_etag(self):
+        url = self.book.get_absolute_url()
+        first = self.client.get(url)
+        # A bulk renewal goes through QuerySet.update(), which skips the signals
+        BookInstance.objects.filter(pk=self.copy.pk).renew(datetime.date.today() + datetime.timedelta(weeks=1))
+        second = self.revalidate(url, first)
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        # Genres have no updated_at, the ETag still follows them
+        Genre.objects.create(name='Fantasy')
+        self.assertEqual(self.revalidate(url, second).status_code, 200)
+
+    def test_deleting_a_row_gives_a_new_etag(self):
+        Author.objects.create(first_name='Jane', last_name='Doe').delete()
+        url = reverse('authors')
+        first = self.client.get(url)
+        Author.objects.create(first_name='Anne', last_name='Other').delete()
+        self.assertEqual(self.revalidate(url, first).status_code, 200)
+
+    def test_if_modified_since_follows_versions(self):
+        # Neither change moves an updated_at, only the page cache versions
+        changes = [(reverse('authors'), lambda: Author.objects.create(first_name='Anne', last_name='Other').delete()),
+                   (self.book.get_absolute_url(), lambda: Genre.objects.create(name='Fantasy'))]
+        for minutes, (url, change) in enumerate(changes, 1):
+            first = self.client.get(url)
+            # Later, so the change can be told apart at HTTP's resolution of a second
+            with mock.patch('catalog.cache.time', time=mock.Mock(return_value=time.time() + minutes * 60)):
+                change()
+            second = self.client.get(url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+            self.assertEqual(second.status_code, 200)
+            self.assertNotEqual(second['Last-Modified'], first['Last-Modified'])
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=second['Last-Modified']).status_code, 304)
+
+    def test_logged_in_users_get_no_validators(self):
+        User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        self.client.login(username='reader', password='1X<ISRUkw+tuK')
+        self.assertNotIn('ETag', self.client.get(reverse('books')))
+
+    def test_revalidation_hit_ratio(self):
+        """A client revisiting the catalog pages, with one edit half way through,
+        gets most of them as 304s and is spared their bodies."""
+        urls = [reverse('books'), self.book.get_absolute_url(), reverse('authors'), self.author.get_absolute_url()]
+        stored = {}
+        not_modified = requests = bytes_saved = 0
+        for visit in range(10):
+            if visit == 5:
+                self.book.title = 'New title'
+                self.book.save()
+            for url in urls:
+                headers = {'HTTP_IF_NONE_MATCH': stored[url]['ETag']} if url in stored else {}
+                response = self.client.get(url, **headers)
+                requests += 1
+                if response.status_code == 304:
+                    not_modified += 1
+                    bytes_saved += len(stored[url].content)
+                else:
+                    stored[url] = response
+        # Every page is fetched on the first visit, the book's pages (all but
+        # the author list) once more after the edit
+        self.assertEqual(requests - not_modified, 4 + 3)
+        self.assertGreaterEqual(not_modified / requests, 0.8)
+        self.assertGreater(bytes_saved, 0)
+
+
+class HoldViewsTest(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG')
+        BookInstance.objects.create(book=self.book, imprint='Imprint', status='o')
+        User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+        self.client.login(username='reader', password='1X<ISRUkw+tuK')
+
+    def test_place_and_cancel_hold(self):
+        response = self.client.post(reverse('place-hold', args=[self.book.pk]))
+        self.assertRedirects(response, self.book.get_absolute_url())
+        response = self.client.get(self.book.get_absolute_url())
+        self.assertEqual(response.context['hold_position'], 1)
+        self.assertContains(response, 'number 1 in the queue')
+        self.client.post(reverse('cancel-hold', args=[response.context['hold'].pk]))
+        self.assertIsNone(self.client.get(self.book.get_absolute_url()).context['hold'])
+
+    def test_hold_needs_login_and_post(self):
+        self.assertEqual(self.client.get(reverse('place-hold', args=[self.book.pk])).status_code, 405)
+        self.client.logout()
+        self.assertEqual(self.client.post(reverse('place-hold', args=[self.book.pk])).status_code, 302)
+        self.assertFalse(Hold.objects.exists())
+
+
+class LoanViewsTest(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Book', summary='Summary', isbn='ABCDEFG')
+        self.copy = BookInstance.objects.create(book=self.book, imprint='Imprint', status='a')
+        self.patron = User.objects.create_user(username='patron')
+        User.objects.create_superuser(username='librarian', email='', password='1X<ISRUkw+tuK')
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        self.due = datetime.date.today() + datetime.timedelta(weeks=2)
+
+    def test_checkout_then_return(self):
+        response = self.client.post(reverse('checkout-copy', args=[self.copy.pk]),
+                                    {'borrower': 'patron', 'due_back': self.due, 'version': 0})
+        self.assertRedirects(response, self.book.get_absolute_url())
+        self.copy.refresh_from_db()
+        self.assertEqual((self.copy.status, self.copy.borrower, self.copy.due_back), ('o', self.patron, self.due))
+        response = self.client.post(reverse('return-copy', args=[self.copy.pk]), {'version': self.copy.version})
+        self.assertRedirects(response, reverse('all-borrowed'))
+        self.copy.refresh_from_db()
+        self.assertEqual(self.copy.status, 'a')
+
+    def test_form_from_before_a_change_is_refused(self):
+        response = self.client.get(reverse('checkout-copy', args=[self.copy.pk]))
+        version = response.context['form'].initial['version']
+        self.copy.imprint = 'Changed meanwhile'
+        self.copy.save()
+        response = self.client.post(reverse('checkout-copy', args=[self.copy.pk]),
+                                    {'borrower': 'patron', 'due_back': self.due, 'version': version})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'changed by someone else')
+        self.copy.refresh_from_db()
+        self.assertEqual(self.copy.status, 'a')
+
+    def test_loan_report_reads_the_rollups(self):
+        self.client.post(reverse('checkout-copy', args=[self.copy.pk]),
+                         {'borrower': 'patron', 'due_back': self.due, 'version': 0})
+        # Session, user, and the month's most borrowed books with one query
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('loan-report'))
+        self.assertEqual([(row.book, row.loans) for row in response.context['popular']], [(self.book, 1)])
+        self.assertContains(response, '1 loan)')
+        response = self.client.get(reverse('loan-report'), {'month': '2001-02'})
+        self.assertEqual(response.context['month'], datetime.date(2001, 2, 1))
+        self.assertContains(response, 'No books were borrowed this month.')
+        # Out of range: this month instead
+        for month in ('0001-01', '9999-12', '2001-13'):
+            response = self.client.get(reverse('loan-report'), {'month': month})
+            self.assertEqual(response.context['month'], datetime.date.today().replace(day=1))
+
+
+class ProfilingMiddlewareTest(TestCase):
+    def setUp(self):
+        profiling.collector.reset()
+        self.author = Author.objects.create(first_name='John', last_name='Smith')
+        self.books = [Book.objects.create(title=f'Book {i}', summary='Summary', isbn='ABCDEFG', author=self.author)
+                      for i in range(3)]
+
+    def test_requests_are_recorded_per_view(self):
+        page_cache().clear()
+        for _ in range(3):
+            self.client.get(reverse('books'))
+        self.client.get(reverse('book-detail', args=[self.books[0].pk]))
+        views = profiling.collector.snapshot()['views']
+        self.assertEqual(views['books']['requests'], 3)
+        self.assertEqual(views['book-detail']['requests'], 1)
+        # The first request renders the list, the others come from the page cache
+        self.assertEqual(views['books']['queries']['max'], 2)
+        self.assertEqual(views['books']['queries']['p50'], 0)
+        self.assertEqual(views['books']['template_ms']['count'], 1)
+        self.assertEqual(views['books']['n_plus_one_requests'], 0)
+        wall = views['books']['wall_ms']
+        self.assertLessEqual(wall['p50'], wall['p95'])
+        self.assertLessEqual(wall['p99'], wall['max'])
+
+    def test_repeated_sql_is_flagged(self):
+        profile = profiling.RequestProfile()
+        with connection.execute_wrapper(profile.record_query):
+            for book in Book.objects.all():
+                # One query per book, as a template following a foreign key would
+                Author.objects.get(pk=book.author_id)
+            Author.objects.get(pk=self.author.pk)
+        self.assertEqual(profile.queries, 5)
+        # The same author four times, all but the first are exact repeats
+        self.assertEqual(profile.duplicates, 3)
+        with override_settings(PROFILING_REPEATED_QUERIES=4), self.assertLogs('catalog.profiling', 'WARNING'):
+            profiling.collector.add('books', profile)
+        stats = profiling.collector.snapshot()['views']['books']
+        self.assertEqual(stats['n_plus_one_requests'], 1)
+        self.assertEqual(stats['n_plus_one'][0]['max_executions'], 4)
+        self.assertIn('"catalog_author"', stats['n_plus_one'][0]['sql'])
+
+    def test_dashboard_is_staff_only(self):
+        url = reverse('profiling')
+        response = self.client.get(url)
+        self.assertRedirects(response, f'{reverse("admin:login")}?next={url}')
+        User.objects.create_user(username='staff', password='1X<ISRUkw+tuK', is_staff=True)
+        self.client.login(username='staff', password='1X<ISRUkw+tuK')
+        self.client.get(reverse('authors'))
+        self.assertContains(self.client.get(url), '<td>authors</td>', html=False)
+        data = self.client.get(url, {'format': 'json'}).json()
+        self.assertEqual(data['views']['authors']['requests'], 1)
+
+    def test_snapshot_is_flushed_to_a_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        path = os.path.join(directory, 'profile-{pid}.json')
+        with override_settings(PROFILING_FILE=path, PROFILING_FLUSH_SECONDS=0):
+            self.client.get(reverse('authors'))
+        written = path.format(pid=os.getpid())
+        self.addCleanup(os.remove, written)
+        with open(written) as f:
+            self.assertEqual(json.load(f)['views']['authors']['requests'], 1)
+
+
+class JobViewsTest(TestCase):
+    def setUp(self):
+        self.librarian = User.objects.create_superuser(username='librarian', password='1X<ISRUkw+tuK')
+        User.objects.create_user(username='reader', password='1X<ISRUkw+tuK')
+
+    def test_librarians_only(self):
+        self.client.login(username='reader', password='1X<ISRUkw+tuK')
+        self.assertEqual(self.client.get(reverse('jobs')).status_code, 403)
+        response = self.client.post(reverse('enqueue-job'), {'task': 'rebuild_search_index'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Job.objects.exists())
+
+    def test_enqueue_and_follow_a_job(self):
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        self.assertContains(self.client.get(reverse('jobs')), 'Rebuild the search index')
+        response = self.client.post(reverse('enqueue-job'), {'task': 'rebuild_search_index'})
+        job = Job.objects.get()
+        self.assertRedirects(response, job.get_absolute_url())
+        self.assertEqual((job.task, job.created_by), ('rebuild_search_index', self.librarian))
+        # The status page reloads itself until the job is done
+        response = self.client.get(job.get_absolute_url())
+        self.assertContains(response, 'Queued')
+        self.assertContains(response, 'http-equiv="refresh"')
+        jobs.run_next('worker')
+        response = self.client.get(job.get_absolute_url())
+        self.assertContains(response, 'Done')
+        self.assertNotContains(response, 'http-equiv="refresh"')
+        self.assertContains(self.client.get(reverse('jobs')), f'#{job.pk}')
+
+    def test_only_maintenance_tasks_can_be_queued(self):
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        response = self.client.post(reverse('enqueue-job'), {'task': 'import_catalog'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get(reverse('enqueue-job')).status_code, 405)
+        self.assertFalse(Job.objects.exists())
+
+    def test_admin_retries_failed_jobs(self):
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        job = Job.objects.create(task='rebuild_search_index', status='f', attempts=3)
+        response = self.client.post(reverse('admin:catalog_job_changelist'),
+                                    {'action': 'retry_jobs', '_selected_action': [job.pk]})
+        self.assertEqual(response.status_code, 302)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('q', 0))
+
+
+class ASGIStreamingTest(TransactionTestCase):
+    """Streaming responses through the project's ASGI handler. A TransactionTestCase:
+    the handler's threads have their own connections, which only see committed rows."""
+
+    def request(self, path, query=b'', cookies=''):
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+            'root_path': '', 'query_string': query,
+            'headers': [(b'host', b'testserver'), (b'cookie', cookies.encode())],
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(ThreadPoolASGIHandler()(scope, receive, send))
+        return messages
+
+    def test_export_streams_to_the_end(self):
+        author = Author.objects.create(first_name='Ursula', last_name='Le Guin')
+        for i in range(25):
+            Book.objects.create(title=f'Book {i}', summary='Summary', isbn=f'{i:013}', author=author)
+        User.objects.create_superuser(username='librarian', password='1X<ISRUkw+tuK')
+        self.client.login(username='librarian', password='1X<ISRUkw+tuK')
+        cookies = f'sessionid={self.client.cookies["sessionid"].value}'
+
+        # Three rows per chunk: the export runs several queries while it is sent
+        with mock.patch('catalog.views.export_lines', functools.partial(export_lines, chunk_size=3)):
+            messages = self.request(reverse('export-catalog', args=['books']), b'format=jsonl', cookies)
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(messages[-1], {'type': 'http.response.body'})
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual([row['title'] for row in rows], [f'Book {i}' for i in range(25)])
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 # URL pattern is an empty string
 # view function that will be called if the URL pattern is detected : views.index()
@@ -12,12 +12,26 @@ urlpatterns = [
     # <something> capture the pattern and pass the value to the view as a variable something
     # can precede the variable name with a converter specification like int, str, path
     # pk (short for primary key) - id that is being used to store the book uniquely
+    path('books/search/', views.BookSearchView.as_view(), name='book-search'),
     path('book/<int:pk>', views.BookDetailView.as_view(), name ='book-detail'),
     path('authors/', views.AuthorListView.as_view(), name = 'authors'),
     path('author/<int:pk>', views.AuthorDetailView.as_view(), name='author-detail'),
     path('mybooks/', views.LoanedBooksByUserListView.as_view(), name='my-borrowed'),
     path('borrowed', views.AllLoanedBooksListView.as_view(), name='all-borrowed'),
     path('book/<uuid:pk>/renew/', views.renew_book_librarian, name = 'renew-book-librarian'),
+    path('book/<uuid:pk>/checkout/', views.checkout_copy, name='checkout-copy'),
+    path('book/<uuid:pk>/return/', views.return_copy, name='return-copy'),
+    path('borrowed/renew/', views.renew_books_bulk, name='renew-books-bulk'),
+    path('borrowed/report/', views.loan_report, name='loan-report'),
+    path('book/<int:pk>/hold/', views.place_hold, name='place-hold'),
+    path('hold/<int:pk>/cancel/', views.cancel_hold, name='cancel-hold'),
+    path('export/<slug:dataset>/', views.export_catalog, name='export-catalog'),
+    # Read-only JSON API (see catalog/api.py)
+    path('api/<slug:resource>/', api.resource_list, name='api'),
+    path('profiling/', views.profiling_dashboard, name='profiling'),
+    path('jobs/', views.JobListView.as_view(), name='jobs'),
+    path('jobs/new/', views.enqueue_job, name='enqueue-job'),
+    path('jobs/<int:pk>/', views.JobDetailView.as_view(), name='job-detail'),
     path('author/create/', views.AuthorCreate.as_view(), name='author_create'),
     path('author/<int:pk>/update/', views.AuthorUpdate.as_view(), name='author_update'),
     path('author/<int:pk>/delete/', views.AuthorDelete.as_view(), name='author_delete'),
@@ -1,8 +1,19 @@
 from django.shortcuts import render
 # import the model classes in order to access the data
-from catalog.models import Book, Author, BookInstance, Genre
+from catalog.models import Book, Author, BookInstance, Genre, Hold, Language, RelatedBook
+from catalog import holds
+from catalog.cache import cache_catalog_page
+from catalog import conditional
+from catalog.conditional import conditional_catalog_page
+from catalog.stats import get_catalog_stats
+from catalog.visits import count_visit, get_visits
 # import the generic list view
 from django.views import generic
+from django.utils.decorators import method_decorator
+from django.core.paginator import Paginator
+from django.db.models import Prefetch
+from catalog.pagination import KeysetPaginationMixin
+from catalog.search import SearchResults
 
 # Create your views here.
 # Used to process an HTTP request, fetch data from the database, and render
@@ -12,30 +23,16 @@ from django.views import generic
 def index(request):
     """View function for home page of site."""
 
-    # Generate counts of some of the main objects
-    num_books = Book.objects.all().count()
-    num_instances = BookInstance.objects.all().count()
-    
-    # Available books (status = 'a')
-    num_instances_available = BookInstance.objects.filter(status__exact='a').count()
-    
-    # The 'all()' is implied by default.    
-    num_authors = Author.objects.count()
-    num_books_game = Book.objects.filter(title__contains='game').count()
-    num_genres = Genre.objects.all().count()
+    # Counts of the main objects, computed in one query and cached until a
+    # Book, BookInstance, Author or Genre is saved or deleted (see catalog/stats.py)
+    stats = get_catalog_stats()
 
-    # Number of visits to this view, as counted in the session variable
-    num_visits = request.session.get('num_visits', 0) # Sets to 0 if not previously been set
-    # Each time a request is received, increment the value and store it back in session
-    request.session['num_visits'] = num_visits + 1
+    # Number of visits to this view, counted in a signed cookie so a visit
+    # doesn't write to the database (see catalog/visits.py)
+    num_visits = get_visits(request)
 
     context = {
-        'num_books': num_books,
-        'num_instances': num_instances,
-        'num_instances_available': num_instances_available,
-        'num_authors': num_authors,
-        'num_books_game': num_books_game,
-        'num_genres': num_genres,
+        **stats,
         'num_visits': num_visits,
     }
 
@@ -43,10 +40,16 @@ def index(request):
     # request - HttpRequest, index.html --> html template wtih placeholders for the data
     # index.html expected to be found in catalog/templates/
     # context - python dictionary containing the data to insert into the placeholders
-    return render(request, 'index.html', context=context)
+    response = render(request, 'index.html', context=context)
+    # Each time a request is received, increment the value and store it back in the cookie
+    return count_visit(response, num_visits)
 
 # use a class-based generic list view (ListView) - a class that inherits from an existing view
-class BookListView(generic.ListView):
+# Anonymous visitors get a cached copy of the page until one of the listed models changes,
+# and a 304 Not Modified if they already have the current one
+@method_decorator(conditional_catalog_page(conditional.book_list_updates, Book, Author, BookInstance), name='dispatch')
+@method_decorator(cache_catalog_page(Book, Author, BookInstance), name='dispatch')
+class BookListView(KeysetPaginationMixin, generic.ListView):
     """The generic view will query the database to get all records for the
     specific model (Book) and render a template"""
     model = Book
@@ -56,21 +59,82 @@ class BookListView(generic.ListView):
     #queryset = Book.objects.filter(title__icontains='silent')[:5]
     # Adds pagination to the list views, reducing number of items displayed on each page
     paginate_by = 4
+    # Fetch each book's author in the same query (the template shows {{book.author}})
+    # and only load the columns the list actually renders
+    queryset = Book.objects.select_related('author').only(
+        'title', 'author', 'author__first_name', 'author__last_name', 'copies_total', 'copies_available')
+    # Pages are linked with cursors on the book id (see catalog/pagination.py);
+    # the catalog is large, so don't count it on every page
+    keyset_count = False
     
+class BookSearchView(generic.ListView):
+    """Full-text search over book titles, summaries, authors and genres,
+    best matches first (see catalog/search.py)."""
+    template_name = 'catalog/book_search.html'
+    context_object_name = 'book_list'
+    paginate_by = 10
+
+    def get_queryset(self):
+        return SearchResults(self.request.GET.get('q', ''))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.request.GET.get('q', '')
+        return context
+
+@method_decorator(conditional_catalog_page(
+    conditional.book_detail_updates, Book, Author, Language, Genre, BookInstance, RelatedBook), name='dispatch')
+@method_decorator(cache_catalog_page(Book, Author, Language, Genre, BookInstance, RelatedBook), name='dispatch')
 class BookDetailView(generic.DetailView):
     model = Book
+    # Join the author and language and fetch all genres in one extra query
+    queryset = Book.objects.select_related('author', 'language').prefetch_related('genre')
+    # Copies are paginated so a popular title doesn't render thousands of them
+    copies_paginate_by = 20
 
-class AuthorListView(generic.ListView):
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        copies = (BookInstance.objects.filter(book=self.object)
+                  .only('id', 'imprint', 'status', 'due_back').order_by('due_back', 'id'))
+        paginator = Paginator(copies, self.copies_paginate_by)
+        copies_page = paginator.get_page(self.request.GET.get('page'))
+        context['copies_page'] = copies_page
+        context['copy_list'] = copies_page.object_list
+        # Precomputed by "manage.py build_recommendations" (see catalog/recommendations.py)
+        context['related_books'] = (RelatedBook.objects.filter(book=self.object)
+                                    .select_related('related').only('related__id', 'related__title'))
+        # The signed in patron's place in the queue for this book, if any
+        if self.request.user.is_authenticated:
+            hold = Hold.objects.filter(book=self.object, patron=self.request.user, status__in=['w', 'r']).first()
+            context['hold'] = hold
+            context['hold_position'] = hold and holds.queue_position(hold)
+        return context
+
+@method_decorator(conditional_catalog_page(conditional.author_list_updates, Author), name='dispatch')
+@method_decorator(cache_catalog_page(Author), name='dispatch')
+class AuthorListView(KeysetPaginationMixin, generic.ListView):
     model = Author
     paginate_by = 4
+    # The list only renders the author's name
+    queryset = Author.objects.only('first_name', 'last_name')
 
+@method_decorator(conditional_catalog_page(conditional.author_detail_updates, Author, Book), name='dispatch')
+@method_decorator(cache_catalog_page(Author, Book), name='dispatch')
 class AuthorDetailView(generic.DetailView):
     model = Author
+    # Fetch the author's books in one extra query instead of when the template loops
+    queryset = Author.objects.prefetch_related(
+        Prefetch('book_set', queryset=Book.objects.only('title', 'summary', 'author')))
 
 # Used to add the view of list of books loaned to the current user
 # This import allows only the logged in user to call this view
 from django.contrib.auth.mixins import LoginRequiredMixin
-class LoanedBooksByUserListView(LoginRequiredMixin, generic.ListView):
+
+# Columns rendered by the borrowed books templates. The book (and borrower) are
+# joined in with select_related so each row doesn't fetch them lazily.
+LOANED_BOOK_FIELDS = ('id', 'due_back', 'status', 'book', 'book__title')
+
+class LoanedBooksByUserListView(LoginRequiredMixin, KeysetPaginationMixin, generic.ListView):
     """Generic class-based view listing books on loan to current user."""
     model = BookInstance
     # May have different lists of BookInstance records with different views and templates
@@ -79,21 +143,27 @@ class LoanedBooksByUserListView(LoginRequiredMixin, generic.ListView):
 
     # Restrict query to just BookInstance objects for the current user
     def get_queryset(self):
-        return BookInstance.objects.filter(borrower=self.request.user).filter(status__exact='o').order_by('due_back') 
+        return (BookInstance.objects.filter(borrower=self.request.user).on_loan()
+                .select_related('book').only(*LOANED_BOOK_FIELDS).order_by('due_back'))
 
 # Used to add the view of list of all books loaned
 # Allows only those with permission to call this view
 from django.contrib.auth.mixins import PermissionRequiredMixin
-class AllLoanedBooksListView(PermissionRequiredMixin, generic.ListView):
+class AllLoanedBooksListView(PermissionRequiredMixin, KeysetPaginationMixin, generic.ListView):
     """"Generic class-based view listing all books on loan. Can only be viewed
     with the can_edit permission """
     model = BookInstance
     template_name = 'catalog/bookinstance_list_all_borrowed.html'
     paginate_by = 10
     permission_required = 'catalog.can_mark_returned'
+    # Every loan in the library, so skip the COUNT(*) for the page total
+    keyset_count = False
 
     def get_queryset(self):
-        return BookInstance.objects.filter(status__exact='o').order_by('due_back')
+        return (BookInstance.objects.on_loan()
+                .select_related('book', 'borrower')
+                .only(*LOANED_BOOK_FIELDS, 'borrower', 'borrower__username')
+                .order_by('due_back'))
 
 # The view for the form when a librarian is renewing a book
 import datetime
@@ -103,34 +173,38 @@ from django.http import HttpResponseRedirect # Creates redirect to a specified U
 from django.urls import reverse
 
 # from .forms import RenewBookForm
-from catalog.forms import RenewBookForm
+from catalog.forms import BulkRenewBookForm, CheckoutForm, CopyVersionForm, RenewCopyForm
+from catalog import jobs, loans
+from catalog.tasks import RENEW_INLINE_LIMIT
 
 # Function decorator
 @permission_required('catalog.can_mark_returned')
 # pk argument in get_object_or_404() to get the current BookSInstance
 def renew_book_librarian(request, pk):
     """View function for renewing a specific BookInstance by librarian."""
-    book_instance = get_object_or_404(BookInstance, pk=pk)
+    book_instance = get_object_or_404(BookInstance.objects.select_related('book', 'borrower'), pk=pk)
 
     # If this is a POST request then process the Form data
     if request.method == 'POST':
 
         # Create a form instance and populate it with data from the request (binding):
-        form = RenewBookForm(request.POST)
+        form = RenewCopyForm(request.POST)
 
         # Check if the form is valid:
         if form.is_valid():
-            # process the data in form.cleaned_data as required (here we just write it to the model due_back field)
-            book_instance.due_back = form.cleaned_data['renewal_date']
-            book_instance.save()
-
-            # redirect to a new URL:
-            return HttpResponseRedirect(reverse('all-borrowed') )
+            # Move the due date, unless the copy changed since the form was shown
+            try:
+                loans.renew(book_instance.pk, form.cleaned_data['renewal_date'], form.cleaned_data['version'])
+            except loans.LoanError as e:
+                form.add_error(None, str(e))
+            else:
+                # redirect to a new URL:
+                return HttpResponseRedirect(reverse('all-borrowed') )
 
     # If this is a GET (or any other method) create the default form.
     else:
         proposed_renewal_date = datetime.date.today() + datetime.timedelta(weeks=3)
-        form = RenewBookForm(initial={'renewal_date': proposed_renewal_date})
+        form = RenewCopyForm(initial={'renewal_date': proposed_renewal_date, 'version': book_instance.version})
 
     # Contains our BookInstance
     context = {
@@ -141,6 +215,81 @@ def renew_book_librarian(request, pk):
     # Render creates the HTML page
     return render(request, 'catalog/book_renew_librarian.html', context)
 
+@permission_required('catalog.can_mark_returned')
+def renew_books_bulk(request):
+    """Renew every copy ticked on the all borrowed page to one date, with a single UPDATE."""
+    if request.method == 'POST':
+        form = BulkRenewBookForm(request.POST)
+        if form.is_valid():
+            copies, renewal_date = form.cleaned_data['copies'], form.cleaned_data['renewal_date']
+            if len(copies) > RENEW_INLINE_LIMIT:
+                # Too many to wait for: renew them in the background (see catalog/jobs.py)
+                job = jobs.enqueue('renew_loans', user=request.user, copy_ids=copies, renewal_date=renewal_date)
+                return HttpResponseRedirect(job.get_absolute_url())
+            BookInstance.objects.filter(pk__in=copies).renew(renewal_date)
+            return HttpResponseRedirect(reverse('all-borrowed'))
+    else:
+        proposed_renewal_date = datetime.date.today() + datetime.timedelta(weeks=3)
+        form = BulkRenewBookForm(initial={'renewal_date': proposed_renewal_date,
+                                          'copies': request.GET.getlist('copies')})
+
+    return render(request, 'catalog/book_renew_bulk.html', {'form': form})
+
+@permission_required('catalog.can_mark_returned')
+def checkout_copy(request, pk):
+    """Lend a copy to a patron (see catalog/loans.py)."""
+    book_instance = get_object_or_404(BookInstance.objects.select_related('book'), pk=pk)
+    if request.method == 'POST':
+        form = CheckoutForm(request.POST)
+        if form.is_valid():
+            try:
+                loans.checkout(book_instance.pk, form.cleaned_data['borrower'], form.cleaned_data['due_back'],
+                               form.cleaned_data['version'])
+            except loans.LoanError as e:
+                form.add_error(None, str(e))
+            else:
+                return HttpResponseRedirect(book_instance.book.get_absolute_url())
+    else:
+        form = CheckoutForm(initial={'due_back': datetime.date.today() + loans.LOAN_PERIOD,
+                                     'version': book_instance.version})
+    return render(request, 'catalog/bookinstance_checkout.html', {'form': form, 'book_instance': book_instance})
+
+@permission_required('catalog.can_mark_returned')
+def return_copy(request, pk):
+    """Take a copy back; it goes to the next patron waiting for the book, if any."""
+    book_instance = get_object_or_404(BookInstance.objects.select_related('book', 'borrower'), pk=pk)
+    if request.method == 'POST':
+        form = CopyVersionForm(request.POST)
+        if form.is_valid():
+            try:
+                loans.return_copy(book_instance.pk, form.cleaned_data['version'])
+            except loans.LoanError as e:
+                form.add_error(None, str(e))
+            else:
+                return HttpResponseRedirect(reverse('all-borrowed'))
+    else:
+        form = CopyVersionForm(initial={'version': book_instance.version})
+    return render(request, 'catalog/bookinstance_return.html', {'form': form, 'book_instance': book_instance})
+
+from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_POST
+
+@login_required
+@require_POST
+def place_hold(request, pk):
+    """Join the queue for a book; a copy on the shelf is set aside straight away."""
+    book = get_object_or_404(Book, pk=pk)
+    holds.place_hold(book, request.user)
+    return HttpResponseRedirect(book.get_absolute_url())
+
+@login_required
+@require_POST
+def cancel_hold(request, pk):
+    """Leave the queue; a copy set aside for the hold goes to the next patron."""
+    hold = get_object_or_404(Hold, pk=pk, patron=request.user)
+    holds.cancel_hold(hold)
+    return HttpResponseRedirect(reverse('book-detail', args=[hold.book_id]))
+
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.urls import reverse_lazy
 
@@ -161,4 +310,104 @@ class AuthorUpdate(UpdateView):
 class AuthorDelete(DeleteView):
     model = Author
     # Redirects to the author list after an author has been deleated
-    success_url = reverse_lazy('authors')
\ No newline at end of file
+    success_url = reverse_lazy('authors')
+
+# Streams a whole table as CSV or JSONL for downstream systems, see catalog/export.py
+from django.http import Http404, StreamingHttpResponse
+from catalog.export import DATASETS, FORMATS, export_lines, gzip_stream
+
+@permission_required('catalog.can_mark_returned')
+def export_catalog(request, dataset):
+    """Stream a catalog export. ?format=csv|jsonl, ?gzip=1 to compress."""
+    file_format = request.GET.get('format', 'csv')
+    if dataset not in DATASETS or file_format not in FORMATS:
+        raise Http404('Unknown export')
+
+    lines = export_lines(dataset, file_format)
+    filename = f'{dataset}.{file_format}'
+    content_type = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    if request.GET.get('gzip'):
+        response = StreamingHttpResponse(gzip_stream(lines), content_type='application/gzip')
+        filename += '.gz'
+    else:
+        response = StreamingHttpResponse(lines, content_type=f'{content_type}; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+# Loan history reports, read from the monthly rollups (see catalog/ledger.py)
+from catalog import ledger
+
+@permission_required('catalog.can_mark_returned')
+def loan_report(request):
+    """The most borrowed books of a month. ?month=YYYY-MM, default this month."""
+    try:
+        month = datetime.datetime.strptime(request.GET.get('month', ''), '%Y-%m').date()
+        # The links to the previous and following months need a year on either side
+        if not datetime.MINYEAR < month.year < datetime.MAXYEAR:
+            raise ValueError
+    except ValueError:
+        month = datetime.date.today().replace(day=1)
+    previous = (month - datetime.timedelta(days=1)).replace(day=1)
+    following = (month + datetime.timedelta(days=31)).replace(day=1)
+    context = {
+        'month': month,
+        'previous': previous,
+        'following': following if following <= datetime.date.today() else None,
+        'popular': ledger.popular_books(month),
+    }
+    return render(request, 'catalog/loan_report.html', context)
+
+# Request profiling dashboard, see catalog/profiling.py
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
+from catalog import profiling
+
+@staff_member_required
+def profiling_dashboard(request):
+    """Latency and SQL numbers per view collected by this process. ?format=json for the raw numbers."""
+    snapshot = profiling.collector.snapshot()
+    if request.GET.get('format') == 'json':
+        return JsonResponse(snapshot)
+    views = sorted(snapshot['views'].items(), key=lambda item: -item[1]['wall_ms']['p95'])
+    return render(request, 'catalog/profiling.html', {'snapshot': snapshot, 'views': views})
+
+# Background jobs and their status pages, see catalog/jobs.py
+from catalog.models import Job
+
+# Maintenance tasks librarians can start from the jobs page
+MAINTENANCE_TASKS = {
+    'rebuild_availability': 'Recount the copies of every book',
+    'rebuild_search_index': 'Rebuild the search index',
+    'rebuild_loan_rollups': 'Rebuild the loan reports',
+    'build_recommendations': 'Rebuild "readers also borrowed"',
+    'send_overdue_notices': 'Send overdue notices',
+}
+
+class JobListView(PermissionRequiredMixin, KeysetPaginationMixin, generic.ListView):
+    """Recent background jobs, newest first, with buttons to start maintenance tasks."""
+    model = Job
+    paginate_by = 20
+    permission_required = 'catalog.can_mark_returned'
+    keyset_count = False
+
+    def get_queryset(self):
+        return Job.objects.select_related('created_by').defer('arguments', 'result', 'error')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['maintenance_tasks'] = MAINTENANCE_TASKS
+        return context
+
+class JobDetailView(PermissionRequiredMixin, generic.DetailView):
+    model = Job
+    permission_required = 'catalog.can_mark_returned'
+
+@permission_required('catalog.can_mark_returned')
+@require_POST
+def enqueue_job(request):
+    """Queue one of the MAINTENANCE_TASKS and show its status page."""
+    task = request.POST.get('task')
+    if task not in MAINTENANCE_TASKS:
+        raise Http404('Unknown task')
+    job = jobs.enqueue(task, user=request.user)
+    return HttpResponseRedirect(job.get_absolute_url())
@@ -0,0 +1,34 @@
+from django.conf import settings
+
+# Home page visit counts are kept in a signed cookie rather than the session,
+# so counting a visit never writes to the database (with the database session
+# backend every modified session is an UPDATE of django_session, and on SQLite
+# writers queue up behind each other). The signature stops clients from
+# editing their count; a cookie that fails the check counts from zero again.
+VISITS_COOKIE = 'catalog_visits'
+VISITS_SALT = 'catalog.visits'
+VISITS_MAX_AGE = 60 * 60 * 24 * 365
+
+# Where earlier versions kept the count
+SESSION_VISITS_KEY = 'num_visits'
+
+
+def get_visits(request):
+    """Return how many times this client has visited before."""
+    visits = request.get_signed_cookie(VISITS_COOKIE, default=None, salt=VISITS_SALT)
+    if visits is None:
+        # Carry over a count from the session, for clients that visited
+        # before the cookie existed. This only reads the session.
+        visits = request.session.get(SESSION_VISITS_KEY, 0) if settings.SESSION_COOKIE_NAME in request.COOKIES else 0
+    try:
+        return max(int(visits), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def count_visit(response, visits):
+    """Store the visit count (including this visit) on the response."""
+    response.set_signed_cookie(VISITS_COOKIE, str(visits + 1), salt=VISITS_SALT,
+                               max_age=VISITS_MAX_AGE, httponly=True, samesite='Lax')
+    return response
+
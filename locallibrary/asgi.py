@@ -7,10 +7,94 @@ For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 """
 
+import functools
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'locallibrary.settings')
 
-application = get_asgi_application()
+
+class ThreadPoolASGIHandler(ASGIHandler):
+    """ASGIHandler that serves requests on a pool of threads.
+
+    Django 3.0 has no async views, so the stock handler runs every request's
+    view through sync_to_async() with the default thread_sensitive=True, which
+    (with current asgiref) puts all requests on one shared thread: under ASGI
+    the site served one request at a time. Here each request gets a thread
+    from a pool of ASGI_THREADS (default 32), like a threaded WSGI server,
+    while the event loop keeps reading requests and writing responses.
+
+    Database connections belong to the thread that opened them, so they are
+    closed (or kept, per CONN_MAX_AGE) in that same thread after the view."""
+    executor = ThreadPoolExecutor(max_workers=int(os.environ.get('ASGI_THREADS', 32)),
+                                  thread_name_prefix='asgi')
+
+    async def get_response(self, request):
+        return await sync_to_async(self.get_response_in_thread, thread_sensitive=False,
+                                   executor=self.executor)(request)
+
+    def get_response_in_thread(self, request):
+        close_old_connections()
+        try:
+            return super().get_response(request)
+        finally:
+            close_old_connections()
+
+    async def send_response(self, response, send):
+        """Like ASGIHandler.send_response(), but a streaming response's iterator
+        (e.g. an export running ORM queries) is consumed off the event loop.
+
+        Its chunks are pulled on one thread of its own: the database cursor it
+        reads from belongs to the connection of the thread that opened it, and
+        a pool thread could close that connection while serving another request."""
+        if not response.streaming:
+            return await super().send_response(response, send)
+        thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='asgi-stream')
+        in_thread = functools.partial(sync_to_async, thread_sensitive=False, executor=thread)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': self.response_headers(response),
+            })
+            # Access `__iter__` and not `streaming_content`, as Django does
+            parts = await in_thread(iter)(response)
+            while True:
+                part = await in_thread(next)(parts, None)
+                if part is None:
+                    break
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            # Fires request_finished, which closes the connections of that thread
+            await in_thread(response.close)()
+            thread.shutdown(wait=False)
+
+    @staticmethod
+    def response_headers(response):
+        # As in ASGIHandler.send_response()
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        return headers
+
+
+def get_application():
+    # What django.core.asgi.get_asgi_application() does, with the handler above
+    django.setup(set_prefix=False)
+    return ThreadPoolASGIHandler()
+
+
+application = get_application()
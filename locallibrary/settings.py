@@ -37,10 +37,12 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'catalog',
+    'catalog.apps.CatalogConfig',
 ]
 
 MIDDLEWARE = [
+    # First, so its timings include the other middleware (see catalog/profiling.py)
+    'catalog.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -84,6 +86,79 @@ DATABASES = {
     }
 }
 
+# PRAGMAs run on every new SQLite connection (see catalog/sqlite.py)
+SQLITE_PRAGMAS = {}
+
+# Production profile for SQLite, enabled with CATALOG_DB_PROFILE=production:
+# - WAL journal, so readers never block the writer and vice versa, with
+#   synchronous=NORMAL (durable at each checkpoint rather than each commit)
+# - reads through a 256 MB memory map and a 64 MB page cache per connection
+# - writers wait up to 20 s for the write lock instead of failing with
+#   "database is locked"
+# - persistent connections (CONN_MAX_AGE), so the pragmas and the page cache
+#   aren't thrown away after every request
+# `python manage.py benchmark_sqlite` compares it with the defaults.
+SQLITE_PRODUCTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negative: in KiB
+    'busy_timeout': 20000,  # ms
+}
+
+if os.environ.get('CATALOG_DB_PROFILE') == 'production':
+    DATABASES['default']['CONN_MAX_AGE'] = 600
+    # Seconds; Python's sqlite3 module sets busy_timeout from it as well
+    DATABASES['default']['OPTIONS'] = {'timeout': 20}
+    SQLITE_PRAGMAS = SQLITE_PRODUCTION_PRAGMAS
+
+
+# Caches
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# 'pages' holds the rendered catalog pages served to anonymous visitors (see
+# catalog/cache.py). By default it is an in-process LRU capped at MAX_ENTRIES;
+# set CATALOG_PAGE_CACHE=file to keep the pages on disk and share them between
+# worker processes instead. 'page-versions' holds the version of each model
+# the pages were built from. It is always shared through files, so a change
+# made by any process (a management command, a job in run_workers) makes the
+# pages of every web worker stale; a cache hit only reads it.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog-pages',
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    },
+    'page-versions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'versions'),
+    },
+}
+
+if os.environ.get('CATALOG_PAGE_CACHE') == 'file':
+    CACHES['pages'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'pages'),
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    }
+
+# The tests run with caches of their own (see catalog/tests/runner.py)
+TEST_RUNNER = 'catalog.tests.runner.CatalogTestRunner'
+
+
+# Request profiling (see catalog/profiling.py): per-view latency and SQL
+# histograms at /catalog/profiling/ for staff. PROFILING_FILE, if set, also
+# gets them as JSON every PROFILING_FLUSH_SECONDS; "{pid}" in it is replaced
+# by the process id, since each process collects its own.
+PROFILING_ENABLED = os.environ.get('CATALOG_PROFILING', '1') == '1'
+PROFILING_FILE = os.environ.get('CATALOG_PROFILING_FILE')
+PROFILING_FLUSH_SECONDS = 60
+# The same SQL this many times in one request is flagged as a possible N+1
+PROFILING_REPEATED_QUERIES = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators